@@ -0,0 +1,207 @@
+"""============================================================================
+Dynamical (state-space) probabilistic CCA.
+
+Instead of flattening clusters x time bins into one vector, the shared latent
+follows linear-Gaussian dynamics across bins and both regions read it out
+through their own loadings:
+
+    z_1 ~ N(mu0, V0),      z_t = A z_{t-1} + w_t,     w_t ~ N(0, Q)
+    [x1_t; x2_t] = C z_t + d + v_t,                   v_t ~ N(0, diag(r))
+
+Inference is a Kalman filter / RTS smoother in information form, so a bin
+costs O(p k + k^3) with p the number of neurons, and the whole E-step is
+linear in the number of bins. Since the model is time-invariant and every
+trial has the same length, the covariance recursions are run once and only
+the means are propagated per trial. References:
+
+    From Linear Dynamical Systems to Factor Analysis (and back).
+    Roweis, Ghahramani (1999).
+
+    Parameter Estimation for Linear Dynamical Systems.
+    Ghahramani, Hinton (1996).
+============================================================================"""
+
+import numpy as np
+
+import instrument
+
+inv = np.linalg.inv
+solve = np.linalg.solve
+
+
+# -----------------------------------------------------------------------------
+
+class DynamicalPCCA:
+
+    def __init__(self, n_components, n_iters, regularization=1e-3):
+        """Initialize dynamical PCCA.
+
+        `regularization` is added to the diagonal observation noise in every
+        M-step, like PCCA's ridge term on Psi.
+        """
+        self.k = n_components
+        self.n_iters = n_iters
+        self.reg = regularization
+
+    def fit(self, X1, X2):
+        """Fit via EM on (n_trials, n_time_bins, n_neurons_i) tensors, as
+        returned by prepare_pcca_matrices.
+        """
+        with instrument.timer('dpcca_fit', k=self.k):
+            X = self._init_params(X1, X2)
+            self.log_likelihoods_ = []
+            for _ in range(self.n_iters):
+                with instrument.timer('em_iter'):
+                    m, P, P_cross, ll = self._smooth(X)
+                    self.log_likelihoods_.append(ll)
+                    self._m_step(X, m, P, P_cross)
+            instrument.count('em_iterations', self.n_iters)
+            self.log_likelihood_ = self._smooth(X)[3]
+        return self
+
+    def transform(self, X1, X2):
+        """Smoothed latent means E[z_t | x1, x2], shape (n_trials, T, k).
+        """
+        return self._smooth(np.concatenate([X1, X2], axis=-1))[0]
+
+    def predict_view(self, X, source=1):
+        """E[X2 | X1] (or E[X1 | X2]) per bin, smoothing on `source` only.
+        """
+        rows = self._rows(source)
+        target = self._rows(2 if source == 1 else 1)
+        m = self._smooth(X, rows)[0]
+        return m @ self.C[target].T + self.d[target]
+
+    def prediction_error(self, X1, X2):
+        """Cross-view RMSEs, as PCCA.prediction_error.
+        """
+        rmse1 = np.sqrt(np.mean((X1 - self.predict_view(X2, source=2)) ** 2))
+        rmse2 = np.sqrt(np.mean((X2 - self.predict_view(X1, source=1)) ** 2))
+        return rmse1, rmse2
+
+    @property
+    def C1(self):
+        return self.C[:self.p1]
+
+    @property
+    def C2(self):
+        return self.C[self.p1:]
+
+# -----------------------------------------------------------------------------
+
+    def _rows(self, view):
+        return slice(None, self.p1) if view == 1 else slice(self.p1, None)
+
+    def _smooth(self, X, rows=slice(None)):
+        """Kalman filter + RTS smoother using observation rows `rows`.
+
+        Returns smoothed means (n, T, k), smoothed covariances (T, k, k),
+        lag-one cross covariances Cov(z_{t+1}, z_t) (T-1, k, k) and the
+        log-likelihood of X.
+        """
+        n, T, p = X.shape
+        k = self.k
+        C, d, r = self.C[rows], self.d[rows], self.r[rows]
+        A, Q = self.A, self.Q
+
+        # Everything the filter needs from the data, projected once
+        Xc = X - d
+        RinvC = C / r[:, None]
+        J = C.T @ RinvC                       # C^T R^-1 C
+        Y = Xc @ RinvC                        # C^T R^-1 (x_t - d), (n, T, k)
+        q = np.einsum('ntp,ntp->nt', Xc, Xc / r)
+        logdet_R = np.sum(np.log(r))
+
+        # Covariance recursions (shared by all trials)
+        P_pred = np.empty((T, k, k))
+        P_filt = np.empty((T, k, k))
+        P_pred[0] = self.V0
+        for t in range(T):
+            if t > 0:
+                P_pred[t] = A @ P_filt[t - 1] @ A.T + Q
+            P_filt[t] = inv(inv(P_pred[t]) + J)
+            P_filt[t] = (P_filt[t] + P_filt[t].T) / 2
+
+        # Mean recursions (batched over trials) and innovations likelihood
+        m_pred = np.empty((n, T, k))
+        m_filt = np.empty((n, T, k))
+        ll = -0.5 * n * T * p * np.log(2 * np.pi)
+        for t in range(T):
+            m_pred[:, t] = self.mu0 if t == 0 else m_filt[:, t - 1] @ A.T
+            info = solve(P_pred[t], m_pred[:, t].T).T + Y[:, t]
+            m_filt[:, t] = info @ P_filt[t]
+
+            # log N(x_t; C m_pred + d, C P_pred C^T + R) via Woodbury
+            u = Y[:, t] - m_pred[:, t] @ J          # C^T R^-1 e_t
+            e_Rinv_e = q[:, t] - 2 * np.sum(m_pred[:, t] * Y[:, t], axis=1) \
+                + np.sum((m_pred[:, t] @ J) * m_pred[:, t], axis=1)
+            quad = e_Rinv_e - np.sum((u @ P_filt[t]) * u, axis=1)
+            logdet = logdet_R + np.linalg.slogdet(np.eye(k) + P_pred[t] @ J)[1]
+            ll -= 0.5 * np.sum(quad + logdet)
+
+        # RTS smoother
+        m = np.empty_like(m_filt)
+        P = np.empty_like(P_filt)
+        P_cross = np.empty((max(T - 1, 0), k, k))
+        m[:, -1] = m_filt[:, -1]
+        P[-1] = P_filt[-1]
+        for t in range(T - 2, -1, -1):
+            G = solve(P_pred[t + 1], A @ P_filt[t]).T   # P_filt A^T P_pred^-1
+            m[:, t] = m_filt[:, t] + (m[:, t + 1] - m_pred[:, t + 1]) @ G.T
+            P[t] = P_filt[t] + G @ (P[t + 1] - P_pred[t + 1]) @ G.T
+            P_cross[t] = P[t + 1] @ G.T
+
+        return m, P, P_cross, ll
+
+    def _m_step(self, X, m, P, P_cross):
+        n, T, p = X.shape
+        k = self.k
+        N = n * T
+
+        # Observation model: regress x_t on [z_t; 1]
+        Ezz = n * P.sum(axis=0) + np.einsum('ntj,ntl->jl', m, m)
+        Ez = m.sum(axis=(0, 1))
+        Sxz = np.einsum('ntp,ntj->pj', X, m)
+        Sx = X.sum(axis=(0, 1))
+        lhs = np.block([[Ezz, Ez[:, None]], [Ez[None, :], np.array([[N]])]])
+        Cd = solve(lhs, np.hstack([Sxz, Sx[:, None]]).T).T
+        self.C, self.d = Cd[:, :k], Cd[:, k]
+        Sxx = np.einsum('ntp,ntp->p', X, X)
+        self.r = (Sxx - np.sum(Cd * np.hstack([Sxz, Sx[:, None]]), axis=1)) / N + self.reg
+
+        # Dynamics
+        if T > 1:
+            E_prev = n * P[:-1].sum(axis=0) + np.einsum('ntj,ntl->jl', m[:, :-1], m[:, :-1])
+            E_next = n * P[1:].sum(axis=0) + np.einsum('ntj,ntl->jl', m[:, 1:], m[:, 1:])
+            E_cross = n * P_cross.sum(axis=0) + np.einsum('ntj,ntl->jl', m[:, 1:], m[:, :-1])
+            self.A = solve(E_prev.T, E_cross.T).T
+            Q = (E_next - self.A @ E_cross.T) / (n * (T - 1))
+            self.Q = (Q + Q.T) / 2 + 1e-9 * np.eye(k)
+
+        # Initial state
+        self.mu0 = m[:, 0].mean(axis=0)
+        dm = m[:, 0] - self.mu0
+        V0 = P[0] + dm.T @ dm / n
+        self.V0 = (V0 + V0.T) / 2 + 1e-9 * np.eye(k)
+
+    def _init_params(self, X1, X2):
+        """Initialize from a PCA of the pooled bins; returns the stacked data.
+        """
+        self.n, self.T, self.p1 = X1.shape
+        self.p2 = X2.shape[2]
+        self.p = self.p1 + self.p2
+        X = np.concatenate([X1, X2], axis=-1).astype(float)
+
+        flat = X.reshape(-1, self.p)
+        self.d = flat.mean(axis=0)
+        cov = np.cov(flat.T)
+        evals, evecs = np.linalg.eigh(cov)
+        evals, evecs = evals[::-1][:self.k], evecs[:, ::-1][:, :self.k]
+        self.C = evecs * np.sqrt(np.maximum(evals, 1e-6))
+        self.r = np.maximum(np.diag(cov) - np.sum(self.C ** 2, axis=1), 0) + self.reg + 1e-6
+
+        self.A = 0.9 * np.eye(self.k)
+        self.Q = (1 - 0.9 ** 2) * np.eye(self.k)
+        self.mu0 = np.zeros(self.k)
+        self.V0 = np.eye(self.k)
+        return X
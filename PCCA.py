@@ -10,40 +10,154 @@ Probabilistic canonical correlation analysis. For references in comments:
     Ghahramani, Hinton (1996).
 ============================================================================"""
 
+import copy
+import json
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 
+import instrument
+from reduction import AdaptivePCA
+
 inv = np.linalg.inv
+solve = np.linalg.solve
 
 
 # -----------------------------------------------------------------------------
 
 class PCCA:
 
-    def __init__(self, n_components, n_iters, regularization=1.0):
+    def __init__(self, n_components, n_iters, regularization=1.0, n_init=1,
+                 n_jobs=1, backend='thread', noise='full'):
         """Initialize probabilistic CCA model.
+
+        n_init random restarts are run as one stacked batch (W of shape
+        (n_init, p, k)) and the restart with the highest log-likelihood is
+        kept. With n_jobs > 1 the batch is split over a thread or process
+        pool (`backend`).
+
+        noise is 'full', 'diagonal' or 'isotropic', or a pair giving the
+        mode of each view. Diagonal and isotropic views store Psi_i as a
+        length-p_i vector, and when no view is full the p x p moment matrix
+        is never formed, so EM runs in O(p k) memory beyond the data itself.
         """
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"Unknown backend: {backend}")
+        if isinstance(noise, str):
+            noise = (noise, noise)
+        for mode in noise:
+            if mode not in NOISE_MODES:
+                raise ValueError(f"Unknown noise mode: {mode}")
+        self.noise = tuple(noise)
         self.k = n_components
         self.n_iters = n_iters
         self.reg = regularization
+        self.n_init = n_init
+        self.n_jobs = n_jobs
+        self.backend = backend
 
     def fit(self, X1, X2):
         """Fit model via EM.
         """
+        with instrument.timer('pcca_fit', k=self.k):
+            self._init_params(X1, X2)
+            self.moments = self._moments()
+            self._fit_em()
+
+    def partial_fit(self, X1, X2, n_iters=5):
+        """Add trials to a fitted model and refresh it with a few EM steps.
+
+        The new trials are folded into the second moments,
+        S <- (n S + X_new X_new^T) / (n + m), and EM continues from the
+        current W and Psi for `n_iters` steps (no restarts). With full noise
+        the update costs O(m p^2) and each step O(p^2 k), whatever the number
+        of trials seen before. Diagonal/isotropic views keep S implicit
+        through the data, so there the new trials are appended to it and
+        the steps still scale with all n trials. An unfitted model is
+        fitted on (X1, X2) instead.
+        """
+        if not hasattr(self, 'W'):
+            return self.fit(X1, X2)
+        if not hasattr(self, 'moments'):
+            raise ValueError("partial_fit needs the training moments, which "
+                             "saved models do not keep; refit instead")
+        with instrument.timer('pcca_partial_fit', k=self.k):
+            X_new = np.hstack([X1, X2]).T
+            n, m = self.n, X_new.shape[1]
+            self._append_trials(X_new)
+            if self.moments.S is not None:
+                self.S = (n * self.moments.S + X_new @ X_new.T) / (n + m)
+                self.moments = _Moments(self.p1, S=self.S)
+            else:
+                self.moments = _Moments(self.p1, X=self.X, noise=self.noise)
+            W, Psi1, Psi2, ll = _run_em(self.moments, self.W, self.Psi1, self.Psi2,
+                                        self.reg, n_iters, self.n, self.noise)
+            self.W = W
+            self._set_noise(Psi1, Psi2)
+            self.log_likelihood_ = ll
+
+    def regularization_path(self, X1, X2, regs, tol=1e-5, max_iters=None):
+        """Fit PCCA along a decreasing sequence of ridge values.
+
+        Each fit is warm-started from the previous one, and S is computed
+        once for the whole path. Psi only enters the M-step as R_i + reg I,
+        so the next ridge value starts from the previous residual blocks
+        shifted along the diagonal. EM at each value stops once the relative
+        change in W falls below `tol`, or after `max_iters` (default
+        n_iters). The model is left fitted at the smallest value.
+
+        Returns a dict of arrays with one entry per ridge value: 'regs',
+        'log_likelihood', 'n_iters', 'W', 'Psi1', 'Psi2' and
+        'canonical_correlations'.
+        """
+        regs = np.sort(np.asarray(regs, dtype=float).ravel())[::-1]
+        if regs.size == 0:
+            raise ValueError("regs must hold at least one ridge value")
+        noise = self.noise
+        max_iters = self.n_iters if max_iters is None else max_iters
+        if max_iters < 1:
+            raise ValueError(f"max_iters must be >= 1, got {max_iters}")
         self._init_params(X1, X2)
-        #np.linalg.cholesky(self.Psi)
-        print('is psd')
-        for _ in range(self.n_iters):
-            self._em_step()
-            #np.linalg.cholesky(self.Psi)
+        self.moments = mom = self._moments()
+
+        W, Psi1, Psi2 = self.W, self.Psi1, self.Psi2
+        prev_reg = None
+        path = {key: [] for key in ('log_likelihood', 'n_iters', 'W', 'Psi1',
+                                    'Psi2', 'canonical_correlations')}
+        for reg in regs:
+            if prev_reg is not None:
+                Psi1 = _noise_shift(Psi1, reg - prev_reg, noise[0])
+                Psi2 = _noise_shift(Psi2, reg - prev_reg, noise[1])
+            for it in range(1, max_iters + 1):
+                W_new, Psi1, Psi2 = _em_update(mom, W, Psi1, Psi2, reg, noise)
+                delta = np.linalg.norm(W_new - W) / np.linalg.norm(W_new)
+                W = W_new
+                if delta < tol:
+                    break
+            prev_reg = reg
+            path['log_likelihood'].append(
+                _log_likelihood(mom, W, Psi1, Psi2, self.n, noise))
+            path['n_iters'].append(it)
+            path['W'].append(W)
+            path['Psi1'].append(Psi1)
+            path['Psi2'].append(Psi2)
+            path['canonical_correlations'].append(
+                _canonical_correlations(W, Psi1, Psi2, noise))
+
+        self.reg = regs[-1]
+        self.W = W
+        self._set_noise(Psi1, Psi2)
+        self.log_likelihood_ = path['log_likelihood'][-1]
+        path = {key: np.array(val) for key, val in path.items()}
+        path['regs'] = regs
+        return path
 
     def transform(self, X1, X2):
         """Embed data using fitted model.
         """
-        X = np.hstack([X1, X2]).T
-        Psi_inv = inv(self.Psi)
-        M = inv(np.eye(self.k) + self.W.T @ Psi_inv @ self.W)
-        Z = M @ self.W.T @ Psi_inv @ X
-        return Z.T
+        A, M = self._view_factors()[None]
+        Z = np.hstack([X1, X2]) @ A @ M
+        return Z
 
     def fit_transform(self, X1, X2):
         self.fit(X1, X2)
@@ -56,9 +170,8 @@ class PCCA:
         if n_samples is None:
           n_samples = self.n
 
-        Psi_inv = inv(self.Psi)
-        M = inv(np.eye(self.k) + self.W.T @ Psi_inv @ self.W)
-        Z_post_mean = M @ self.W.T @ Psi_inv @ self.X
+        A, M = self._view_factors()[None]
+        Z_post_mean = M @ A.T @ self.X
 
         X_mean = self.W @ Z_post_mean
         X_samples = np.zeros((self.n, self.p))
@@ -71,38 +184,189 @@ class PCCA:
 
         return X1_samples, X2_samples
 
-# -----------------------------------------------------------------------------
+    def predict_view(self, X, source=1):
+        """Conditional mean of the other view, E[X2 | X1] (or E[X1 | X2]).
 
-    def _em_step(self):
-        Psi_inv = inv(self.Psi)
-        M = inv(np.eye(self.k) + self.W.T @ Psi_inv @ self.W)
-        Z = M @ self.W.T @ Psi_inv @ self.X
-        Ezz = Z @ Z.T + self.n * M
+        Only `source`'s block of the model is used: by Woodbury,
+        E[z | x_s] = (I + W_s^T Psi_s^-1 W_s)^-1 W_s^T Psi_s^-1 x_s, so after
+        the per-view factors are cached a call costs O(n p k + k^3).
+        """
+        Z = PCCA.predict_latent(self, X, source)
+        W_target = self.W[self.p1:] if source == 1 else self.W[:self.p1]
+        return Z @ W_target.T
 
-        # Update W explicitly
-        W_new = (self.X @ Z.T) @ inv(Ezz)
+    def predict_latent(self, X, source=1):
+        """Posterior latent mean E[z | x_source] for each row of X.
+        """
+        A_s, M_s = self._view_factors()[source]
+        return X @ A_s @ M_s
 
-        # Compute residuals explicitly
-        X_recon = W_new @ Z
-        residual = self.X - X_recon
+    def posterior_covariance(self, source=None):
+        """Posterior latent covariance Cov[z | x], shape (k, k).
 
-        # Clearly separate Psi1 and Psi2
-        residual1 = residual[:self.p1, :]
-        residual2 = residual[self.p1:, :]
+        source=None conditions on both views, source=1/2 on a single view.
+        In this linear-Gaussian model it is identical for every trial.
+        """
+        return self._view_factors()[source][1]
+
+    def prediction_error(self, X1, X2):
+        """Deterministic cross-view RMSEs.
 
-        Psi1_new = (residual1 @ residual1.T) / self.n + self.reg * np.eye(self.p1)
-        Psi2_new = (residual2 @ residual2.T) / self.n + self.reg * np.eye(self.p2)
+        Returns (rmse1, rmse2): X1 against E[X1 | X2] and X2 against
+        E[X2 | X1]. Replaces comparing the data to random `sample()` draws.
+        """
+        rmse1 = np.sqrt(np.mean((X1 - self.predict_view(X2, source=2)) ** 2))
+        rmse2 = np.sqrt(np.mean((X2 - self.predict_view(X1, source=1)) ** 2))
+        return rmse1, rmse2
+
+    def canonical_correlations(self):
+        """Canonical correlations implied by the fitted model, shape (k,).
+        """
+        return _canonical_correlations(self.W, self.Psi1, self.Psi2, self.noise)
 
-        # Combine Psi clearly
-        self.Psi = np.block([
-            [Psi1_new, np.zeros((self.p1, self.p2))],
-            [np.zeros((self.p2, self.p1)), Psi2_new]
+    def get_params(self):
+        """Constructor arguments of this model (JSON-serializable).
+        """
+        return {'n_components': self.k, 'n_iters': self.n_iters,
+                'regularization': float(self.reg), 'n_init': self.n_init,
+                'n_jobs': self.n_jobs, 'backend': self.backend,
+                'noise': list(self.noise)}
+
+    def save(self, path):
+        """Write the fitted model to an .npz file, see PCCA.load.
+
+        Holds the hyperparameters, W, the noise blocks and the fit
+        diagnostics but not the training data, so a loaded model can
+        transform and predict, while sample() and resampling need a refit.
+        """
+        np.savez(path, model_class=type(self).__name__,
+                 params=json.dumps(self.get_params()), **self._state())
+
+    @classmethod
+    def load(cls, path):
+        """Read a model written by save(), restoring its original class.
+        """
+        with np.load(path, allow_pickle=False) as f:
+            state = {key: f[key] for key in f.files}
+        model_class = _MODEL_CLASSES[str(state.pop('model_class'))]
+        if not issubclass(model_class, cls):
+            raise TypeError(f"{path} holds a {model_class.__name__}, not a {cls.__name__}")
+        model = model_class(**json.loads(str(state.pop('params'))))
+        model._set_state(state)
+        return model
+
+    def _state(self):
+        state = {'W': self.W, 'Psi1': self.Psi1, 'Psi2': self.Psi2,
+                 'n': self.n, 'p1': self.p1, 'p2': self.p2}
+        for name in ('log_likelihood_', 'restart_log_likelihoods_'):
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+        return state
+
+    def _set_state(self, state):
+        self.W = state['W']
+        self._set_noise(state['Psi1'], state['Psi2'])
+        self.n, self.p1, self.p2 = (int(state[key]) for key in ('n', 'p1', 'p2'))
+        self.p = self.p1 + self.p2
+        if 'log_likelihood_' in state:
+            self.log_likelihood_ = float(state['log_likelihood_'])
+        if 'restart_log_likelihoods_' in state:
+            self.restart_log_likelihoods_ = state['restart_log_likelihoods_']
+
+    def _view_factors(self):
+        """Cached Psi^-1 W and posterior covariances, joint and per view.
+
+        Returns {None: (A, M), 1: (A1, M1), 2: (A2, M2)} where
+        A_s = Psi_s^-1 W_s and M_s = (I + W_s^T Psi_s^-1 W_s)^-1. Psi is
+        solved one view block at a time, so nothing larger than p_i x p_i is
+        ever factorized.
+        """
+        cached = getattr(self, '_factors', None)
+        if cached is not None and cached[0] is self.W and \
+                cached[1] is self.Psi1 and cached[2] is self.Psi2:
+            return cached[3]
+
+        I = np.eye(self.k)
+        W1, W2 = self.W[:self.p1], self.W[self.p1:]
+        A1 = _noise_solve(self.Psi1, W1, self.noise[0])
+        A2 = _noise_solve(self.Psi2, W2, self.noise[1])
+        G1, G2 = W1.T @ A1, W2.T @ A2
+        factors = {None: (np.vstack([A1, A2]), inv(I + G1 + G2)),
+                   1: (A1, inv(I + G1)),
+                   2: (A2, inv(I + G2))}
+        self._factors = (self.W, self.Psi1, self.Psi2, factors)
+        return factors
+
+    @property
+    def Psi(self):
+        """Dense p x p noise covariance, assembled on demand.
+        """
+        return np.block([
+            [_noise_dense(self.Psi1, self.noise[0]), np.zeros((self.p1, self.p2))],
+            [np.zeros((self.p2, self.p1)), _noise_dense(self.Psi2, self.noise[1])]
         ])
 
-        # Update W
-        self.W = (self.X @ Z.T) @ inv(Ezz)
+# -----------------------------------------------------------------------------
 
+    def _em_step(self):
+        W, Psi1, Psi2 = _em_update(self.moments, self.W, self.Psi1, self.Psi2,
+                                   self.reg, self.noise)
+        self.W = W
+        self._set_noise(Psi1, Psi2)
+
+    def _moments(self):
+        """Second moments of the stacked data, dense only if every view has
+        full noise.
+        """
+        if self.noise == ('full', 'full'):
+            self.S = self.X @ self.X.T / self.n
+            return _Moments(self.p1, S=self.S)
+        return _Moments(self.p1, X=self.X, noise=self.noise)
 
+    def _fit_em(self):
+        """Run the n_init EM restarts as one batch and keep the most likely.
+        """
+        R = self.n_init
+        W = np.empty((R, self.p, self.k))
+        W[0] = self.W
+        if R > 1:
+            W[1:] = np.random.random((R - 1, self.p, self.k))
+        Psi1 = np.repeat(self.Psi1[None], R, axis=0)
+        Psi2 = np.repeat(self.Psi2[None], R, axis=0)
+
+        chunks = np.array_split(np.arange(R), min(self.n_jobs, R))
+        args = [(self.moments, W[c], Psi1[c], Psi2[c], self.reg, self.n_iters,
+                 self.n, self.noise) for c in chunks]
+        if len(chunks) == 1:
+            results = [_run_em(*args[0])]
+        else:
+            Executor = ThreadPoolExecutor if self.backend == 'thread' else ProcessPoolExecutor
+            with Executor(max_workers=len(chunks)) as ex:
+                results = list(ex.map(_run_em, *zip(*args)))
+        W, Psi1, Psi2, ll = (np.concatenate(parts) for parts in zip(*results))
+
+        best = int(np.argmax(ll))
+        self.W = W[best]
+        self._set_noise(Psi1[best], Psi2[best])
+        self.log_likelihood_ = ll[best]
+        self.restart_log_likelihoods_ = ll
+
+    def _set_noise(self, Psi1, Psi2):
+        self.Psi1, self.Psi2 = Psi1, Psi2
+
+    def _append_trials(self, X_new):
+        """Append columns to the stacked data X (p x n) in amortized
+        O(m p): X is a view into a buffer that doubles when full."""
+        n, m = self.n, X_new.shape[1]
+        buf = getattr(self, '_X_buf', None)
+        if buf is None or buf.shape[1] < n + m:
+            buf = np.empty((self.p, max(2 * (n + m), 64)))
+            buf[:, :n] = self.X
+        buf[:, n:n + m] = X_new
+        self._X_buf = buf
+        self.X = buf[:, :n + m]
+        self.X1, self.X2 = self.X[:self.p1].T, self.X[self.p1:].T
+        self.n = n + m
 
     def _init_params(self, X1, X2):
         """Initialize parameters.
@@ -112,13 +376,16 @@ class PCCA:
         _, self.p2 = self.X2.shape
         self.p = self.p1 + self.p2
 
-        # Initialize sample covariances matrices.
+        # Initialize sample covariances matrices (only for full-noise views,
+        # the others never hold anything p_i x p_i).
         self.X = np.hstack([X1, X2]).T
         assert(self.X.shape == (self.p, self.n))
-        self.Sigma1 = np.cov(self.X1.T)
-        assert(self.Sigma1.shape == (self.p1, self.p1))
-        self.Sigma2 = np.cov(self.X2.T)
-        assert(self.Sigma2.shape == (self.p2, self.p2))
+        if self.noise[0] == 'full':
+            self.Sigma1 = np.cov(self.X1.T)
+            assert(self.Sigma1.shape == (self.p1, self.p1))
+        if self.noise[1] == 'full':
+            self.Sigma2 = np.cov(self.X2.T)
+            assert(self.Sigma2.shape == (self.p2, self.p2))
 
         # Initialize W.
         W1 = np.random.random((self.p1, self.k))
@@ -129,8 +396,452 @@ class PCCA:
         # Initialize Psi.
         prior_var1 = 1
         prior_var2 = 1
-        Psi1 = prior_var1 * np.eye(self.p1)
-        Psi2 = prior_var2 * np.eye(self.p2)
-        Psi = np.block([[Psi1, np.zeros((self.p1, self.p2))],
-                        [np.zeros((self.p2, self.p1)), Psi2]])
-        self.Psi = Psi
\ No newline at end of file
+        Psi1 = prior_var1 * _noise_eye(self.p1, self.noise[0])
+        Psi2 = prior_var2 * _noise_eye(self.p2, self.noise[1])
+        self._set_noise(Psi1, Psi2)
+
+
+# -----------------------------------------------------------------------------
+
+def _t(a):
+    return np.swapaxes(a, -1, -2)
+
+
+class _Moments:
+
+    def __init__(self, p1, S=None, X=None, noise=('full', 'full'), weights=None,
+                 perm=None):
+        """Second moments S = X X^T / n of the stacked views.
+
+        Either dense (`S`, p x p, possibly with leading batch axes) or
+        implicit through the data (`X`, p x n). In the implicit form S is
+        only ever applied to p x k matrices, and the within-view block is
+        formed only for views with full noise.
+
+        The implicit form can also describe a batch of resampled moment
+        matrices without copying X: `weights` (B, n) are per-trial integer
+        counts (bootstrap), `perm` (B, n) re-pairs the trials of view 2
+        with those of view 1 (trial-shuffle null).
+        """
+        self.p1 = p1
+        self.S = S
+        self.X = X
+        if X is not None:
+            if weights is not None and perm is not None:
+                raise ValueError("weights and perm cannot be combined")
+            self.n = X.shape[-1]
+            self.weights = weights
+            self.perm = perm
+            self.inv_perm = None if perm is None else np.argsort(perm, axis=-1)
+            if weights is None:
+                self.sq = np.einsum('pn,pn->p', X, X) / self.n
+            else:
+                self.sq = weights @ (X ** 2).T / self.n
+            self.blocks = tuple(
+                self._weighted_gram(X[sl]) if mode == 'full' else None
+                for sl, mode in zip(self._slices(), noise))
+
+    def dot(self, A):
+        """S @ A, batched over A's leading axes.
+        """
+        if self.S is not None:
+            return self.S @ A
+        X1, X2 = self.X[:self.p1], self.X[self.p1:]
+
+        # U = X^T A, one row per trial (pair)
+        U2 = X2.T @ A[..., self.p1:, :]
+        if self.perm is not None:
+            U2 = np.take_along_axis(U2, self.perm[..., None], axis=-2)
+        U = X1.T @ A[..., :self.p1, :] + U2
+        if self.weights is not None:
+            U = U * self.weights[..., None]
+
+        U2 = U if self.inv_perm is None else \
+            np.take_along_axis(U, self.inv_perm[..., None], axis=-2)
+        return np.concatenate([X1 @ U, X2 @ U2], axis=-2) / self.n
+
+    def block(self, view):
+        if self.S is not None:
+            sl = self._slices()[view - 1]
+            return self.S[..., sl, sl]
+        return self.blocks[view - 1]
+
+    def diag(self, view):
+        sl = self._slices()[view - 1]
+        if self.S is not None:
+            return np.diagonal(self.S[..., sl, sl], axis1=-2, axis2=-1)
+        return self.sq[..., sl]
+
+    def take(self, idx):
+        """The moments of batch entries `idx` only, sharing the data.
+        """
+        sub = copy.copy(self)
+        if self.S is not None:
+            sub.S = self.S[idx]
+        elif self.weights is not None:
+            sub.weights, sub.sq = self.weights[idx], self.sq[idx]
+            sub.blocks = tuple(None if b is None else b[idx] for b in self.blocks)
+        elif self.perm is not None:
+            sub.perm, sub.inv_perm = self.perm[idx], self.inv_perm[idx]
+        return sub
+
+    def _weighted_gram(self, X_i):
+        if self.weights is None:
+            return X_i @ X_i.T / self.n
+        return (X_i * self.weights[..., None, :]) @ X_i.T / self.n
+
+    def _slices(self):
+        return slice(None, self.p1), slice(self.p1, None)
+
+
+# Noise blocks are p_i x p_i matrices for 'full' views and length-p_i vectors
+# of variances for 'diagonal' and 'isotropic' ones (equal entries for the
+# latter). These helpers hide the difference; all broadcast over batch axes.
+
+NOISE_MODES = ('full', 'diagonal', 'isotropic')
+
+
+def _noise_eye(p_i, mode):
+    return np.eye(p_i) if mode == 'full' else np.ones(p_i)
+
+
+def _noise_solve(Psi, B, mode):
+    if mode == 'full':
+        return solve(Psi, B)
+    return B / Psi[..., :, None]
+
+
+def _noise_logdet(Psi, mode):
+    if mode == 'full':
+        return np.linalg.slogdet(Psi)[1]
+    return np.sum(np.log(Psi), axis=-1)
+
+
+def _noise_shift(Psi, shift, mode):
+    if mode == 'full':
+        return Psi + shift * np.eye(Psi.shape[-1])
+    return Psi + shift
+
+
+def _noise_dense(Psi, mode):
+    return Psi if mode == 'full' else np.diag(Psi)
+
+
+def _em_update(mom, W, Psi1, Psi2, reg, noise=('full', 'full')):
+    """One EM step written on the second moments S = X X^T / n (`mom`).
+
+    Same update as the original data-space step. With dense moments it only
+    touches p x p and p x k arrays, so the cost of an iteration no longer
+    depends on the number of trials. Psi is solved one view block at a time
+    instead of inverted whole. Diagonal/isotropic views only need diag(S_ii),
+    so they cost O(p_i k). All arguments may carry leading batch axes
+    (restarts, time windows, ...), handled by batched matmul/solve.
+    """
+    p1 = mom.p1
+    k = W.shape[-1]
+    W1, W2 = W[..., :p1, :], W[..., p1:, :]
+
+    # A = Psi^-1 W, M = (I + W^T Psi^-1 W)^-1
+    A = np.concatenate([_noise_solve(Psi1, W1, noise[0]),
+                        _noise_solve(Psi2, W2, noise[1])], axis=-2)
+    M = inv(np.eye(k) + _t(W) @ A)
+
+    # B = X Z^T / n, ZZ = Z Z^T / n with Z the posterior means
+    B = mom.dot(A) @ M
+    ZZ = M @ _t(A) @ B
+    ZZ = (ZZ + _t(ZZ)) / 2
+    Ezz = ZZ + M
+    W_new = _t(solve(Ezz, _t(B)))
+
+    # Residual covariance, diagonal blocks only
+    Psi_new = []
+    for view, sl, mode in ((1, slice(None, p1), noise[0]), (2, slice(p1, None), noise[1])):
+        W_i, B_i = W_new[..., sl, :], B[..., sl, :]
+        if mode == 'full':
+            WB = W_i @ _t(B_i)
+            R_i = mom.block(view) - WB - _t(WB) + W_i @ ZZ @ _t(W_i)
+            # Symmetrize: the antisymmetric rounding error is amplified by the
+            # next solve and would otherwise grow geometrically across
+            # iterations.
+            R_i = (R_i + _t(R_i)) / 2
+            Psi_new.append(R_i + reg * np.eye(R_i.shape[-1]))
+        else:
+            r_i = mom.diag(view) - 2 * np.sum(W_i * B_i, axis=-1) \
+                + np.sum((W_i @ ZZ) * W_i, axis=-1)
+            if mode == 'isotropic':
+                r_i = np.repeat(r_i.mean(axis=-1, keepdims=True), r_i.shape[-1], axis=-1)
+            Psi_new.append(r_i + reg)
+
+    return W_new, Psi_new[0], Psi_new[1]
+
+
+def _log_likelihood(mom, W, Psi1, Psi2, n, noise=('full', 'full')):
+    """Gaussian log-likelihood of n samples with second moments `mom` under
+    C = W W^T + blockdiag(Psi1, Psi2), via the determinant lemma and
+    Woodbury. Broadcasts over leading batch axes like _em_update.
+    """
+    p1 = mom.p1
+    k = W.shape[-1]
+    W1, W2 = W[..., :p1, :], W[..., p1:, :]
+    p = W.shape[-2]
+
+    A = np.concatenate([_noise_solve(Psi1, W1, noise[0]),
+                        _noise_solve(Psi2, W2, noise[1])], axis=-2)
+    I_G = np.eye(k) + _t(W) @ A
+    logdet = (_noise_logdet(Psi1, noise[0]) + _noise_logdet(Psi2, noise[1])
+              + np.linalg.slogdet(I_G)[1])
+    trace = - np.trace(solve(I_G, _t(A) @ mom.dot(A)), axis1=-2, axis2=-1)
+    for view, Psi, mode in ((1, Psi1, noise[0]), (2, Psi2, noise[1])):
+        if mode == 'full':
+            trace = trace + np.trace(solve(Psi, mom.block(view)), axis1=-2, axis2=-1)
+        else:
+            trace = trace + np.sum(mom.diag(view) / Psi, axis=-1)
+    return -0.5 * n * (p * np.log(2 * np.pi) + logdet + trace)
+
+
+def _run_em(mom, W, Psi1, Psi2, reg, n_iters, n, noise=('full', 'full')):
+    """Run n_iters batched EM steps; returns the final state and its
+    log-likelihood per batch entry."""
+    for _ in range(n_iters):
+        with instrument.timer('em_iter'):
+            W, Psi1, Psi2 = _em_update(mom, W, Psi1, Psi2, reg, noise)
+    instrument.count('em_iterations', n_iters)
+    return W, Psi1, Psi2, _log_likelihood(mom, W, Psi1, Psi2, n, noise)
+
+
+def _canonical_correlations(W, Psi1, Psi2, noise=('full', 'full')):
+    """Canonical correlations of the model, batched over leading axes.
+
+    With M_i = (I + W_i^T Psi_i^-1 W_i)^-1 we have
+    W_i^T (W_i W_i^T + Psi_i)^-1 W_i = I - M_i, so the squared canonical
+    correlations are the eigenvalues of the k x k product (I - M1)(I - M2).
+    """
+    p1 = Psi1.shape[-1]
+    I = np.eye(W.shape[-1])
+    W1, W2 = W[..., :p1, :], W[..., p1:, :]
+    G1 = I - inv(I + _t(W1) @ _noise_solve(Psi1, W1, noise[0]))
+    G2 = I - inv(I + _t(W2) @ _noise_solve(Psi2, W2, noise[1]))
+    rho2 = np.linalg.eigvals(G1 @ G2).real
+    return np.sqrt(np.clip(-np.sort(-rho2, axis=-1), 0, 1))
+
+
+_PCA_STATE = ('mean_', 'components_', 'singular_values_', 'explained_variance_',
+              'explained_variance_ratio_')
+
+
+class ReducedRankPCCA(PCCA):
+
+    def __init__(self, n_components, n_iters, regularization=1.0,
+                 pca_components=0.95, max_pca_components=200,
+                 pca_method='randomized', **kwargs):
+        """Initialize PCA-then-PCCA estimator.
+
+        Takes the raw flattened region matrices, computes a thin SVD per view
+        (see reduction.AdaptivePCA) and runs the PCCA EM in those PCA
+        coordinates. W and Psi live in the reduced basis; loadings in
+        neuron x time space are only built by `loadings()` on demand.
+        """
+        super().__init__(n_components, n_iters, regularization, **kwargs)
+        self.pca_components = pca_components
+        self.max_pca_components = max_pca_components
+        self.pca_method = pca_method
+
+    def fit(self, X1, X2):
+        """Fit per-view thin SVDs, then PCCA via EM in the reduced basis.
+        """
+        self.pca1 = AdaptivePCA(self.pca_components, method=self.pca_method,
+                                max_components=self.max_pca_components)
+        self.pca2 = AdaptivePCA(self.pca_components, method=self.pca_method,
+                                max_components=self.max_pca_components)
+        Y1 = self.pca1.fit_transform(X1)
+        Y2 = self.pca2.fit_transform(X2)
+        self._init_params(Y1, Y2)
+
+        # In PCA coordinates the within-view blocks of S are diagonal (the
+        # PCA variances), so only the cross-view block needs a product.
+        n = self.n
+        S12 = Y1.T @ Y2 / n
+        self.S = np.block([[np.diag(self.pca1.singular_values_ ** 2 / n), S12],
+                           [S12.T, np.diag(self.pca2.singular_values_ ** 2 / n)]])
+        self.moments = _Moments(self.p1, S=self.S)
+
+        self._fit_em()
+
+    def partial_fit(self, X1, X2, n_iters=5):
+        """Add raw trials, see PCCA.partial_fit.
+
+        The new trials are projected onto the existing PCA bases (means and
+        components stay fixed), so the update never revisits old trials.
+        """
+        if not hasattr(self, 'pca1'):
+            return self.fit(X1, X2)
+        super().partial_fit(self.pca1.transform(X1), self.pca2.transform(X2), n_iters)
+
+    def transform(self, X1, X2):
+        """Embed raw (unreduced) data using the fitted model.
+        """
+        return super().transform(self.pca1.transform(X1), self.pca2.transform(X2))
+
+    def predict_view(self, X, source=1):
+        """E[X2 | X1] (or E[X1 | X2]) in the original feature space.
+        """
+        pca_s, pca_t = (self.pca1, self.pca2) if source == 1 else (self.pca2, self.pca1)
+        Y = super().predict_view(pca_s.transform(X), source)
+        return pca_t.inverse_transform(Y)
+
+    def predict_latent(self, X, source=1):
+        pca = self.pca1 if source == 1 else self.pca2
+        return super().predict_latent(pca.transform(X), source)
+
+    def loadings(self, view=None):
+        """Map W back to the original feature space.
+
+        view=None returns the stacked (p1_raw + p2_raw, k) loadings, view=1
+        or view=2 returns that view's block. Reshape with the tensor's
+        (n_time_bins, n_clusters) to get neuron x time loadings.
+        """
+        W1 = self.pca1.components_.T @ self.W[:self.p1]
+        W2 = self.pca2.components_.T @ self.W[self.p1:]
+        if view == 1:
+            return W1
+        if view == 2:
+            return W2
+        return np.vstack([W1, W2])
+
+    def get_params(self):
+        params = super().get_params()
+        params.update(pca_components=self.pca_components,
+                      max_pca_components=self.max_pca_components,
+                      pca_method=self.pca_method)
+        return params
+
+    def _state(self):
+        state = super()._state()
+        for i, pca in ((1, self.pca1), (2, self.pca2)):
+            for attr in _PCA_STATE:
+                state[f'pca{i}_{attr}'] = getattr(pca, attr)
+        return state
+
+    def _set_state(self, state):
+        super()._set_state(state)
+        for i in (1, 2):
+            pca = AdaptivePCA(self.pca_components, method=self.pca_method,
+                              max_components=self.max_pca_components)
+            for attr in _PCA_STATE:
+                setattr(pca, attr, state[f'pca{i}_{attr}'])
+            pca.n_components_ = len(pca.components_)
+            setattr(self, f'pca{i}', pca)
+
+    def noise_covariance(self, view):
+        """Per-view noise covariance mapped back to the original features.
+        """
+        pca, Psi = (self.pca1, self.Psi1) if view == 1 else (self.pca2, self.Psi2)
+        Psi = _noise_dense(Psi, self.noise[view - 1])
+        return pca.components_.T @ Psi @ pca.components_
+
+
+# -----------------------------------------------------------------------------
+
+class TimeResolvedPCCA:
+
+    def __init__(self, n_components, n_iters, window=1, step=1, regularization=1.0):
+        """Initialize time-resolved PCCA.
+
+        Fits one PCCA per sliding window of `window` time bins (advanced by
+        `step` bins) over the (trials x time x neurons) tensors from
+        prepare_pcca_matrices. All windows are stepped together as one
+        batched EM on stacked per-window second-moment matrices.
+        """
+        self.k = n_components
+        self.n_iters = n_iters
+        self.window = window
+        self.step = step
+        self.reg = regularization
+
+    def fit(self, X1, X2, bin_times=None):
+        """Fit all windows.
+
+        X1, X2 : (n_trials, n_time_bins, n_neurons_i) arrays.
+        bin_times : optional (n_time_bins,) bin centers; `times_` is then the
+            center time of each window, otherwise its center bin index.
+
+        Windows are warm-started from their neighbours: a fit on the
+        window-averaged statistics initializes the even windows, whose fits
+        in turn initialize the odd window to their right. Each half is one
+        batched EM.
+        """
+        n_bins = X1.shape[1]
+        if self.window < 1 or self.step < 1:
+            raise ValueError(f"window and step must be >= 1, got window={self.window}, "
+                             f"step={self.step}")
+        if self.window > n_bins:
+            raise ValueError(f"window={self.window} is longer than the {n_bins} time bins")
+        Xw1 = self._windows(X1)
+        Xw2 = self._windows(X2)
+        self.n = X1.shape[0]
+        self.n_neurons1, self.n_neurons2 = X1.shape[2], X2.shape[2]
+        self.p1, self.p2 = Xw1.shape[-1], Xw2.shape[-1]
+        p1, p = self.p1, self.p1 + self.p2
+
+        # Stacked per-window second moments, shape (n_windows, p, p)
+        Xw = np.concatenate([Xw1, Xw2], axis=-1)
+        Xw -= Xw.mean(axis=1, keepdims=True)
+        S = _t(Xw) @ Xw / self.n
+        n_windows = S.shape[0]
+
+        # Pooled fit shared by every window
+        W = np.random.random((p, self.k))
+        W, Psi1, Psi2, _ = _run_em(_Moments(p1, S=S.mean(axis=0)), W, np.eye(p1),
+                                   np.eye(p - p1), self.reg, self.n_iters, self.n)
+
+        W_all = np.empty((n_windows, p, self.k))
+        Psi1_all = np.empty((n_windows, p1, p1))
+        Psi2_all = np.empty((n_windows, p - p1, p - p1))
+        ll = np.empty(n_windows)
+
+        even = np.arange(0, n_windows, 2)
+        odd = np.arange(1, n_windows, 2)
+        init = (np.repeat(W[None], len(even), axis=0),
+                np.repeat(Psi1[None], len(even), axis=0),
+                np.repeat(Psi2[None], len(even), axis=0))
+        W_all[even], Psi1_all[even], Psi2_all[even], ll[even] = _run_em(
+            _Moments(p1, S=S[even]), *init, self.reg, self.n_iters, self.n)
+        if len(odd):
+            W_all[odd], Psi1_all[odd], Psi2_all[odd], ll[odd] = _run_em(
+                _Moments(p1, S=S[odd]), W_all[odd - 1], Psi1_all[odd - 1], Psi2_all[odd - 1],
+                self.reg, self.n_iters, self.n)
+
+        self.W = W_all
+        self.Psi1, self.Psi2 = Psi1_all, Psi2_all
+        self.log_likelihood_ = ll
+        self.canonical_correlations_ = _canonical_correlations(W_all, Psi1_all, Psi2_all)
+
+        starts = np.arange(n_windows) * self.step
+        centers = starts + (self.window - 1) / 2
+        if bin_times is None:
+            self.times_ = centers
+        else:
+            self.times_ = np.interp(centers, np.arange(len(bin_times)), bin_times)
+        return self
+
+    def loadings(self, view):
+        """Loadings over time, shape (n_windows, window, n_neurons, k).
+        """
+        if view == 1:
+            W, n_neurons = self.W[:, :self.p1], self.n_neurons1
+        else:
+            W, n_neurons = self.W[:, self.p1:], self.n_neurons2
+        return W.reshape(W.shape[0], self.window, n_neurons, self.k)
+
+    def _windows(self, X):
+        """(n_trials, n_bins, n_neurons) -> (n_windows, n_trials, window*n_neurons)
+        """
+        n_trials, n_bins, n_neurons = X.shape
+        starts = np.arange(0, n_bins - self.window + 1, self.step)
+        idx = starts[:, None] + np.arange(self.window)
+        # X[:, idx] is (n_trials, n_windows, window, n_neurons)
+        Xw = X[:, idx].transpose(1, 0, 2, 3)
+        return Xw.reshape(len(starts), n_trials, self.window * n_neurons).astype(float)
+
+
+_MODEL_CLASSES = {cls.__name__: cls for cls in (PCCA, ReducedRankPCCA)}
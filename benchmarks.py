@@ -0,0 +1,309 @@
+"""============================================================================
+Offline benchmarks for the pipeline's hot paths.
+
+    python benchmarks.py                       # full scaling grids
+    python benchmarks.py --quick               # small grids, seconds
+    python benchmarks.py --only pcca_fit binning
+    python benchmarks.py --baseline results/benchmarks_old.csv
+
+Every case runs on synthetic data (synthetic.py), is timed as the best of
+--repeat runs and then run once more under tracemalloc for its peak memory.
+Results are written to results/benchmarks.csv. With --baseline, cases slower
+than the baseline by more than --tolerance are listed and the exit status is
+non-zero. The PCCA cases also report how well the planted latents are
+recovered (R^2 per latent, averaged).
+============================================================================"""
+
+import argparse
+import csv
+import itertools
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from synthetic import make_session, make_pcca_data, latent_recovery
+
+
+# -----------------------------------------------------------------------------
+# Cases. Each takes one grid point and returns (run, metrics): `run` is the
+# timed zero-argument call, `metrics(result)` adds columns (or is None).
+
+def bench_binning(n_trials, n_clusters):
+    """bin_spikes2D of every cluster around stimOn, as in the sensitivity scan."""
+    from brainbox.singlecell import bin_spikes2D
+
+    session, _ = _session(n_trials, n_clusters)
+    spikes = session.spikes
+    cluster_ids = np.unique(spikes['clusters'])
+    events = session.trials['stimOn_times'].to_numpy()
+
+    def run():
+        return bin_spikes2D(spikes['times'], spikes['clusters'], cluster_ids,
+                            events, pre_time=0.5, post_time=1.0, bin_size=0.05)
+    return run, None
+
+
+def bench_sensitivity(n_trials, n_clusters, n_shuffles=200):
+    """find_sensitive_clusters on one event.
+
+    post_time spans the planted response, so side-tuned clusters have the
+    more than 10 significant bins the selection rule asks for.
+    """
+    from preprocessing import find_sensitive_clusters
+
+    session, _ = _session(n_trials, n_clusters)
+
+    def run():
+        return find_sensitive_clusters(session.pid, session.trials['stimOn_times'],
+                                       session, post_time=1.0, bin_size=0.05,
+                                       n_shuffles=n_shuffles, session=session)
+
+    def metrics(result):
+        n_significant = len(result[0])
+        if n_significant == 0:
+            print(f"Warning: sensitivity benchmark (n_trials={n_trials}, "
+                  f"n_clusters={n_clusters}) selected no clusters")
+        return {'n_significant': n_significant}
+    return run, metrics
+
+
+def bench_extract(n_trials, n_clusters):
+    """Per-cluster bin_spikes of both regions (extract_spikes_for_pcca_by_region)."""
+    from preprocessing import extract_spikes_for_pcca_by_region
+
+    session, _ = _session(n_trials, n_clusters)
+    sig_scdg, sig_sciw = _good_clusters(session)
+
+    def run():
+        return extract_spikes_for_pcca_by_region(session.pid, sig_scdg, sig_sciw,
+                                                 'stimOn', None, None, session=session)
+    return run, None
+
+
+def bench_prepare(n_trials, n_clusters):
+    """prepare_pcca_matrices on already binned region data."""
+    from preprocessing import extract_spikes_for_pcca_by_region, prepare_pcca_matrices
+
+    session, _ = _session(n_trials, n_clusters)
+    sig_scdg, sig_sciw = _good_clusters(session)
+    region_data = extract_spikes_for_pcca_by_region(session.pid, sig_scdg, sig_sciw,
+                                                    'stimOn', None, None,
+                                                    session=session)
+
+    def run():
+        return prepare_pcca_matrices(region_data, condition='left-right')
+    return run, None
+
+
+def bench_pcca_fit(n, p, k, n_iters=200):
+    """PCCA.fit on data drawn from the PCCA model."""
+    from PCCA import PCCA
+
+    X1, X2, Z, _ = make_pcca_data(n, p // 2, p - p // 2, k, random_state=0)
+
+    def run():
+        np.random.seed(0)  # PCCA initializes W from the global RNG
+        model = PCCA(k, n_iters, regularization=1e-3)
+        model.fit(X1, X2)
+        return model
+
+    def metrics(model):
+        return {'recovery_r2': latent_recovery(Z, model.transform(X1, X2)).mean()}
+    return run, metrics
+
+
+def bench_pcca_transform(n, p, k):
+    from PCCA import PCCA
+
+    X1, X2, _, _ = make_pcca_data(n, p // 2, p - p // 2, k, random_state=0)
+    model = PCCA(k, 20, regularization=1e-3)
+    model.fit(X1, X2)
+    return lambda: model.transform(X1, X2), None
+
+
+def bench_pcca_sample(n, p, k):
+    from PCCA import PCCA
+
+    X1, X2, _, _ = make_pcca_data(n, p // 2, p - p // 2, k, random_state=0)
+    model = PCCA(k, 20, regularization=1e-3)
+    model.fit(X1, X2)
+    return model.sample, None
+
+
+def bench_session_pcca(n_trials, n_clusters, n_latents=2):
+    """Bin -> tensors -> PCCA on spike counts in the response window; checks
+    that the planted latents (and trial side) are recovered."""
+    from preprocessing import extract_spikes_for_pcca_by_region, prepare_pcca_matrices
+    from PCCA import PCCA
+
+    session, truth = _session(n_trials, n_clusters, n_latents=n_latents)
+    sig_scdg, sig_sciw = _good_clusters(session)
+
+    def run():
+        region_data = extract_spikes_for_pcca_by_region(
+            session.pid, sig_scdg, sig_sciw, 'stimOn', None, None, session=session)
+        X1, X2, trial_idx, _, _ = prepare_pcca_matrices(region_data)
+        # bins 10:30 are [0, 1) s after stimOn (pre_time=0.5, bin_size=0.05),
+        # the response window of make_session
+        Y1 = X1[:, 10:30].sum(axis=1)
+        Y2 = X2[:, 10:30].sum(axis=1)
+        Y1, Y2 = Y1 - Y1.mean(axis=0), Y2 - Y2.mean(axis=0)
+        np.random.seed(0)
+        model = PCCA(n_latents + 1, 500, regularization=1e-2, n_init=4)
+        model.fit(Y1, Y2)
+        return model.transform(Y1, Y2), trial_idx
+
+    def metrics(result):
+        Z_hat, trial_idx = result
+        Z = np.column_stack([truth['latents'], truth['side']])[trial_idx]
+        return {'recovery_r2': latent_recovery(Z, Z_hat).mean()}
+    return run, metrics
+
+
+BENCHMARKS = {
+    'binning': bench_binning,
+    'sensitivity': bench_sensitivity,
+    'extract': bench_extract,
+    'prepare': bench_prepare,
+    'pcca_fit': bench_pcca_fit,
+    'pcca_transform': bench_pcca_transform,
+    'pcca_sample': bench_pcca_sample,
+    'session_pcca': bench_session_pcca,
+}
+
+GRIDS = {
+    'binning': {'n_trials': [200, 400, 800], 'n_clusters': [20, 60, 180]},
+    'sensitivity': {'n_trials': [200, 400, 800], 'n_clusters': [20, 60]},
+    'extract': {'n_trials': [200, 400, 800], 'n_clusters': [20, 60, 180]},
+    'prepare': {'n_trials': [200, 400, 800], 'n_clusters': [20, 60, 180]},
+    'pcca_fit': {'n': [250, 500, 1000], 'p': [50, 200, 400], 'k': [2, 5]},
+    'pcca_transform': {'n': [250, 1000], 'p': [50, 400], 'k': [2, 5]},
+    'pcca_sample': {'n': [250, 1000], 'p': [50, 200], 'k': [2]},
+    'session_pcca': {'n_trials': [400, 800], 'n_clusters': [60]},
+}
+
+QUICK_GRIDS = {
+    'binning': {'n_trials': [200], 'n_clusters': [20, 60]},
+    'sensitivity': {'n_trials': [200], 'n_clusters': [20]},
+    'extract': {'n_trials': [200], 'n_clusters': [20, 60]},
+    'prepare': {'n_trials': [200], 'n_clusters': [20, 60]},
+    'pcca_fit': {'n': [250], 'p': [50, 200], 'k': [2]},
+    'pcca_transform': {'n': [250], 'p': [50], 'k': [2]},
+    'pcca_sample': {'n': [250], 'p': [50], 'k': [2]},
+    'session_pcca': {'n_trials': [400], 'n_clusters': [60]},
+}
+
+
+# -----------------------------------------------------------------------------
+
+def measure(run, repeat=3):
+    """Best wall time over `repeat` runs, then peak traced memory (MiB)."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), peak / 2 ** 20, result
+
+
+def run_benchmarks(names, grids, repeat=3):
+    rows = []
+    for name in names:
+        grid = grids[name]
+        for values in itertools.product(*grid.values()):
+            params = dict(zip(grid, values))
+            run, metrics = BENCHMARKS[name](**params)
+            seconds, peak_mb, result = measure(run, repeat)
+            row = {'benchmark': name, 'params': _format_params(params),
+                   'seconds': seconds, 'peak_mb': peak_mb}
+            if metrics is not None:
+                row.update(metrics(result))
+            rows.append(row)
+            print(f"{name:16s} {row['params']:32s} {seconds:9.4f} s "
+                  f"{peak_mb:9.1f} MiB" + ''.join(
+                      f"  {key}={row[key]:.3f}" for key in row
+                      if key not in ('benchmark', 'params', 'seconds', 'peak_mb')))
+    return rows
+
+
+def write_rows(rows, path):
+    fields = ['benchmark', 'params', 'seconds', 'peak_mb']
+    fields += sorted({key for row in rows for key in row} - set(fields))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def compare(rows, baseline_path, tolerance):
+    """Return the rows slower than the baseline by more than `tolerance`."""
+    with open(baseline_path, newline='') as f:
+        baseline = {(row['benchmark'], row['params']): float(row['seconds'])
+                    for row in csv.DictReader(f)}
+    regressions = []
+    for row in rows:
+        before = baseline.get((row['benchmark'], row['params']))
+        if before is not None and row['seconds'] > before * (1 + tolerance):
+            regressions.append((row, before))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip('='),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        default=list(BENCHMARKS))
+    parser.add_argument('--quick', action='store_true', help="small grids")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', default=os.path.join('results', 'benchmarks.csv'))
+    parser.add_argument('--baseline', help="CSV from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="allowed relative slowdown before flagging")
+    args = parser.parse_args(argv)
+
+    rows = run_benchmarks(args.only, QUICK_GRIDS if args.quick else GRIDS,
+                          args.repeat)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    write_rows(rows, args.output)
+    print(f"Wrote {args.output}")
+
+    if args.baseline:
+        regressions = compare(rows, args.baseline, args.tolerance)
+        for row, before in regressions:
+            print(f"REGRESSION {row['benchmark']} {row['params']}: "
+                  f"{before:.4f} s -> {row['seconds']:.4f} s")
+        return 1 if regressions else 0
+    return 0
+
+
+# -----------------------------------------------------------------------------
+
+def _session(n_trials, n_clusters, **kwargs):
+    return make_session(n_trials, (n_clusters // 2, n_clusters - n_clusters // 2),
+                        random_state=0, **kwargs)
+
+
+def _good_clusters(session):
+    """Sensitivity-style dicts listing every good cluster of each region."""
+    clusters = session.clusters
+    good = clusters['label'] >= 0.5
+    return tuple({'pid': session.pid,
+                  'stimOn': list(clusters['cluster_id'][good & (clusters['acronym'] == region)])}
+                 for region in ('SCdg', 'SCiw'))
+
+
+def _format_params(params):
+    return ' '.join(f"{key}={val}" for key, val in params.items())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,353 @@
+"""============================================================================
+Stage-level memoization for the analysis pipeline.
+
+Each stage of run.py (load -> sensitivity -> extract -> PCA -> PCCA sweep ->
+plots) is executed through a StageCache. The cache key of a stage is a hash of
+its name, its code, its parameters and the keys of the stages it depends on,
+so changing anything upstream invalidates everything downstream while
+untouched stages are read back from disk. Identical calls inside one run are
+served from memory. Processes sharing a cache directory (sweep jobs) take a
+lock file per stage key, so a stage they have in common is computed by one
+of them while the others wait and read it back.
+
+A stage's code is the bytecode of its function and of the functions of the
+same module it calls by name (e.g. stage_pcca_sweep -> pcca_rmse), plus the
+source of every repo-local module those functions use (PCCA.py,
+preprocessing.py, ...) and of the repo-local modules these import in turn.
+Editing any of them recomputes the stages that depend on it.
+============================================================================"""
+
+import ast
+import dis
+import hashlib
+import os
+import pickle
+import time
+import types
+
+import numpy as np
+
+import instrument
+
+
+# -----------------------------------------------------------------------------
+
+def hash_inputs(*args, **kwargs):
+    """Return a stable hex digest for (nested) stage inputs.
+
+    Supports numpy arrays, pandas objects, dicts, lists/tuples/sets, scalars,
+    strings and None. Anything else is hashed via its pickle.
+    """
+    h = hashlib.sha1()
+    _update_hash(h, args)
+    _update_hash(h, kwargs)
+    return h.hexdigest()
+
+
+def _update_hash(h, obj):
+    if isinstance(obj, StageKey):
+        h.update(b'key:' + obj.digest.encode())
+    elif isinstance(obj, np.ndarray):
+        arr = np.ascontiguousarray(obj)
+        h.update(f'nd:{arr.dtype.str}:{arr.shape}:'.encode())
+        if arr.dtype == object:
+            _update_hash(h, arr.tolist())
+        else:
+            h.update(arr.tobytes())
+    elif isinstance(obj, dict):
+        h.update(b'dict:')
+        for key in sorted(obj, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(f'{type(obj).__name__}:{len(obj)}:'.encode())
+        for item in obj:
+            _update_hash(h, item)
+    elif isinstance(obj, (set, frozenset)):
+        h.update(b'set:')
+        for item in sorted(obj, key=repr):
+            _update_hash(h, item)
+    elif isinstance(obj, (str, bytes, int, float, bool, np.generic)) or obj is None:
+        h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+    elif hasattr(obj, 'to_numpy') and hasattr(obj, 'columns'):
+        # pandas DataFrame (e.g. sl.trials)
+        _update_hash(h, list(obj.columns))
+        for col in obj.columns:
+            _update_hash(h, obj[col].to_numpy())
+    elif hasattr(obj, 'to_numpy'):
+        _update_hash(h, obj.to_numpy())
+    else:
+        h.update(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def code_digest(func):
+    """Hex digest of `func`'s code, of the same-module functions it calls
+    and of the source of the repo-local modules they use.
+    """
+    h = hashlib.sha1()
+    seen = set()
+    modules = set()
+
+    def visit(f):
+        if f in seen:
+            return
+        seen.add(f)
+        _update_code(h, f.__code__)
+        modules.update(_code_imports(f.__code__))
+        # sorted: set order follows the per-process string hash seed
+        for name in sorted(_code_names(f.__code__)):
+            g = f.__globals__.get(name)
+            g = getattr(g, '__wrapped__', g)    # lru_cache, instrument.timed
+            if isinstance(g, types.FunctionType) and g.__module__ == f.__module__:
+                visit(g)
+            elif isinstance(g, types.ModuleType):
+                modules.add(g.__name__)
+            elif isinstance(g, (types.FunctionType, type)) and g.__module__ != f.__module__:
+                modules.add(g.__module__)
+
+    visit(getattr(func, '__wrapped__', func))
+    h.update(source_digest(*modules).encode())
+    return h.hexdigest()
+
+
+def source_digest(*modules):
+    """Hex digest of the source of the repo-local `modules` and of every
+    repo-local module they import, directly or not. Other names are ignored.
+    """
+    h = hashlib.sha1()
+    for name in sorted(_local_closure(modules)):
+        h.update(f'{name}:{_file_digest(_local_path(name))};'.encode())
+    return h.hexdigest()
+
+
+_REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+_file_digests = {}
+
+
+def _local_path(module):
+    path = os.path.join(_REPO_DIR, f"{module.split('.')[0]}.py")
+    return path if os.path.isfile(path) else None
+
+
+def _local_closure(modules):
+    seen = set()
+    stack = [m.split('.')[0] for m in modules]
+    while stack:
+        name = stack.pop()
+        if name in seen or _local_path(name) is None:
+            continue
+        seen.add(name)
+        stack.extend(_file_digest(_local_path(name), imports=True))
+    return seen
+
+
+def _file_digest(path, imports=False):
+    """sha1 of a source file, or the top-level names of the modules it
+    imports; both cached until the file changes."""
+    stamp = os.stat(path).st_mtime_ns
+    cached = _file_digests.get(path)
+    if cached is None or cached[0] != stamp:
+        with open(path, 'rb') as f:
+            source = f.read()
+        names = set()
+        for node in ast.walk(ast.parse(source)):
+            if isinstance(node, ast.Import):
+                names.update(alias.name.split('.')[0] for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.level == 0:
+                names.add(node.module.split('.')[0])
+        cached = (stamp, hashlib.sha1(source).hexdigest(), names)
+        _file_digests[path] = cached
+    return cached[2] if imports else cached[1]
+
+
+def _update_code(h, code):
+    h.update(code.co_code)
+    h.update(repr(code.co_names).encode())
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            _update_code(h, const)
+        elif isinstance(const, frozenset):
+            # `x in {...}` literals; their repr order depends on the hash seed
+            h.update(f'frozenset:{sorted(map(repr, const))}'.encode())
+        else:
+            h.update(repr(const).encode())
+
+
+def _code_imports(code):
+    """Modules imported inside `code` (function-level imports)."""
+    names = {ins.argval for ins in dis.get_instructions(code)
+             if ins.opname == 'IMPORT_NAME'}
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_imports(const)
+    return names
+
+
+def _code_names(code):
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _code_names(const)
+    return names
+
+
+class StageKey:
+    """Handle to a stage result; hashing it uses the digest, not the value."""
+
+    def __init__(self, name, digest, value):
+        self.name = name
+        self.digest = digest
+        self.value = value
+
+    def __repr__(self):
+        return f"StageKey({self.name!r}, {self.digest[:12]})"
+
+
+# -----------------------------------------------------------------------------
+
+LOCK_POLL = 0.5    # seconds between checks while another process computes a stage
+
+
+class StageCache:
+
+    def __init__(self, cache_dir='cache', enabled=True, verbose=True, compute=True):
+        """Initialize a cache backed by pickles in `cache_dir`.
+
+        When `enabled` is False nothing is read from or written to disk, but
+        identical calls within one run are still deduplicated in memory.
+        With `compute` False a stage that is not cached raises LookupError
+        instead of running, e.g. to re-plot offline from earlier results.
+        """
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.compute = compute
+        self.verbose = verbose
+        self._memory = {}
+        self.hits = 0
+        self.misses = 0
+        if self.enabled:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, name, func, *args, **kwargs):
+        """Cache key of stage `name` running `func` on the given inputs.
+        """
+        return hash_inputs(name, code_digest(func), args, kwargs)
+
+    def path(self, name, digest):
+        return os.path.join(self.cache_dir, f"{name}-{digest[:16]}.pkl")
+
+    def run(self, name, func, *args, **kwargs):
+        """Run `func(*args, **kwargs)` as stage `name`, or reuse its result.
+
+        StageKey arguments are unwrapped to their values before calling
+        `func`, but only their digest enters the cache key. Returns a
+        StageKey so the result can be chained into downstream stages.
+        """
+        with instrument.timer(f'stage:{name}'):
+            digest = self.key(name, func, *args, **kwargs)
+            return self._run(name, digest, func, args, kwargs)
+
+    def _run(self, name, digest, func, args, kwargs):
+        if digest in self._memory:
+            self.hits += 1
+            return self._memory[digest]
+
+        path = self.path(name, digest)
+        if not self.enabled:
+            value = self._compute(name, func, args, kwargs)
+        else:
+            # Processes sharing cache_dir (sweep jobs) compute a stage once:
+            # the first takes path.lock, the others wait for its pickle.
+            waiting = False
+            while True:
+                if os.path.exists(path):
+                    value = self._load(name, path)
+                    break
+                if not self.compute:
+                    raise LookupError(f"Stage {name!r} is not cached "
+                                      f"({os.path.basename(path)})")
+                if _try_lock(f'{path}.lock'):
+                    try:
+                        if os.path.exists(path):
+                            value = self._load(name, path)
+                        else:
+                            value = self._compute(name, func, args, kwargs)
+                            self._write(path, value)
+                    finally:
+                        os.remove(f'{path}.lock')
+                    break
+                if not waiting:
+                    self._log(f"[cache] {name}: waiting for another process")
+                    waiting = True
+                time.sleep(LOCK_POLL)
+
+        result = StageKey(name, digest, value)
+        self._memory[digest] = result
+        return result
+
+    def _load(self, name, path):
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+        self.hits += 1
+        self._log(f"[cache] {name}: loaded {os.path.basename(path)}")
+        return value
+
+    def _compute(self, name, func, args, kwargs):
+        call_args = [_unwrap(a) for a in args]
+        call_kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+        value = func(*call_args, **call_kwargs)
+        self.misses += 1
+        self._log(f"[cache] {name}: computed")
+        return value
+
+    def _write(self, path, value):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def invalidate(self, name=None):
+        """Drop cached results of stage `name` (or of every stage).
+        """
+        self._memory = {d: k for d, k in self._memory.items()
+                        if name is not None and k.name != name}
+        if not self.enabled:
+            return
+        prefix = f"{name}-" if name is not None else ''
+        for fname in os.listdir(self.cache_dir):
+            if fname.startswith(prefix) and fname.endswith('.pkl'):
+                os.remove(os.path.join(self.cache_dir, fname))
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
+
+
+def _unwrap(obj):
+    return obj.value if isinstance(obj, StageKey) else obj
+
+
+def _try_lock(lock_path):
+    """Create `lock_path` holding our pid; False if another process holds it.
+
+    A lock whose process has died (e.g. a killed sweep) is removed, so the
+    next attempt can take it. Pids are only checked on this machine.
+    """
+    try:
+        fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        try:
+            with open(lock_path) as f:
+                pid = int(f.read())
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+        except (OSError, ValueError):
+            pass  # just created, pid not written yet, or not ours to signal
+        return False
+    with os.fdopen(fd, 'w') as f:
+        f.write(str(os.getpid()))
+    return True
@@ -0,0 +1,211 @@
+"""============================================================================
+Command-line entry point.
+
+    python cli.py run [--config c.toml] [--no-cache] [--no-raster]
+    python cli.py sweep [c.toml] [--pid ...] [--event ...] [--jobs N]
+    python cli.py plot [--config c.toml] [--raster] # re-plot from cache/, offline
+    python cli.py pcca X1.npy X2.npy -k 3           # PCCA on saved matrices
+    python cli.py bench [--quick ...]               # benchmarks.py
+
+Only argparse is imported up front; each subcommand imports what it needs,
+so e.g. `pcca` never loads ONE, brainbox, the atlas or matplotlib.
+--instrument (or PIPELINE_INSTRUMENT=1) records timings to results/.
+============================================================================"""
+
+import argparse
+import sys
+
+
+# -----------------------------------------------------------------------------
+
+def cmd_run(args):
+    import run
+    from cache import StageCache
+
+    params = {}
+    if args.config:
+        from sweep import load_config
+        params, grid = load_config(args.config)
+        if grid:
+            print(f"{args.config} defines a sweep; use `python cli.py sweep`.")
+            return 1
+    run.main(StageCache(cache_dir=args.cache_dir, enabled=not args.no_cache),
+             raster=not args.no_raster, params=params)
+
+
+def cmd_sweep(args):
+    from sweep import load_config, expand_jobs, job_id, run_sweep
+
+    params, grid = load_config(args.config) if args.config else ({}, {})
+    # lists given on the command line replace those of the config file
+    for key in ('pid', 'event', 'bin_size'):
+        if getattr(args, key):
+            grid[key] = getattr(args, key)
+    if args.regions:
+        grid['regions'] = [pair.split(':') for pair in args.regions]
+
+    jobs = expand_jobs(params, grid)
+    if args.dry_run:
+        for job in jobs:
+            print(job_id(job), {key: job[key] for key in grid})
+        return
+    rows = run_sweep(jobs, n_jobs=args.jobs, out_root=args.out,
+                     cache_dir=args.cache_dir, raster=args.raster,
+                     prefetch=args.prefetch)
+    return 1 if any(row['status'] != 'ok' for row in rows) else 0
+
+
+def cmd_plot(args):
+    import os
+    import run
+    from cache import StageCache
+
+    params, grid = ({}, {})
+    if args.config:
+        from sweep import load_config
+        params, grid = load_config(args.config)
+    if grid:
+        # a sweep config re-plots every job into OUT/<job id>/, as the sweep did
+        from sweep import expand_jobs, job_id
+        targets = [(job, os.path.join(args.out, job_id(job)))
+                   for job in expand_jobs(params, grid)]
+    else:
+        targets = [(run.resolve_params(params), args.out)]
+
+    cache = StageCache(cache_dir=args.cache_dir, compute=False)
+    for params, out_dir in targets:
+        try:
+            results = run.compute(cache, params)
+        except LookupError as e:
+            command = 'sweep' if grid else 'run'
+            print(f"{e}; run `python cli.py {command}` with this config first.")
+            return 1
+        run.plot_results(results, raster=args.raster, out_dir=out_dir)
+
+
+def cmd_pcca(args):
+    import numpy as np
+    from PCCA import PCCA
+
+    X1, X2 = (_load_matrix(path) for path in (args.X1, args.X2))
+    model = PCCA(args.k, args.n_iters, regularization=args.regularization,
+                 n_init=args.n_init, n_jobs=args.n_jobs, noise=args.noise)
+    if args.registry:
+        from registry import ModelRegistry
+        model = ModelRegistry(args.registry).fit(model, X1, X2)
+    else:
+        model.fit(X1, X2)
+
+    np.set_printoptions(precision=4, suppress=True)
+    print(f"X1 {X1.shape}, X2 {X2.shape}, k={args.k}, noise={args.noise}")
+    print(f"log-likelihood:         {model.log_likelihood_:.4f}")
+    print(f"canonical correlations: {model.canonical_correlations()}")
+    print("cross-view RMSE:        %.4f, %.4f" % model.prediction_error(X1, X2))
+    if args.save:
+        model.save(args.save)
+        print(f"saved {args.save}")
+
+
+def cmd_bench(args):
+    import benchmarks
+    return benchmarks.main(args.bench_args)
+
+
+# -----------------------------------------------------------------------------
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='cli.py', description="SCdg/SCiw latent variable analysis pipeline.")
+    parser.add_argument('--instrument', action='store_true',
+                        help="record stage timings to results/instrumentation.*")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="with --instrument, also record tracemalloc peaks")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('run', help="run the full pipeline")
+    p.add_argument('--config', help="TOML/JSON file whose [params] override run.DEFAULTS")
+    p.add_argument('--cache-dir', default='cache')
+    p.add_argument('--no-cache', action='store_true', help="do not read or write cache/")
+    p.add_argument('--no-raster', action='store_true',
+                   help="skip the per-cluster raster figures")
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser('sweep', help="run the pipeline over a grid of parameters")
+    p.add_argument('config', nargs='?', help="TOML/JSON file with [params] and [sweep]")
+    p.add_argument('--pid', nargs='+', help="probe insertion IDs")
+    p.add_argument('--regions', nargs='+', metavar='A:B',
+                   help="region pairs, e.g. SCdg:SCiw SCdg:SCig")
+    p.add_argument('--event', nargs='+', help="e.g. stimOn firstMovement feedback")
+    p.add_argument('--bin-size', nargs='+', type=float, help="bin sizes (s)")
+    p.add_argument('--jobs', type=int, help="worker processes (default: one per job, "
+                                            "up to the CPU count)")
+    p.add_argument('--out', default='results', help="jobs write to OUT/<job id>/")
+    p.add_argument('--cache-dir', default='cache')
+    p.add_argument('--raster', action='store_true',
+                   help="also draw the raster figures of each job")
+    p.add_argument('--prefetch', type=int, default=2, metavar='N',
+                   help="with --jobs 1, download the next N PIDs' sessions in the "
+                        "background (0: off)")
+    p.add_argument('--dry-run', action='store_true', help="only list the jobs")
+    p.set_defaults(func=cmd_sweep)
+
+    p = sub.add_parser('plot', help="re-plot from cached stage results only")
+    p.add_argument('--config', help="TOML/JSON file as for `run` or `sweep`; a [sweep] "
+                                    "table re-plots every job")
+    p.add_argument('--out', default='results',
+                   help="figure directory (OUT/<job id>/ per sweep job)")
+    p.add_argument('--cache-dir', default='cache')
+    p.add_argument('--raster', action='store_true',
+                   help="also draw the raster figures (needs OpenAlyx)")
+    p.set_defaults(func=cmd_plot)
+
+    p = sub.add_parser('pcca', help="fit PCCA on saved .npy matrices")
+    p.add_argument('X1', help=".npy of shape (n_trials, ...) for view 1")
+    p.add_argument('X2', help=".npy of shape (n_trials, ...) for view 2")
+    p.add_argument('-k', type=int, default=2, help="latent dimensions")
+    p.add_argument('--n-iters', type=int, default=100)
+    p.add_argument('--regularization', type=float, default=1.0)
+    p.add_argument('--n-init', type=int, default=1)
+    p.add_argument('--n-jobs', type=int, default=1)
+    p.add_argument('--noise', default='full', choices=['full', 'diagonal', 'isotropic'])
+    p.add_argument('--registry', help="model registry directory to reuse fits from")
+    p.add_argument('--save', help="write the fitted model to this .npz")
+    p.set_defaults(func=cmd_pcca)
+
+    # everything after `bench` is passed on to benchmarks.py
+    p = sub.add_parser('bench', help="offline benchmarks (see benchmarks.py -h)",
+                       add_help=False)
+    p.set_defaults(func=cmd_bench)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args, extra = parser.parse_known_args(argv)
+    if args.command == 'bench':
+        args.bench_args = extra
+    elif extra:
+        parser.error(f"unrecognized arguments: {' '.join(extra)}")
+    if args.instrument:
+        import instrument
+        instrument.enable(trace_memory=args.trace_memory)
+
+    status = args.func(args)
+
+    # run.main and the sweep jobs write their own reports
+    if args.command not in ('run', 'sweep') and 'instrument' in sys.modules:
+        import instrument
+        if instrument.enabled:
+            print(f"Instrumentation report: {instrument.write_report('results')}")
+    return status or 0
+
+
+def _load_matrix(path):
+    import numpy as np
+
+    X = np.load(path)
+    return X.reshape(X.shape[0], -1)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,262 @@
+"""============================================================================
+Multiple-comparison corrections for the permutation tests.
+
+The sensitivity scan tests every time bin of every cluster. Everything here
+works on whole arrays, so all clusters are corrected in one call:
+
+    obs   (..., n_bins)               observed statistic, e.g. Right - Left
+    null  (..., n_shuffles, n_bins)   the same statistic under shuffled labels
+    p     (..., n_bins)               permutation p-values
+
+difference_null builds obs and null of the Right - Left test for all clusters
+at once, one label permutation per shuffle shared by every cluster.
+RunningDifference accumulates the same arrays over batches of new trials.
+Leading axes (usually clusters) are separate families unless `pooled=True`,
+in which case every test in the array is one family.
+
+    fdr             Benjamini-Hochberg / -Yekutieli step-up, one sort for
+                    all families. NaN p-values count as not tested.
+    max_statistic   family-wise control from the maximum over the family of
+                    each shuffle's statistic.
+    cluster_mass    family-wise control over runs of adjacent supra-threshold
+                    bins, which uses that neighbouring bins are correlated.
+
+Only max_statistic and cluster_mass control the family-wise error rate. The
+legacy 'bonferroni-fdr' rule keeps the original permutation_p_values, which
+can be 0, so it is anti-conservative once the threshold drops below
+1 / n_shuffles (e.g. pooled over many clusters). 'fdr_bh' and 'fdr_by' use
+(1 + #) / (n_shuffles + 1) p-values, which never are.
+
+max_statistic and cluster_mass only reuse the null matrix the permutation
+test already built, so no further shuffles are drawn. Both standardize each
+bin by its null standard deviation, so that bins and clusters with different
+firing rates are comparable. For pooled families, shuffle s of every cluster
+must come from the same label permutation, as in find_sensitive_clusters.
+============================================================================"""
+
+import numpy as np
+
+
+METHODS = ('bonferroni-fdr', 'fdr_bh', 'fdr_by', 'max', 'cluster')
+
+
+# -----------------------------------------------------------------------------
+
+def difference_null(raster, left, right, n_shuffles):
+    """Right - Left trial means of `raster` and their label-shuffle null.
+
+    raster : (n_trials, ..., n_bins), e.g. (n_trials, n_clusters, n_bins)
+    left, right : boolean trial masks
+
+    Each shuffle permutes the trial labels (np.random, as before) once for
+    all clusters, applying the same permutation to both masks so that a
+    shuffled trial is still either left or right, and every shuffle's means
+    come out of one matrix product.
+    NaNs are ignored like np.nanmean does. Returns obs (..., n_bins) and
+    null (..., n_shuffles, n_bins).
+    """
+    diff = RunningDifference(n_shuffles)
+    diff.update(raster, left, right)
+    return diff.obs, diff.null
+
+
+class RunningDifference:
+
+    def __init__(self, n_shuffles=500):
+        """Right - Left means and their shuffle null, accumulated by trials.
+
+        update() adds a batch of trials to running per-side sums and counts,
+        for the observed labels and for every shuffle, so its cost only
+        depends on the batch. A batch's labels are shuffled among its own
+        trials, which makes the null that of a permutation test restricted
+        to exchanges within batches. With one batch it is difference_null.
+        """
+        self.n_shuffles = n_shuffles
+        self.n_trials = 0
+        self.shape = None
+        self._sums = None
+        self._counts = None
+
+    def update(self, raster, left, right):
+        """Add trials; raster is (n_new_trials, ..., n_bins)."""
+        n_new = raster.shape[0]
+        if self.shape is None:
+            self.shape = raster.shape[1:]
+            size = (2, 1 + self.n_shuffles, int(np.prod(self.shape)))
+            self._sums, self._counts = np.zeros(size), np.zeros(size)
+        elif raster.shape[1:] != self.shape:
+            raise ValueError(f"Expected trials of shape {self.shape}, got {raster.shape[1:]}")
+
+        X = raster.reshape(n_new, -1)
+        valid = ~np.isnan(X)
+        X = np.where(valid, X, 0.0)
+
+        # masks (side, observed + shuffles, trial)
+        left = np.asarray(left, dtype=bool)
+        right = np.asarray(right, dtype=bool)
+        # one permutation of the trial labels per shuffle, shared by both sides
+        perm = np.argsort(np.random.random((self.n_shuffles, n_new)), axis=-1)
+        masks = np.empty((2, 1 + self.n_shuffles, n_new))
+        masks[0, 0], masks[1, 0] = left, right
+        masks[0, 1:], masks[1, 1:] = left[perm], right[perm]
+
+        self._sums += masks @ X
+        self._counts += masks @ valid.astype(float)
+        self.n_trials += n_new
+
+    @property
+    def obs(self):
+        """Observed Right - Left means, (..., n_bins)."""
+        return self._difference()[0].reshape(self.shape)
+
+    @property
+    def null(self):
+        """Shuffled Right - Left means, (..., n_shuffles, n_bins)."""
+        null = self._difference()[1:].reshape((self.n_shuffles,) + self.shape)
+        return np.moveaxis(null, 0, -2)
+
+    def _difference(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = self._sums / self._counts
+        return means[1] - means[0]
+
+
+def permutation_p_values(obs, null, plus_one=False):
+    """Two-sided p-values, the fraction of shuffles with |null| >= |obs|.
+
+    By default this is the original pipeline's p-value, without the +1 of
+    the (1 + #) / (n_shuffles + 1) form, so it is 0 when no shuffle reaches
+    obs. plus_one gives the (1 + #) / (n_shuffles + 1) form.
+    """
+    exceed = np.sum(np.abs(null) >= np.abs(obs)[..., None, :], axis=-2)
+    if plus_one:
+        return (1 + exceed) / (1 + null.shape[-2])
+    return exceed / null.shape[-2]
+
+
+def fdr(p_vals, alpha=0.05, method='bh', pooled=False):
+    """Benjamini-Hochberg ('bh') or Benjamini-Yekutieli ('by') FDR.
+
+    Returns (reject, p_adjusted) shaped like `p_vals`. Each row along the
+    last axis is a family unless `pooled`. NaN entries are left out of their
+    family and stay NaN.
+    """
+    p_vals = np.asarray(p_vals, dtype=float)
+    p = p_vals.reshape(1, -1) if pooled else p_vals.reshape(-1, p_vals.shape[-1])
+
+    order = np.argsort(p, axis=-1)  # NaNs sort last
+    p_sorted = np.take_along_axis(p, order, axis=-1)
+    m = np.sum(~np.isnan(p), axis=-1, keepdims=True)
+    rank = np.arange(1, p.shape[-1] + 1)
+    scaled = p_sorted * m / rank
+    if method == 'by':
+        scaled *= np.cumsum(1 / rank)[np.maximum(m - 1, 0)]
+    elif method != 'bh':
+        raise ValueError(f"Unknown FDR method: {method}")
+
+    # step-up: running minimum from the largest p-value down
+    scaled = np.where(np.isnan(scaled), np.inf, scaled)
+    adjusted = np.minimum.accumulate(scaled[:, ::-1], axis=-1)[:, ::-1]
+    adjusted = np.minimum(adjusted, 1.0)
+
+    p_adjusted = np.empty_like(p)
+    np.put_along_axis(p_adjusted, order, adjusted, axis=-1)
+    p_adjusted = np.where(np.isnan(p), np.nan, p_adjusted).reshape(p_vals.shape)
+    return p_adjusted <= alpha, p_adjusted
+
+
+def max_statistic(obs, null, alpha=0.05, pooled=False):
+    """Westfall-Young single-step max-|t| correction.
+
+    A test's adjusted p-value is the fraction of shuffles whose largest
+    standardized |statistic| over the family reaches the test's own,
+    (1 + #) / (n_shuffles + 1). Returns (reject, p_adjusted).
+    """
+    z_obs, z_null = _standardize(obs, null)
+    peak = z_null.max(axis=-1)                               # (..., n_shuffles)
+    if pooled:
+        peak = peak.reshape(-1, peak.shape[-1]).max(axis=0)  # (n_shuffles,)
+    exceed = np.sum(peak[..., :, None] >= z_obs[..., None, :], axis=-2)
+    p_adjusted = (1 + exceed) / (1 + null.shape[-2])
+    return p_adjusted < alpha, p_adjusted
+
+
+def cluster_mass(obs, null, alpha=0.05, threshold=None, pooled=False):
+    """Cluster-mass correction over runs of adjacent bins.
+
+    Bins whose standardized |statistic| exceeds `threshold` (default: the
+    two-sided 5% normal quantile, 1.96) form runs along the last axis; a
+    run's mass is the sum of its statistics. Every bin of a run gets the
+    run's p-value against the null distribution of the largest mass per
+    shuffle and family. Returns (reject, p_values).
+    """
+    if threshold is None:
+        threshold = 1.959964
+    z_obs, z_null = _standardize(obs, null)
+
+    null_mass, _ = _run_masses(z_null, threshold)
+    peak = null_mass.max(axis=-1)                            # (..., n_shuffles)
+    if pooled:
+        peak = peak.reshape(-1, peak.shape[-1]).max(axis=0)
+
+    _, bin_mass = _run_masses(z_obs, threshold)
+    exceed = np.sum(peak[..., :, None] >= bin_mass[..., None, :], axis=-2)
+    p_values = np.where(bin_mass > 0, (1 + exceed) / (1 + null.shape[-2]), 1.0)
+    return p_values < alpha, p_values
+
+
+def correct(obs, null, alpha=0.005, method='bonferroni-fdr', pooled=False):
+    """Significant bins of a permutation test by `method` (see METHODS).
+
+    'bonferroni-fdr' is the pipeline's original rule: Bonferroni over the
+    bins of a cluster, then BH on the survivors, both at `alpha`, on p-values
+    that can be 0. 'fdr_bh' and 'fdr_by' use (1 + #) / (n_shuffles + 1).
+    """
+    obs, null = np.asarray(obs, dtype=float), np.asarray(null, dtype=float)
+    if method == 'max':
+        return max_statistic(obs, null, alpha, pooled=pooled)[0]
+    if method == 'cluster':
+        return cluster_mass(obs, null, alpha, pooled=pooled)[0]
+
+    if method in ('fdr_bh', 'fdr_by'):
+        p_vals = permutation_p_values(obs, null, plus_one=True)
+        return fdr(p_vals, alpha, method[-2:], pooled=pooled)[0]
+    if method != 'bonferroni-fdr':
+        raise ValueError(f"Unknown correction: {method} (expected one of {METHODS})")
+    p_vals = permutation_p_values(obs, null)
+    n_tests = p_vals.size if pooled else p_vals.shape[-1]
+    bonf_reject = p_vals < alpha / n_tests
+    _, p_fdr = fdr(np.where(bonf_reject, p_vals, np.nan), alpha, pooled=pooled)
+    return bonf_reject & (p_fdr < alpha)
+
+
+# -----------------------------------------------------------------------------
+
+def _standardize(obs, null):
+    """|obs| and |null| in units of each bin's null standard deviation."""
+    sd = null.std(axis=-2)
+    scale = np.divide(1.0, sd, out=np.zeros_like(sd), where=sd > 0)
+    return np.abs(obs) * scale, np.abs(null) * scale[..., None, :]
+
+
+def _run_masses(z, threshold):
+    """Masses of runs of z > threshold along the last axis.
+
+    Returns (masses, bin_mass): masses (..., n_bins + 1) per run label, with
+    label 0 (below threshold) zeroed, and each bin's run mass (0 outside runs).
+    """
+    above = z > threshold
+    starts = above.copy()
+    starts[..., 1:] &= ~above[..., :-1]
+    label = np.cumsum(starts, axis=-1) * above               # 1..n_runs, 0 below
+
+    rows = z.reshape(-1, z.shape[-1])
+    label = label.reshape(rows.shape)
+    n_labels = rows.shape[-1] + 1
+    flat = label + n_labels * np.arange(len(rows))[:, None]
+    masses = np.bincount(flat.ravel(), weights=(rows * (label > 0)).ravel(),
+                         minlength=len(rows) * n_labels).reshape(len(rows), n_labels)
+    masses[:, 0] = 0
+    bin_mass = np.take_along_axis(masses, label, axis=-1)
+    return (masses.reshape(z.shape[:-1] + (n_labels,)),
+            bin_mass.reshape(z.shape))
@@ -1,14 +1,13 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from one.api import ONE
-from brainbox.io.one import SpikeSortingLoader
-from iblatlas.atlas import AllenAtlas
-from statsmodels.stats.multitest import multipletests
-from brainbox.singlecell import bin_spikes2D,bin_spikes
-from brainbox.io.one import SessionLoader, SpikeSortingLoader
 
 import os
 
+import instrument
+from correction import correct, difference_null
+
+# ONE, brainbox, iblatlas and matplotlib are imported inside the functions
+# that need them, so importing this module stays cheap.
+
 def get_diff_arrays_for_one_cluster(pid,
                                     sl,
                                     cluster_id,
@@ -17,14 +16,18 @@ def get_diff_arrays_for_one_cluster(pid,
                                     post_time=0.5,
                                     bin_size=0.05,
                                     alpha=0.005,
-                                    n_shuffles=500):
+                                    n_shuffles=500,
+                                    correction='bonferroni-fdr',
+                                    session=None):
     """
     Bins spikes around event_times for the specified cluster_id,
     computes:
       obs_diff: observed (Right - Left) difference in each time bin,
       shuffled_diff: the null distribution of differences (via label shuffling),
-      final_reject: boolean mask of significant time bins after corrections,
+      final_reject: boolean mask of significant time bins after corrections
+        (`correction`, one of correction.METHODS),
       time_bins: the bin centers from the binning.
+    A prefetched prefetch.Session for `pid` skips the downloads.
 
     Returns
     -------
@@ -37,12 +40,21 @@ def get_diff_arrays_for_one_cluster(pid,
     time_bins : 1D array
         The bin centers for plotting (same length as obs_diff).
     """
+    from brainbox.singlecell import bin_spikes2D
+
     # --- Load the data ---
-    one = ONE()
-    ba = AllenAtlas()
-    ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = ssl.load_spike_sorting()
-    clusters = ssl.merge_clusters(spikes, clusters, channels)
+    if session is None:
+        with instrument.timer('load'):
+            from one.api import ONE
+            from iblatlas.atlas import AllenAtlas
+            from brainbox.io.one import SpikeSortingLoader
+            one = ONE()
+            ba = AllenAtlas()
+            ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = ssl.load_spike_sorting()
+            clusters = ssl.merge_clusters(spikes, clusters, channels)
+    else:
+        spikes, clusters = session.spikes, session.clusters
 
     # --- Define the full set of cluster IDs ---
     cluster_ids = np.unique(spikes['clusters'])
@@ -53,15 +65,18 @@ def get_diff_arrays_for_one_cluster(pid,
     # --- Bin spikes for ALL clusters in cluster_ids ---
     # This gives us a raster with shape (nTrials, nClusters, nBins)
     # plus the bin center times.
-    raster_3D, time_bins = bin_spikes2D(
-        spikes['times'],        # full spike times
-        spikes['clusters'],     # each spike's cluster ID
-        cluster_ids,            # the set of cluster IDs we're including
-        event_times,
-        pre_time=pre_time,
-        post_time=post_time,
-        bin_size=bin_size
-    )
+    with instrument.timer('binning'):
+        raster_3D, time_bins = bin_spikes2D(
+            spikes['times'],        # full spike times
+            spikes['clusters'],     # each spike's cluster ID
+            cluster_ids,            # the set of cluster IDs we're including
+            event_times,
+            pre_time=pre_time,
+            post_time=post_time,
+            bin_size=bin_size
+        )
+    instrument.count('spikes', len(spikes['times']))
+    instrument.count('clusters', len(cluster_ids))
 
     # Convert spike counts to firing rates
     raster_3D = raster_3D / bin_size  # shape => (nTrials, nClusters, nBins)
@@ -79,37 +94,15 @@ def get_diff_arrays_for_one_cluster(pid,
     # Extract just this cluster's data => shape (nTrials, nBins)
     cluster_raster = raster_3D[:, cluster_idx, :]
 
-    # --- Observed difference (Right - Left) in each bin ---
-    obs_diff = (
-        np.nanmean(cluster_raster[right_idx, :], axis=0) -
-        np.nanmean(cluster_raster[left_idx, :], axis=0)
-    )
-
-    # --- Build null distribution via shuffling ---
-    n_bins = cluster_raster.shape[1]
-    shuffled_diff = np.zeros((n_shuffles, n_bins))
-    for s in range(n_shuffles):
-        perm_left = np.random.permutation(left_idx)
-        perm_right = np.random.permutation(right_idx)
-        shuffled_diff[s, :] = (
-            np.nanmean(cluster_raster[perm_right, :], axis=0) -
-            np.nanmean(cluster_raster[perm_left, :], axis=0)
-        )
-
-    # --- Compute p-values (two-sided) ---
-    p_vals = np.mean(np.abs(shuffled_diff) >= np.abs(obs_diff), axis=0)
+    # --- Observed difference (Right - Left) in each bin, and its null
+    # distribution via shuffling ---
+    with instrument.timer('permutation_test'):
+        obs_diff, shuffled_diff = difference_null(cluster_raster, left_idx, right_idx,
+                                                  n_shuffles)
+    instrument.count('shuffles', n_shuffles)
 
-    # --- Multiple-comparisons correction ---
-    bonf_threshold = alpha / n_bins
-    bonf_reject = (p_vals < bonf_threshold)
-
-    remaining = p_vals[bonf_reject]
-    if len(remaining) > 0:
-        _, p_fdr_corrected, _, _ = multipletests(remaining, alpha=alpha, method='fdr_bh')
-        final_reject = np.copy(bonf_reject)
-        final_reject[bonf_reject] = (p_fdr_corrected < alpha)
-    else:
-        final_reject = np.zeros_like(p_vals, dtype=bool)
+    # --- Multiple-comparisons correction (two-sided p-values) ---
+    final_reject = correct(obs_diff, shuffled_diff, alpha, method=correction)
 
     # Return arrays needed for plotting
     return obs_diff, shuffled_diff, final_reject, time_bins
@@ -118,7 +111,8 @@ def plot_difference_with_significance(time_bins,
                                       obs_diff,
                                       shuffled_diff,
                                       final_reject,
-                                      title="Observed vs. Shuffled Differences"):
+                                      title="Observed vs. Shuffled Differences",
+                                      out_dir="results"):
     """
     Plots the observed difference in firing rates over time (obs_diff),
     overlays the null distribution (shuffled_diff) as a shaded region,
@@ -136,8 +130,12 @@ def plot_difference_with_significance(time_bins,
         Boolean mask of which bins are significant after corrections, shape (n_bins,).
     title : str
         Plot title.
+    out_dir : str
+        Directory the figure is saved to.
     """
 
+    import matplotlib.pyplot as plt
+
     # percentile boundaries
     lower_bound = np.percentile(shuffled_diff, 2.5, axis=0)
     upper_bound = np.percentile(shuffled_diff, 97.5, axis=0)
@@ -167,10 +165,10 @@ def plot_difference_with_significance(time_bins,
     plt.xlabel("Time (s)")
     plt.ylabel("Difference in Firing Rate (Hz)")
     plt.legend()
-    plt.savefig(f"results/{title}.png", dpi=300, bbox_inches='tight')
+    plt.savefig(os.path.join(out_dir, f"{title}.png"), dpi=300, bbox_inches='tight')
     plt.close()
 
-def load_cluster_data(pid, cluster_id, one, ba):
+def load_cluster_data(pid, cluster_id, one, ba, session=None):
     """
     Loads spikes and trials for the given probe insertion ID (pid),
     filters to 'good' clusters, and returns:
@@ -178,12 +176,18 @@ def load_cluster_data(pid, cluster_id, one, ba):
       - sl (SessionLoader with sl.trials)
       - cluster_id (the same, but we confirm it's 'good')
     Raises ValueError if cluster_id not found among good clusters.
+    A prefetched prefetch.Session skips the downloads.
     """
 
     # --- load the spike data ---
-    ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = ssl.load_spike_sorting()
-    clusters = ssl.merge_clusters(spikes, clusters, channels)
+    if session is None:
+        with instrument.timer('load'):
+            from brainbox.io.one import SpikeSortingLoader
+            ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = ssl.load_spike_sorting()
+            clusters = ssl.merge_clusters(spikes, clusters, channels)
+    else:
+        spikes, clusters = session.spikes, session.clusters
 
     # --- filter to good clusters ---
     good_mask = (clusters['label'] >= 0.5) #kinda good clusters
@@ -201,9 +205,13 @@ def load_cluster_data(pid, cluster_id, one, ba):
     print(f"SCdg clusters found: {scdg_ids}")
 
     # --- Load trials ---
-    eid, pname = one.pid2eid(pid)
-    sl = SessionLoader(eid=eid, one=one)
-    sl.load_trials()
+    if session is not None:
+        return spikes_g, clusters, session
+    with instrument.timer('load'):
+        from brainbox.io.one import SessionLoader
+        eid, pname = one.pid2eid(pid)
+        sl = SessionLoader(eid=eid, one=one)
+        sl.load_trials()
 
     return spikes_g, clusters, sl
 
@@ -271,6 +279,8 @@ def plot_raster_psth(axs, spike_times, event_times, trial_idx, dividers, colors,
     - pre_time, post_time: time window for binning
     - raster_bin, psth_bin: bin sizes for raster and PSTH
     """
+    from brainbox.singlecell import bin_spikes
+
     # drop nans
     not_nan = ~np.isnan(event_times)
     event_times = event_times[not_nan]
@@ -336,7 +346,7 @@ def plot_raster_psth(axs, spike_times, event_times, trial_idx, dividers, colors,
     axs[1].set_xlim([-pre_time, post_time + width])
 
 
-def plot_cluster_all(pid, cluster_id, one, ba):
+def plot_cluster_all(pid, cluster_id, one, ba, out_dir="results"):
     """
     1) Loads data for a single cluster (must be 'good').
     2) Creates 3 separate figures:
@@ -345,8 +355,11 @@ def plot_cluster_all(pid, cluster_id, one, ba):
        (c) All Trials
     3) Each figure has 3 rows (stimOn, firstMove, feedback).
        Each row has 2 subplots (PSTH + Raster).
+    Figures are saved to `out_dir`.
     """
 
+    import matplotlib.pyplot as plt
+
     # load data and confirm cluster is good
     spikes_g, clusters, sl = load_cluster_data(pid, cluster_id, one, ba)
 
@@ -390,6 +403,6 @@ def plot_cluster_all(pid, cluster_id, one, ba):
 
         plt.tight_layout()
         filename = f"PID_{pid}_Cluster_{cluster_id}_{cond}"
-        plt.savefig(f"results/{filename}.png", dpi=300, bbox_inches='tight')
+        plt.savefig(os.path.join(out_dir, f"{filename}.png"), dpi=300, bbox_inches='tight')
         plt.close()
 
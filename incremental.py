@@ -0,0 +1,198 @@
+"""============================================================================
+Incremental trial appends for long or ongoing recordings.
+
+find_sensitive_clusters, extract_spikes_for_pcca_by_region +
+prepare_pcca_matrices and PCCA.fit all work on a closed trial table, so new
+trials mean recomputing everything. The classes here keep running state
+instead, and an update only touches the new trials:
+
+    scan = RunningSensitivity(n_shuffles=500)
+    tensors = RegionTensors({'SCdg': scdg_ids, 'SCiw': sciw_ids})
+    model = PCCA(3, 100)
+    for trials in new_trial_batches:                # slices of the trials table
+        scan.update(spikes, clusters, trials)
+        new = tensors.append(spikes, trials)
+        model.partial_fit(*(X.reshape(len(X), -1) for X in new.values()))
+    sig_clusters, times = scan.sensitive_clusters()
+
+`spikes` may grow between calls as long as its times stay sorted. Binning
+finds each new event's window with searchsorted, so spikes outside the new
+trials are never scanned. The sensitivity null shuffles labels within each
+batch of trials (see correction.RunningDifference).
+============================================================================"""
+
+import numpy as np
+
+import instrument
+from correction import RunningDifference, correct
+
+
+# -----------------------------------------------------------------------------
+
+def bin_trials(spikes, cluster_ids, event_times, pre_time=0.5, post_time=1.0,
+               bin_size=0.05):
+    """Spike counts of `cluster_ids` around `event_times` only.
+
+    Same bins as brainbox's bin_spikes/bin_spikes2D. Returns (binned,
+    bin_times) with binned of shape (n_events, n_clusters, n_bins), clusters
+    in the order given.
+    """
+    from brainbox.singlecell import bin_spikes2D
+
+    event_times = np.asarray(event_times, dtype=float)
+    cluster_ids = np.asarray(cluster_ids)
+    order = np.argsort(cluster_ids)
+
+    # spikes that can fall into one of the new windows
+    times = spikes['times']
+    events = event_times[np.isfinite(event_times)]
+    lo, hi = 0, 0
+    if events.size:
+        lo, hi = np.searchsorted(times, [events.min() - pre_time - bin_size,
+                                         events.max() + post_time + bin_size])
+    t, c = times[lo:hi], spikes['clusters'][lo:hi]
+    keep = np.isin(c, cluster_ids)
+
+    with instrument.timer('binning'):
+        binned, bin_times = bin_spikes2D(t[keep], c[keep], cluster_ids[order],
+                                         event_times, pre_time=pre_time,
+                                         post_time=post_time, bin_size=bin_size)
+    instrument.count('spikes', int(keep.sum()))
+    return binned[:, np.argsort(order)], bin_times
+
+
+class RegionTensors:
+
+    def __init__(self, clusters, event='stimOn', pre_time=0.5, post_time=1.0,
+                 bin_size=0.05):
+        """(trials x time x neurons) spike counts of two regions, grown by
+        appending trials.
+
+        clusters : {region: cluster IDs}, e.g. the sensitive clusters of
+            each region, in the order of the tensors' last axis.
+        The binning window defaults to extract_spikes_for_pcca_by_region's.
+        """
+        self.clusters = {region: np.asarray(ids) for region, ids in clusters.items()}
+        self.event = event
+        self.pre_time = pre_time
+        self.post_time = post_time
+        self.bin_size = bin_size
+        self.n_trials = 0
+        self.bin_times = None
+        self._buffers = {}
+        self._trials = []
+
+    def append(self, spikes, trials):
+        """Bin the new `trials` and append them.
+
+        Returns {region: (n_new_trials, n_bins, n_clusters)} holding only
+        the new trials, e.g. to pass to PCCA.partial_fit.
+        """
+        ids = np.concatenate(list(self.clusters.values()))
+        binned, self.bin_times = bin_trials(spikes, ids, trials[f'{self.event}_times'],
+                                            self.pre_time, self.post_time, self.bin_size)
+        binned = binned.transpose(0, 2, 1)
+
+        new, start = {}, 0
+        for region, region_ids in self.clusters.items():
+            new[region] = binned[..., start:start + len(region_ids)]
+            start += len(region_ids)
+            self._buffers[region] = _append_rows(self._buffers.get(region),
+                                                 self.n_trials, new[region])
+        self._trials.append(trials)
+        self.n_trials += len(binned)
+        return new
+
+    def tensor(self, region):
+        """All trials so far in recording order, (n_trials, n_bins, n_clusters).
+        """
+        return self._buffers[region][:self.n_trials]
+
+    @property
+    def trials(self):
+        """The appended trials tables, concatenated."""
+        import pandas as pd
+        return pd.concat(self._trials, ignore_index=True)
+
+    def matrices(self, condition='left-right'):
+        """Tensors with trials sorted by `condition`, like prepare_pcca_matrices.
+
+        Returns X1, X2, trial_idx, clusters1, clusters2.
+        """
+        from types import SimpleNamespace
+        from preprocessing import sort_trials_condition
+
+        trial_idx = sort_trials_condition(SimpleNamespace(trials=self.trials), condition)[0]
+        (r1, ids1), (r2, ids2) = self.clusters.items()
+        return (self.tensor(r1)[trial_idx], self.tensor(r2)[trial_idx], trial_idx,
+                list(ids1), list(ids2))
+
+
+# -----------------------------------------------------------------------------
+
+class RunningSensitivity:
+
+    def __init__(self, event='stimOn', pre_time=0.5, post_time=0.5, bin_size=0.05,
+                 alpha=0.005, n_shuffles=500, correction='bonferroni-fdr',
+                 acronym=None, cluster_ids=None):
+        """find_sensitive_clusters over trials that arrive in batches.
+
+        Keeps per-cluster Right/Left firing-rate sums for the observed labels
+        and every shuffle (correction.RunningDifference). The clusters are
+        fixed at the first update: `cluster_ids`, or else the good clusters
+        (in `acronym`, if given).
+        """
+        self.event = event
+        self.pre_time = pre_time
+        self.post_time = post_time
+        self.bin_size = bin_size
+        self.alpha = alpha
+        self.n_shuffles = n_shuffles
+        self.correction = correction
+        self.acronym = acronym
+        self.cluster_ids = None if cluster_ids is None else np.asarray(cluster_ids)
+        self.times = None
+        self.diff = RunningDifference(n_shuffles)
+
+    @property
+    def n_trials(self):
+        return self.diff.n_trials
+
+    def update(self, spikes, clusters, trials):
+        """Bin the new `trials` and add them to the running sums."""
+        if self.cluster_ids is None:
+            good = clusters['label'] >= 0.5
+            if self.acronym is not None:
+                good &= (np.asarray(clusters['acronym']) == self.acronym)
+            self.cluster_ids = np.sort(clusters['cluster_id'][good])
+
+        raster, self.times = bin_trials(spikes, self.cluster_ids,
+                                        trials[f'{self.event}_times'],
+                                        self.pre_time, self.post_time, self.bin_size)
+        raster = raster / self.bin_size
+        left = ~np.isnan(np.asarray(trials['contrastLeft'], dtype=float))
+        right = ~np.isnan(np.asarray(trials['contrastRight'], dtype=float))
+
+        with instrument.timer('permutation_test'):
+            self.diff.update(raster, left, right)
+        instrument.count('shuffles', self.n_shuffles)
+
+    def sensitive_clusters(self):
+        """(cluster IDs, bin times) by the rule of find_sensitive_clusters.
+        """
+        final_reject = correct(self.diff.obs, self.diff.null, self.alpha,
+                               method=self.correction)
+        sig_clusters = list(self.cluster_ids[np.count_nonzero(final_reject, axis=1) > 10])
+        # at most 31, like find_sensitive_clusters
+        return sig_clusters[:31], self.times
+
+
+def _append_rows(buf, n, rows):
+    """Write `rows` after the first n rows of `buf`, doubling it when full."""
+    if buf is None or len(buf) < n + len(rows):
+        grown = np.empty((max(2 * (n + len(rows)), 64),) + rows.shape[1:], dtype=rows.dtype)
+        if buf is not None:
+            grown[:n] = buf[:n]
+        buf = grown
+    buf[n:n + len(rows)] = rows
+    return buf
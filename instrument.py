@@ -0,0 +1,225 @@
+"""============================================================================
+Lightweight instrumentation: timers, memory peaks and counters.
+
+    import instrument
+    instrument.enable()                     # or PIPELINE_INSTRUMENT=1 (=memory
+                                            # also traces allocations)
+    with instrument.timer('binning'):
+        ...
+    instrument.count('spikes', len(times))
+    instrument.write_report('results')      # instrumentation.json / .csv
+
+Timers nest: a timer opened inside another is recorded under the joined path
+('stage:pcca_sweep/pcca_fit/em_iter'), and calls are aggregated per path
+(calls, total/min/max seconds, peak RSS, and with trace_memory the peak
+traced allocation inside the timer). When instrumentation is disabled,
+timer() hands back a shared no-op context manager and count() returns at
+once, so instrumented hot loops pay a function call and a flag check.
+
+Peak RSS is the process high-water mark at the time a timer closes. Traced
+peaks come from tracemalloc, which is process-wide, so they are only exact
+for timers that do not overlap with other threads.
+============================================================================"""
+
+import csv
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import nullcontext
+from functools import wraps
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+
+_NULL = nullcontext()
+_lock = threading.Lock()
+_local = threading.local()
+
+enabled = False
+_trace_memory = False
+_timers = {}
+_counters = {}
+_started = None
+
+
+# -----------------------------------------------------------------------------
+
+def enable(trace_memory=False):
+    """Start recording. trace_memory also tracks tracemalloc peaks per timer
+    (slows allocation-heavy code noticeably)."""
+    global enabled, _trace_memory, _started
+    enabled = True
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    if _started is None:
+        _started = time.time()
+
+
+def disable():
+    global enabled, _trace_memory
+    enabled = False
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+
+
+def reset():
+    """Forget everything recorded so far."""
+    global _started
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+    _started = time.time() if enabled else None
+
+
+def timer(name, **tags):
+    """Context manager timing a block as `name` (tags become part of the key).
+    """
+    if not enabled:
+        return _NULL
+    return _Timer(name, tags)
+
+
+def timed(name=None):
+    """Decorator form of timer(); the name defaults to the function's.
+    """
+    def decorator(func):
+        label = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(label, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name, n=1):
+    """Add n to counter `name`."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def summary():
+    """Everything recorded so far as a JSON-serializable dict."""
+    with _lock:
+        timers = [dict(path=path, **stats) for path, stats in _timers.items()]
+        counters = dict(_counters)
+    for row in timers:
+        row['mean_s'] = row['total_s'] / row['calls']
+    return {
+        'started': _started,
+        'wall_s': None if _started is None else time.time() - _started,
+        'rss_peak_mb': _rss_peak_mb(),
+        'timers': sorted(timers, key=lambda row: row['path']),
+        'counters': counters,
+    }
+
+
+def write_report(directory='results', prefix='instrumentation'):
+    """Write <prefix>.json (full summary) and <prefix>.csv (timer rows).
+
+    Returns the path of the JSON file.
+    """
+    os.makedirs(directory, exist_ok=True)
+    report = summary()
+    json_path = os.path.join(directory, f'{prefix}.json')
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=1)
+
+    fields = ['path', 'calls', 'total_s', 'mean_s', 'min_s', 'max_s',
+              'rss_peak_mb', 'traced_peak_mb']
+    with open(os.path.join(directory, f'{prefix}.csv'), 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(report['timers'])
+    return json_path
+
+
+# -----------------------------------------------------------------------------
+
+class _Timer:
+
+    def __init__(self, name, tags):
+        if tags:
+            name += '[' + ','.join(f'{k}={v}' for k, v in sorted(tags.items())) + ']'
+        self.name = name
+        self.traced_peak = 0
+
+    def __enter__(self):
+        stack = _stack()
+        self.path = '/'.join([t.name for t in stack] + [self.name])
+        if _trace_memory and tracemalloc.is_tracing():
+            # Hand the peak so far to the enclosing timer before resetting it
+            if stack:
+                parent = stack[-1]
+                parent.traced_peak = max(parent.traced_peak,
+                                         tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        stack = _stack()
+        stack.pop()
+
+        traced_mb = None
+        if _trace_memory and tracemalloc.is_tracing():
+            self.traced_peak = max(self.traced_peak, tracemalloc.get_traced_memory()[1])
+            traced_mb = self.traced_peak / 2 ** 20
+            if stack:
+                stack[-1].traced_peak = max(stack[-1].traced_peak, self.traced_peak)
+        rss_mb = _rss_peak_mb()
+
+        with _lock:
+            stats = _timers.get(self.path)
+            if stats is None:
+                stats = _timers[self.path] = {'calls': 0, 'total_s': 0.0,
+                                              'min_s': elapsed, 'max_s': elapsed,
+                                              'rss_peak_mb': rss_mb,
+                                              'traced_peak_mb': traced_mb}
+            stats['calls'] += 1
+            stats['total_s'] += elapsed
+            stats['min_s'] = min(stats['min_s'], elapsed)
+            stats['max_s'] = max(stats['max_s'], elapsed)
+            stats['rss_peak_mb'] = _max(stats['rss_peak_mb'], rss_mb)
+            stats['traced_peak_mb'] = _max(stats['traced_peak_mb'], traced_mb)
+        return False
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _rss_peak_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+
+if os.environ.get('PIPELINE_INSTRUMENT', '') not in ('', '0'):
+    enable(trace_memory=os.environ['PIPELINE_INSTRUMENT'] == 'memory')
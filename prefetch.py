@@ -0,0 +1,182 @@
+"""============================================================================
+Prefetching of per-insertion session data.
+
+Loading spikes, clusters and trials from OpenAlyx blocks for the whole
+download, and only then does the permutation test or PCCA start. With
+SessionPrefetcher the next few insertions are fetched by background threads
+while the current one is analysed, and at most `depth` sessions are ever held
+ahead of the consumer.
+
+LocalONE is a directory-backed stand-in for the parts of ONE the pipeline
+uses. Sessions fetched once from OpenAlyx can be written to it with
+save_session() and replayed offline.
+============================================================================"""
+
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+import instrument
+
+
+# -----------------------------------------------------------------------------
+
+class Session:
+    """Everything loaded for one probe insertion.
+
+    Has a `trials` table, so it can stand in wherever a SessionLoader is
+    passed as `sl`.
+    """
+
+    def __init__(self, pid, eid, spikes, clusters, channels, trials, pname=None):
+        self.pid = pid
+        self.eid = eid
+        self.pname = pname
+        self.spikes = spikes
+        self.clusters = clusters
+        self.channels = channels
+        self.trials = trials
+
+    def __repr__(self):
+        return f"Session({self.pid!r}, {len(self.trials)} trials)"
+
+
+@instrument.timed('load_session')
+def fetch_ibl_session(pid, one, ba=None):
+    """Download spikes, merged clusters, channels and trials for `pid`.
+    """
+    from brainbox.io.one import SessionLoader, SpikeSortingLoader
+
+    ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+    spikes, clusters, channels = ssl.load_spike_sorting()
+    clusters = ssl.merge_clusters(spikes, clusters, channels)
+
+    eid, pname = one.pid2eid(pid)
+    sl = SessionLoader(eid=eid, one=one)
+    sl.load_trials()
+    return Session(pid, eid, spikes, clusters, channels, sl.trials, pname=pname)
+
+
+def session_fetcher(one, ba=None):
+    """pid -> Session callable for a real ONE instance or a LocalONE.
+    """
+    if isinstance(one, LocalONE):
+        return one.load_session
+    return partial(fetch_ibl_session, one=one, ba=ba)
+
+
+# -----------------------------------------------------------------------------
+
+class SessionPrefetcher:
+
+    def __init__(self, pids, fetch, depth=2, n_workers=None):
+        """Iterate over Sessions for `pids`, fetching ahead in threads.
+
+        fetch : callable pid -> Session, e.g. session_fetcher(one, ba)
+        depth : number of sessions requested ahead of the one being
+            consumed; bounds memory to depth + 1 sessions.
+        n_workers : download threads (default `depth`).
+        """
+        if depth < 1:
+            raise ValueError("depth must be at least 1")
+        self.pids = list(pids)
+        self.fetch = fetch
+        self.depth = depth
+        self.n_workers = n_workers or depth
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __iter__(self):
+        pids = iter(self.pids)
+        pending = deque()
+        ex = ThreadPoolExecutor(max_workers=self.n_workers)
+        try:
+            for pid in pids:
+                pending.append(ex.submit(self.fetch, pid))
+                if len(pending) == self.depth:
+                    break
+            while pending:
+                session = pending.popleft().result()
+                # Refill before handing the session out, so the next download
+                # overlaps with the caller's work on this one.
+                pid = next(pids, None)
+                if pid is not None:
+                    pending.append(ex.submit(self.fetch, pid))
+                yield session
+        finally:
+            ex.shutdown(wait=True, cancel_futures=True)
+
+
+# -----------------------------------------------------------------------------
+
+class LocalONE:
+
+    def __init__(self, root):
+        """Directory-backed stand-in for ONE.
+
+        Each insertion lives in `root/<pid>/` as meta.json (eid, pname) and
+        spikes.npz, clusters.npz, channels.npz and trials.npz, one array per
+        field or trials column.
+        """
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+
+    def search_insertions(self, atlas_acronym=None, **kwargs):
+        """PIDs stored locally, optionally only those with a cluster in
+        `atlas_acronym`. Other ONE search arguments are ignored.
+        """
+        pids = sorted(pid for pid in os.listdir(self.root)
+                      if os.path.exists(self._path(pid, 'meta.json')))
+        if atlas_acronym is None:
+            return pids
+        return [pid for pid in pids
+                if np.any(self._load_npz(pid, 'clusters')['acronym'] == atlas_acronym)]
+
+    def pid2eid(self, pid):
+        with open(self._path(pid, 'meta.json')) as f:
+            meta = json.load(f)
+        return meta['eid'], meta['pname']
+
+    def load_session(self, pid):
+        eid, pname = self.pid2eid(pid)
+        return Session(pid, eid,
+                       spikes=self._load_npz(pid, 'spikes'),
+                       clusters=self._load_npz(pid, 'clusters'),
+                       channels=self._load_npz(pid, 'channels'),
+                       trials=pd.DataFrame(self._load_npz(pid, 'trials')),
+                       pname=pname)
+
+    def save_session(self, session):
+        """Store a Session (e.g. from fetch_ibl_session) under its pid.
+        """
+        os.makedirs(os.path.join(self.root, session.pid), exist_ok=True)
+        self._save_npz(session.pid, 'spikes', session.spikes)
+        self._save_npz(session.pid, 'clusters', session.clusters)
+        self._save_npz(session.pid, 'channels', session.channels)
+        self._save_npz(session.pid, 'trials',
+                       {col: session.trials[col].to_numpy() for col in session.trials.columns})
+        with open(self._path(session.pid, 'meta.json'), 'w') as f:
+            json.dump({'eid': str(session.eid), 'pname': session.pname}, f)
+
+# -----------------------------------------------------------------------------
+
+    def _path(self, pid, fname):
+        return os.path.join(self.root, pid, fname)
+
+    def _load_npz(self, pid, name):
+        with np.load(self._path(pid, f'{name}.npz'), allow_pickle=False) as f:
+            return {key: f[key] for key in f.files}
+
+    def _save_npz(self, pid, name, fields):
+        arrays = {}
+        for key, val in fields.items():
+            val = np.asarray(val)
+            # object columns (e.g. acronyms) are stored as fixed-width strings
+            arrays[key] = val.astype(str) if val.dtype == object else val
+        np.savez(self._path(pid, f'{name}.npz'), **arrays)
@@ -1,14 +1,13 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from one.api import ONE
-from brainbox.io.one import SpikeSortingLoader
-from iblatlas.atlas import AllenAtlas
-from statsmodels.stats.multitest import multipletests
-from brainbox.io.one import SessionLoader, SpikeSortingLoader
-from brainbox.singlecell import bin_spikes2D,bin_spikes
 
 import os
 
+import instrument
+from correction import correct, difference_null
+
+# ONE, brainbox and iblatlas are imported inside the functions that need
+# them, so importing this module stays cheap.
+
 def find_sensitive_clusters(
     pid,               # Probe insertion ID
     event_times,       # 1D array of event times (e.g. stimOn_times)
@@ -17,28 +16,43 @@ def find_sensitive_clusters(
     post_time=0.5,     # Time (sec) after each event
     bin_size=0.01,     # Bin size (sec)
     alpha=0.005,       # Significance level
-    n_shuffles=500
+    n_shuffles=500,
+    session=None,      # Prefetched prefetch.Session for this PID
+    acronym=None,      # Only test clusters in this brain region
+    correction='bonferroni-fdr'  # see correction.METHODS
 ):
     """
-    1) Loads spikes/clusters for the given PID.
+    1) Loads spikes/clusters for the given PID (unless `session` holds them).
     2) Uses 'bin_spikes2D' to create an (nTrials x nClusters x nBins) array.
     3) Splits trials into left vs. right (based on sl.trials).
-    4) Performs a permutation test for each cluster, comparing right minus left.
+    4) Performs a permutation test of all clusters at once, comparing right
+       minus left, and corrects the bins of each cluster for multiple
+       comparisons (correction.correct).
     5) Returns a list of cluster IDs with significant modulation.
     """
 
-    one = ONE()
-    ba = AllenAtlas()
+    from brainbox.singlecell import bin_spikes2D
 
     # ---------------- Load the spike data ----------------
-    ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = ssl.load_spike_sorting()
-    clusters = ssl.merge_clusters(spikes, clusters, channels)
+    if session is None:
+        with instrument.timer('load'):
+            from one.api import ONE
+            from iblatlas.atlas import AllenAtlas
+            from brainbox.io.one import SpikeSortingLoader
+            one = ONE()
+            ba = AllenAtlas()
+            ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = ssl.load_spike_sorting()
+            clusters = ssl.merge_clusters(spikes, clusters, channels)
+    else:
+        spikes, clusters = session.spikes, session.clusters
 
     # -------------- Restrict to "good" clusters ---------------
     # IBL convention: label=1 => "good"
     # Make sure these fields exist in your data
     good_cluster_idx = (clusters['label'] >= 0.5)
+    if acronym is not None:
+        good_cluster_idx &= (np.asarray(clusters['acronym']) == acronym)
     good_cluster_IDs = clusters['cluster_id'][good_cluster_idx]
 
     # Filter 'clusters' dict
@@ -57,15 +71,18 @@ def find_sensitive_clusters(
     # ---------------- Bin with bin_spikes2D ----------------
     # shape(raster) => (nEvents, nClusters, nBins)
     # times => 1D array of length nBins (the bin centers)
-    raster_3D, times = bin_spikes2D(
-        spikes_g['times'],            # All spike times
-        spikes_g['clusters'],         # Cluster IDs for each spike
-        cluster_ids,                  # Which clusters to include
-        event_times,                  # The event times to align to
-        pre_time=pre_time,
-        post_time=post_time,
-        bin_size=bin_size
-    )
+    with instrument.timer('binning'):
+        raster_3D, times = bin_spikes2D(
+            spikes_g['times'],            # All spike times
+            spikes_g['clusters'],         # Cluster IDs for each spike
+            cluster_ids,                  # Which clusters to include
+            event_times,                  # The event times to align to
+            pre_time=pre_time,
+            post_time=post_time,
+            bin_size=bin_size
+        )
+    instrument.count('spikes', len(spikes_g['times']))
+    instrument.count('clusters', len(cluster_ids))
 
     # Convert spike counts to firing rates (spikes/sec)
     raster_3D = raster_3D / bin_size  # (nTrials, nClusters, nBins)
@@ -79,120 +96,121 @@ def find_sensitive_clusters(
     left_idx = np.asarray(left_idx)
     right_idx = np.asarray(right_idx)
 
-    # ---------------- Permutation test for each cluster ----------------
-    sig_clusters = []
-    n_clusters = len(cluster_ids)
-    n_bins = raster_3D.shape[2]
-
-    for i, cid in enumerate(cluster_ids):
-        # Extract this cluster's data => shape: (nTrials, nBins)
-        cluster_raster = raster_3D[:, i, :]  # slice out cluster 'i'
+    # ---------------- Permutation test for all clusters ----------------
+    # Observed difference in firing rate (Right - Left) for each bin,
+    # shape => (nClusters, nBins), and its null distribution via shuffling,
+    # shape => (nClusters, nShuffles, nBins)
+    with instrument.timer('permutation_test'):
+        obs_diff, shuffled_diff = difference_null(raster_3D, left_idx, right_idx,
+                                                  n_shuffles)
+    instrument.count('shuffles', n_shuffles)
+
+    # Significant bins of every cluster, shape => (nClusters, nBins)
+    final_reject = correct(obs_diff, shuffled_diff, alpha, method=correction)
+
+    # If > 10 bins are significant, we call it “sensitive”
+    sig_clusters = list(cluster_ids[np.count_nonzero(final_reject, axis=1) > 10])
+
+    # to get only 30 clusters (the first 31, where the old loop stopped)
+    return sig_clusters[:31], times
+
+def find_sensitive_clusters_dict(atlas_acronym,
+                                 pid=None,
+                                 insertion_index=32,
+                                 events=('stimOn', 'firstMovement', 'feedback'),
+                                 pre_time=0.5,
+                                 post_time=0.5,
+                                 bin_size=0.05,
+                                 alpha=0.005,
+                                 n_shuffles=500,
+                                 correction='bonferroni-fdr',
+                                 session=None):
+    """
+    Finds the stim/movement/feedback sensitive clusters of one insertion.
 
-        # Observed difference in firing rate (Right - Left) for each bin
-        # shape => (nBins,)
-        obs_diff = (
-            np.nanmean(cluster_raster[right_idx, :], axis=0) -
-            np.nanmean(cluster_raster[left_idx, :], axis=0)
-        )
+    With `pid` given, only that insertion's clusters in `atlas_acronym` are
+    tested. Otherwise the `insertion_index`-th insertion found in
+    `atlas_acronym` is used, with all of its good clusters. The timing and
+    test arguments go to find_sensitive_clusters. A prefetched
+    prefetch.Session for `pid` skips the downloads.
 
-        # Build the null distribution via shuffling
-        shuffled_diff = np.zeros((n_shuffles, n_bins))
-        for s in range(n_shuffles):
-            perm_left = np.random.permutation(left_idx)
-            perm_right = np.random.permutation(right_idx)
-            shuffled_diff[s, :] = (
-                np.nanmean(cluster_raster[perm_right, :], axis=0) -
-                np.nanmean(cluster_raster[perm_left, :], axis=0)
-            )
-
-        # Compute p-values
-        p_vals = np.mean(np.abs(shuffled_diff) >= np.abs(obs_diff), axis=0)
-
-        # Bonferroni
-        bonf_threshold = alpha / n_bins
-        bonf_reject = (p_vals < bonf_threshold)
-
-        # FDR
-        remaining = p_vals[bonf_reject]
-        if len(remaining) > 0:
-            _, p_fdr_corrected, _, _ = multipletests(remaining, alpha=alpha, method='fdr_bh')
-            final_reject = np.copy(bonf_reject)
-            final_reject[bonf_reject] = (p_fdr_corrected < alpha)
-        else:
-            final_reject = np.zeros_like(p_vals, dtype=bool)
-
-        # If > 5 bins are significant, we call it “sensitive”
-        if np.count_nonzero(final_reject) > 10:
-            sig_clusters.append(cid)
-
-        # to get only 30 clusters
-        if len(sig_clusters) > 30:
-          return sig_clusters, times
-
-    return sig_clusters, times
-
-def find_sensitive_clusters_dict(atlas_acronym):
-    one = ONE(base_url='https://openalyx.internationalbrainlab.org', \
-          password='international', \
-          silent=True)
-    insertions = one.search_insertions(atlas_acronym=atlas_acronym, query_type='remote')
-    print(f"Found {len(insertions)} insertions in {atlas_acronym}.")
-    sig_clusters_dict = {}
-
-    if len(insertions) > 0:
-        pid = insertions[32]
+    Returns a dict with the PID and a list of cluster IDs per event.
+    """
+    acronym = atlas_acronym
+    if session is not None:
+        if pid != session.pid:
+            raise ValueError(f"session holds {session.pid}, not {pid}")
+        sl = session
+    else:
+        from one.api import ONE
+        from brainbox.io.one import SessionLoader
+
+        one = ONE(base_url='https://openalyx.internationalbrainlab.org', \
+              password='international', \
+              silent=True)
+        if pid is None:
+            insertions = one.search_insertions(atlas_acronym=atlas_acronym, query_type='remote')
+            print(f"Found {len(insertions)} insertions in {atlas_acronym}.")
+            if len(insertions) <= insertion_index:
+                raise ValueError(f"No insertion {insertion_index} in {atlas_acronym} "
+                                 f"({len(insertions)} found)")
+            pid = insertions[insertion_index]
+            acronym = None
         print("Using PID:", pid)
         eid, pname = one.pid2eid(pid)
 
         sl = SessionLoader(eid=eid, one=one)
         sl.load_trials()
-        trials = sl.trials
+    trials = sl.trials
 
-        # 1) Stim
-        sig_stim_clusters, stim_times = find_sensitive_clusters(
+    sig_clusters_dict = {'pid': pid}
+    for event in events:
+        sig_clusters_dict[event], _ = find_sensitive_clusters(
             pid,
-            event_times=trials['stimOn_times'],
+            event_times=trials[f'{event}_times'],
             sl=sl,
-            pre_time=0.5,
-            post_time=0.5,
-            bin_size=0.05,
-            alpha=0.005,
-            n_shuffles=500
+            pre_time=pre_time,
+            post_time=post_time,
+            bin_size=bin_size,
+            alpha=alpha,
+            n_shuffles=n_shuffles,
+            session=session,
+            acronym=acronym,
+            correction=correction
         )
 
-        # 2) Movement
-        sig_movement_clusters, move_times = find_sensitive_clusters(
-            pid,
-            event_times=trials['firstMovement_times'],
-            sl=sl,
-            pre_time=0.5,
-            post_time=0.5,
-            bin_size=0.05,
-            alpha=0.005,
-            n_shuffles=500
-        )
+    return sig_clusters_dict
 
-        # 3) Reward
-        sig_reward_clusters, reward_times = find_sensitive_clusters(
-            pid,
-            event_times=trials['feedback_times'],
-            sl=sl,
-            pre_time=0.5,
-            post_time=0.5,
-            bin_size=0.05,
-            alpha=0.005,
-            n_shuffles=500
-        )
 
-    sig_clusters_dict['pid'] = pid
-    sig_clusters_dict['stimOn'] = sig_stim_clusters
-    sig_clusters_dict['firstMovement'] = sig_movement_clusters
-    sig_clusters_dict['feedback'] = sig_reward_clusters
+def find_sensitive_clusters_sessions(sessions,
+                                     events=('stimOn', 'firstMovement', 'feedback'),
+                                     **kwargs):
+    """
+    Runs find_sensitive_clusters for every event of every session.
+
+    `sessions` is any iterable of prefetch.Session, typically a
+    SessionPrefetcher, so the next insertions download while the
+    permutation tests of the current one run. Extra keyword arguments go to
+    find_sensitive_clusters.
 
-    return sig_clusters_dict
+    Yields one dict per session, keyed like find_sensitive_clusters_dict.
+    """
+    for session in sessions:
+        sig_clusters_dict = {'pid': session.pid}
+        for event in events:
+            sig_clusters_dict[event], _ = find_sensitive_clusters(
+                session.pid,
+                event_times=session.trials[f'{event}_times'],
+                sl=session,
+                session=session,
+                **kwargs
+            )
+        yield sig_clusters_dict
 
 
-def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one, ba):
+def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one, ba,
+                                      session=None, regions=('SCdg', 'SCiw'),
+                                      pre_time=0.5, post_time=1.0, bin_size=0.05):
     """
     Extracts spike data for PCCA analysis, keeping regions separate
 
@@ -202,10 +220,15 @@ def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one,
         sig_sciw: Dictionary with sensitive clusters for SCiw
         event_type: 'stimOn', 'firstMovement', or 'feedback'
         one, ba: Required objects for data loading
+        session: Optional prefetched prefetch.Session for this PID
+        regions: Names of the two regions, used as keys of the result
+        pre_time, post_time, bin_size: Binning window around each event (s)
 
     Returns:
         Dictionary with separate spike data for each region
     """
+    from brainbox.singlecell import bin_spikes
+
     # Map event type to column name
     event_column = f"{event_type}_times"
 
@@ -217,7 +240,8 @@ def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one,
     reference_cluster = next(iter(scdg_clusters)) if scdg_clusters else next(iter(sciw_clusters))
 
     # Load session data once for efficiency
-    all_spikes, all_clusters, sl = load_cluster_data(pid, reference_cluster, one, ba)
+    all_spikes, all_clusters, sl = load_cluster_data(pid, reference_cluster, one, ba,
+                                                     session=session)
 
     # Get event times
     if event_column not in sl.trials.columns:
@@ -233,10 +257,12 @@ def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one,
             cluster_spike_times = all_spikes['times'][all_spikes['clusters'] == cluster_id]
 
             # Bin the spikes
-            binned_spikes, bin_times = bin_spikes(
-                cluster_spike_times, event_times,
-                pre_time=0.5, post_time=1.0, bin_size=0.05
-            )
+            with instrument.timer('binning'):
+                binned_spikes, bin_times = bin_spikes(
+                    cluster_spike_times, event_times,
+                    pre_time=pre_time, post_time=post_time, bin_size=bin_size
+                )
+            instrument.count('spikes', len(cluster_spike_times))
 
             scdg_data[cluster_id] = {
                 'times': cluster_spike_times,
@@ -254,10 +280,12 @@ def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one,
             cluster_spike_times = all_spikes['times'][all_spikes['clusters'] == cluster_id]
 
             # Bin the spikes
-            binned_spikes, bin_times = bin_spikes(
-                cluster_spike_times, event_times,
-                pre_time=0.5, post_time=1.0, bin_size=0.05
-            )
+            with instrument.timer('binning'):
+                binned_spikes, bin_times = bin_spikes(
+                    cluster_spike_times, event_times,
+                    pre_time=pre_time, post_time=post_time, bin_size=bin_size
+                )
+            instrument.count('spikes', len(cluster_spike_times))
 
             sciw_data[cluster_id] = {
                 'times': cluster_spike_times,
@@ -268,20 +296,21 @@ def extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw, event_type, one,
             print(f"Error processing SCiw cluster {cluster_id}: {e}")
 
     return {
-        'SCdg': scdg_data,
-        'SCiw': sciw_data,
+        regions[0]: scdg_data,
+        regions[1]: sciw_data,
         'trials': sl,
         'event_times': event_times,
         'bin_times': bin_times if 'bin_times' in locals() else None
     }
 
-def prepare_pcca_matrices(region_data, condition='left-right'):
+def prepare_pcca_matrices(region_data, condition='left-right', regions=('SCdg', 'SCiw')):
     """
     Prepares data matrices for PCCA between SCdg and SCiw
 
     Args:
         region_data: Output from extract_spikes_for_pcca_by_region
         condition: 'left-right', 'correct-incorrect', or 'all'
+        regions: The two region keys of region_data
 
     Returns:
         X_scdg, X_sciw: Data matrices for each region
@@ -295,13 +324,13 @@ def prepare_pcca_matrices(region_data, condition='left-right'):
     # Get binned data for both regions
     scdg_binned = []
     scdg_clusters = []
-    for cluster_id, data in region_data['SCdg'].items():
+    for cluster_id, data in region_data[regions[0]].items():
         scdg_binned.append(data['binned'][trial_idx])
         scdg_clusters.append(cluster_id)
 
     sciw_binned = []
     sciw_clusters = []
-    for cluster_id, data in region_data['SCiw'].items():
+    for cluster_id, data in region_data[regions[1]].items():
         sciw_binned.append(data['binned'][trial_idx])
         sciw_clusters.append(cluster_id)
 
@@ -327,7 +356,7 @@ def prepare_pcca_matrices(region_data, condition='left-right'):
 
     return X_scdg, X_sciw, trial_idx, scdg_clusters, sciw_clusters
 
-def load_cluster_data(pid, cluster_id, one, ba):
+def load_cluster_data(pid, cluster_id, one, ba, session=None):
     """
     Loads spikes and trials for the given probe insertion ID (pid),
     filters to 'good' clusters, and returns:
@@ -335,12 +364,18 @@ def load_cluster_data(pid, cluster_id, one, ba):
       - sl (SessionLoader with sl.trials)
       - cluster_id (the same, but we confirm it's 'good')
     Raises ValueError if cluster_id not found among good clusters.
+    A prefetched prefetch.Session skips the downloads.
     """
 
     # --- load the spike data ---
-    ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-    spikes, clusters, channels = ssl.load_spike_sorting()
-    clusters = ssl.merge_clusters(spikes, clusters, channels)
+    if session is None:
+        with instrument.timer('load'):
+            from brainbox.io.one import SpikeSortingLoader
+            ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
+            spikes, clusters, channels = ssl.load_spike_sorting()
+            clusters = ssl.merge_clusters(spikes, clusters, channels)
+    else:
+        spikes, clusters = session.spikes, session.clusters
 
     # --- filter to good clusters ---
     good_mask = (clusters['label'] >= 0.5) #kinda good clusters
@@ -358,9 +393,13 @@ def load_cluster_data(pid, cluster_id, one, ba):
     print(f"SCdg clusters found: {scdg_ids}")
 
     # --- Load trials ---
-    eid, pname = one.pid2eid(pid)
-    sl = SessionLoader(eid=eid, one=one)
-    sl.load_trials()
+    if session is not None:
+        return spikes_g, clusters, session
+    with instrument.timer('load'):
+        from brainbox.io.one import SessionLoader
+        eid, pname = one.pid2eid(pid)
+        sl = SessionLoader(eid=eid, one=one)
+        sl.load_trials()
 
     return spikes_g, clusters, sl
 
@@ -0,0 +1,177 @@
+"""============================================================================
+Dimensionality reduction ahead of PCCA.
+
+run.py used to flatten each region tensor to (n_trials, n_clusters*n_bins) and
+run a dense PCA(n_components=200). AdaptivePCA keeps the same interface but
+offers a randomized SVD and an incremental PCA fed batch-wise from the trial
+tensors, and picks the number of components from the explained variance, so
+its cost scales with the retained rank instead of the full feature count.
+============================================================================"""
+
+import numpy as np
+
+import instrument
+
+
+# -----------------------------------------------------------------------------
+
+def iter_trial_batches(X, batch_size):
+    """Yield consecutive (batch, n_features) blocks of a trial tensor.
+
+    X may be (n_trials, n_features) or (n_trials, ...); trailing axes are
+    flattened one batch at a time so the full flat copy is never built.
+    """
+    n = X.shape[0]
+    for start in range(0, n, batch_size):
+        batch = X[start:start + batch_size]
+        yield batch.reshape(batch.shape[0], -1)
+
+
+class AdaptivePCA:
+
+    def __init__(self, n_components=0.95, method='randomized', max_components=200,
+                 batch_size=None, n_oversamples=10, n_power_iter=4,
+                 random_state=None):
+        """Initialize the reduction.
+
+        n_components : float in (0, 1) or int
+            A float is the fraction of variance to retain, and the rank is
+            grown until it is reached (capped at `max_components`). An int
+            fixes the rank.
+        method : 'randomized', 'incremental' or 'full'
+            'randomized' doubles the rank of a randomized SVD until the
+            variance target is met. 'incremental' streams `batch_size` trials
+            at a time through IncrementalPCA (default 5 x the maximum rank).
+            A batch must hold at least as many trials as components, so
+            batches are grown to the maximum rank (min(n_trials, n_features,
+            max_components)) when `batch_size` is smaller. 'full' is the
+            dense sklearn PCA.
+        """
+        if method not in ('randomized', 'incremental', 'full'):
+            raise ValueError(f"Unknown method: {method}")
+        self.n_components = n_components
+        self.method = method
+        self.max_components = max_components
+        self.batch_size = batch_size
+        self.n_oversamples = n_oversamples
+        self.n_power_iter = n_power_iter
+        self.random_state = random_state
+
+    @instrument.timed('pca')
+    def fit(self, X):
+        """Fit on X of shape (n_trials, n_features) or (n_trials, ...).
+        """
+        n = X.shape[0]
+        p = int(np.prod(X.shape[1:]))
+        max_rank = min(n, p, self.max_components)
+        if isinstance(self.n_components, (int, np.integer)):
+            max_rank = min(max_rank, int(self.n_components))
+
+        if self.method == 'incremental':
+            self._fit_incremental(X, max_rank)
+        elif self.method == 'randomized':
+            self._fit_randomized(X.reshape(n, -1), max_rank)
+        else:
+            self._fit_full(X.reshape(n, -1), max_rank)
+
+        self._trim()
+        return self
+
+    def transform(self, X):
+        """Project X onto the retained components (batch-wise for tensors).
+        """
+        n = X.shape[0]
+        batch_size = self.batch_size or n
+        out = np.empty((n, self.n_components_))
+        for i, batch in enumerate(iter_trial_batches(X, batch_size)):
+            start = i * batch_size
+            out[start:start + batch.shape[0]] = (batch - self.mean_) @ self.components_.T
+        return out
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+    def inverse_transform(self, Z):
+        return Z @ self.components_ + self.mean_
+
+# -----------------------------------------------------------------------------
+
+    def _fit_randomized(self, X, max_rank):
+        from sklearn.utils.extmath import randomized_svd
+
+        self.mean_ = X.mean(axis=0)
+        Xc = X - self.mean_
+        n = X.shape[0]
+        total_var = np.sum(Xc ** 2) / (n - 1)
+
+        target = self._variance_target()
+        rank = max_rank if target is None else min(max_rank, 16)
+        while True:
+            U, S, Vt = randomized_svd(Xc, rank,
+                                      n_oversamples=self.n_oversamples,
+                                      n_iter=self.n_power_iter,
+                                      random_state=self.random_state)
+            explained = S ** 2 / (n - 1)
+            if target is None or rank >= max_rank or \
+                    explained.sum() / total_var >= target:
+                break
+            rank = min(2 * rank, max_rank)
+
+        self._set_fit(Vt, S, explained, total_var)
+
+    def _fit_incremental(self, X, max_rank):
+        from sklearn.decomposition import IncrementalPCA
+
+        n = X.shape[0]
+        # IncrementalPCA needs every batch to hold at least n_components
+        # rows, so a smaller batch_size is grown rather than capping the rank
+        batch_size = max(self.batch_size or 5 * max_rank, max_rank)
+        n_components = max_rank
+        ipca = IncrementalPCA(n_components=n_components)
+
+        starts = list(range(0, n, batch_size))
+        if len(starts) > 1 and n - starts[-1] < n_components:
+            starts.pop()  # fold the short tail into the previous batch
+        for start, stop in zip(starts, starts[1:] + [n]):
+            batch = X[start:stop]
+            ipca.partial_fit(batch.reshape(batch.shape[0], -1))
+
+        self.mean_ = ipca.mean_
+        total_var = ipca.explained_variance_[0] / ipca.explained_variance_ratio_[0]
+        self._set_fit(ipca.components_, ipca.singular_values_,
+                      ipca.explained_variance_, total_var)
+
+    def _fit_full(self, X, max_rank):
+        from sklearn.decomposition import PCA
+
+        pca = PCA(n_components=max_rank, random_state=self.random_state).fit(X)
+        self.mean_ = pca.mean_
+        total_var = pca.explained_variance_[0] / pca.explained_variance_ratio_[0]
+        self._set_fit(pca.components_, pca.singular_values_,
+                      pca.explained_variance_, total_var)
+
+    def _set_fit(self, components, singular_values, explained, total_var):
+        self.components_ = components
+        self.singular_values_ = singular_values
+        self.explained_variance_ = explained
+        self.explained_variance_ratio_ = explained / total_var
+
+    def _trim(self):
+        """Keep the smallest rank whose cumulative variance meets the target.
+        """
+        target = self._variance_target()
+        rank = len(self.explained_variance_)
+        if target is not None:
+            cumulative = np.cumsum(self.explained_variance_ratio_)
+            rank = min(rank, int(np.searchsorted(cumulative, target)) + 1)
+        self.components_ = self.components_[:rank]
+        self.singular_values_ = self.singular_values_[:rank]
+        self.explained_variance_ = self.explained_variance_[:rank]
+        self.explained_variance_ratio_ = self.explained_variance_ratio_[:rank]
+        self.n_components_ = rank
+
+    def _variance_target(self):
+        if isinstance(self.n_components, (float, np.floating)) and \
+                0 < self.n_components < 1:
+            return float(self.n_components)
+        return None
@@ -0,0 +1,182 @@
+"""============================================================================
+Local registry of fitted PCCA models.
+
+Fitted models are stored as .npz files (PCCA.save) under one directory and
+keyed by a hash of the training data, the model's hyperparameters and its
+code, so a pipeline can ask the registry for a fit and get the stored model
+back instead of refitting. An index.json records each entry's class, parameters, size and
+last use. Models are only read from disk on first access, and the least
+recently used entries are evicted once the directory exceeds its budget.
+
+Several processes may share one registry (sweep jobs). Every change to the
+index re-reads index.json and writes it back while holding index.json.lock,
+so no process overwrites entries another one has added, touched or removed.
+============================================================================"""
+
+import json
+import os
+import time
+from contextlib import contextmanager
+
+from cache import hash_inputs, source_digest, _try_lock
+from PCCA import PCCA
+
+# Parameters that change how a fit runs but not its result
+_EXECUTION_PARAMS = ('n_jobs', 'backend')
+
+LOCK_POLL = 0.05    # seconds between attempts to take the index lock
+
+
+# -----------------------------------------------------------------------------
+
+class ModelRegistry:
+
+    def __init__(self, root='models', max_bytes=2 * 1024 ** 3, verbose=True):
+        """Initialize a registry backed by `root`.
+
+        `max_bytes` is the disk budget for the stored models.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.verbose = verbose
+        self._loaded = {}
+        os.makedirs(self.root, exist_ok=True)
+        self.index = self._read_index()
+
+    def key(self, model, X1, X2):
+        """Registry key of `model` (fitted or not) trained on (X1, X2).
+
+        Includes the source of the model's module (and of the repo modules
+        it imports), so editing PCCA.py does not return models fitted by
+        the old code.
+        """
+        params = {name: value for name, value in model.get_params().items()
+                  if name not in _EXECUTION_PARAMS}
+        return hash_inputs(type(model).__name__, params,
+                           source_digest(type(model).__module__), X1, X2)
+
+    def path(self, key):
+        return os.path.join(self.root, f"{key[:16]}.npz")
+
+    def __contains__(self, key):
+        return key in self._read_index()
+
+    def get(self, key):
+        """Return the model stored under `key`, reading it on first use.
+        """
+        with self._update_index():
+            if key not in self.index:
+                raise KeyError(key)
+            if key not in self._loaded:
+                self._loaded[key] = PCCA.load(self.path(key))
+            self.index[key]['last_used'] = time.time()
+        return self._loaded[key]
+
+    def put(self, key, model):
+        """Store a fitted model under `key`, then enforce the disk budget.
+        """
+        path = self.path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp.npz'
+        model.save(tmp_path)
+        os.replace(tmp_path, path)
+        self._loaded[key] = model
+        with self._update_index():
+            self.index[key] = {'model_class': type(model).__name__,
+                               'params': model.get_params(),
+                               'bytes': os.path.getsize(path),
+                               'last_used': time.time()}
+            self._evict(keep=key)
+
+    def fit(self, model, X1, X2):
+        """Fit `model` on (X1, X2) unless an identical fit is registered.
+
+        Returns the registered model if there is one, otherwise fits `model`,
+        registers it and returns it.
+        """
+        key = self.key(model, X1, X2)
+        try:
+            registered = self.get(key)
+        except KeyError:
+            pass
+        else:
+            self._log(f"[registry] {type(model).__name__}: loaded {key[:16]}")
+            return registered
+        model.fit(X1, X2)
+        self.put(key, model)
+        self._log(f"[registry] {type(model).__name__}: fitted {key[:16]}")
+        return model
+
+    def remove(self, key):
+        with self._update_index():
+            self._remove(key)
+
+    def evict(self, keep=None):
+        """Drop least recently used models until the budget is met.
+
+        `keep` is never evicted, even if it alone exceeds the budget.
+        """
+        with self._update_index():
+            self._evict(keep)
+
+    @property
+    def total_bytes(self):
+        return sum(entry['bytes'] for entry in self.index.values())
+
+# -----------------------------------------------------------------------------
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        self._loaded.pop(key, None)
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def _evict(self, keep=None):
+        total = self.total_bytes
+        by_age = sorted(self.index, key=lambda k: self.index[k]['last_used'])
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index[key]['bytes']
+            self._log(f"[registry] evicted {key[:16]}")
+            self._remove(key)
+
+    @contextmanager
+    def _update_index(self):
+        """Read-modify-write of index.json under index.json.lock.
+
+        Inside the block self.index is the current on-disk index; it is
+        written back when the block exits without an error.
+        """
+        lock_path = f'{self._index_path()}.lock'
+        while not _try_lock(lock_path):
+            time.sleep(LOCK_POLL)
+        try:
+            self.index = self._read_index()
+            yield
+            self._write_index()
+        finally:
+            os.remove(lock_path)
+
+    def _index_path(self):
+        return os.path.join(self.root, 'index.json')
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path()):
+            return {}
+        with open(self._index_path()) as f:
+            index = json.load(f)
+        # Entries whose file was deleted by hand are dropped
+        return {key: entry for key, entry in index.items()
+                if os.path.exists(self.path(key))}
+
+    def _write_index(self):
+        tmp_path = f'{self._index_path()}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.index, f, indent=1)
+        os.replace(tmp_path, self._index_path())
+
+    def _log(self, msg):
+        if self.verbose:
+            print(msg)
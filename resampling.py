@@ -0,0 +1,221 @@
+"""============================================================================
+Resampling significance for fitted PCCA models.
+
+Bootstrap confidence intervals and trial-shuffle null distributions for the
+canonical correlations and the loadings W. A replicate is never materialized
+as a resampled data matrix: a bootstrap draw is an integer count per trial and
+a shuffle is a re-pairing of view-2 trials with view-1 trials, and both enter
+EM through the weighted second moments of the data the model was fitted on
+(PCCA._Moments). Every fit, of the full data and of each replicate, runs
+until its average log-likelihood per trial and feature changes by less
+than `tol` in one EM step. Null fits drift slowly towards W -> 0 and never
+settle by a relative change in W, but their likelihood flattens within a
+few dozen steps. Each entry of a batch stops on its own, so a replicate's
+result does not depend on which others it was batched with. Bootstrap
+replicates are warm-started from the converged full-data fit. The
+permutation test instead starts the observed and every null fit from one
+common initialization drawn independently of the data: the EM has several
+fixed points (W -> 0 among them), and a null fit warm-started from the
+observed solution stays in its basin, which biases the null towards the
+observed statistic. Replicates are refitted as stacked batches, optionally
+spread over a thread pool.
+
+null_calibration checks the permutation test on data with independent views,
+where its p-values should be uniform.
+============================================================================"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import instrument
+from PCCA import (_Moments, _em_update, _log_likelihood, _canonical_correlations,
+                  _noise_eye, _t)
+
+
+# -----------------------------------------------------------------------------
+
+def bootstrap_pcca(model, n_resamples=1000, tol=1e-5, max_iters=1000, alpha=0.05,
+                   batch_size=50, n_jobs=1, random_state=None):
+    """Bootstrap a fitted PCCA model over trials.
+
+    Returns a dict with the replicate canonical correlations
+    (n_resamples, k), the replicate loadings W (n_resamples, p, k) rotated
+    onto the converged full-data W, percentile intervals `ci` (2, k) and
+    `W_ci` (2, p, k) at level 1 - alpha, and the bootstrap standard error
+    `W_se`.
+    """
+    _check_data(model)
+    rng = np.random.default_rng(random_state)
+    n = model.n
+    weights = rng.multinomial(n, np.full(n, 1 / n), size=n_resamples)
+
+    start = _converged_fit(model, (model.W, model.Psi1, model.Psi2), tol, max_iters)
+    W, rho = _refit(model, start, 'weights', weights, tol, max_iters, batch_size,
+                    n_jobs)
+    W = align_loadings(W, start[0])
+
+    q = [100 * alpha / 2, 100 * (1 - alpha / 2)]
+    return {
+        'canonical_correlations': rho,
+        'W': W,
+        'ci': np.percentile(rho, q, axis=0),
+        'W_ci': np.percentile(W, q, axis=0),
+        'W_se': W.std(axis=0, ddof=1),
+    }
+
+
+def permutation_test_pcca(model, n_resamples=1000, tol=1e-5, max_iters=1000,
+                          batch_size=50, n_jobs=1, random_state=None):
+    """Trial-shuffle null for the canonical correlations of a fitted model.
+
+    View 2 trials are re-paired with view 1 trials at random, which keeps
+    each region's own covariance and destroys only the shared part. Returns
+    the observed correlations, the null correlations and loadings, and
+    one-sided p-values per component, (1 + #{null >= observed}) / (B + 1).
+
+    The observed statistic is refitted rather than taken from `model`: it
+    and every null replicate are the same procedure (same start, same `tol`)
+    applied to the original and to the re-paired trials, so the p-values
+    stay valid whichever fixed point the fits end in.
+    """
+    _check_data(model)
+    rng = np.random.default_rng(random_state)
+    perms = rng.permuted(np.tile(np.arange(model.n), (n_resamples, 1)), axis=1)
+
+    W0 = rng.standard_normal((model.p, model.k))
+    start = (W0, _noise_eye(model.p1, model.noise[0]), _noise_eye(model.p2, model.noise[1]))
+    W, rho = _refit(model, start, 'perm', perms, tol, max_iters, batch_size, n_jobs)
+    fit = _converged_fit(model, start, tol, max_iters)
+    W = align_loadings(W, fit[0])
+
+    observed = _canonical_correlations(*fit, model.noise)
+    p_values = (1 + np.sum(rho >= observed, axis=0)) / (n_resamples + 1)
+    return {
+        'observed': observed,
+        'canonical_correlations': rho,
+        'W': W,
+        'p_values': p_values,
+    }
+
+
+def null_calibration(n_datasets=200, n=200, p1=10, p2=10, k=2, n_resamples=199,
+                     tol=1e-5, max_iters=1000, alpha=0.05, random_state=None,
+                     **model_kwargs):
+    """permutation_test_pcca on `n_datasets` draws with independent views.
+
+    Each view is drawn on its own from the PCCA model (synthetic.make_pcca_data),
+    so the views share nothing and the first component's p-values should
+    be uniform on (0, 1]. Returns a dict with the p-values (n_datasets, k),
+    the rejection rate of the first component at `alpha`, and the
+    Kolmogorov-Smirnov distance of its p-values from the uniform.
+    """
+    from PCCA import PCCA
+    from synthetic import make_pcca_data
+
+    rng = np.random.default_rng(random_state)
+    p_values = np.empty((n_datasets, k))
+    for d in range(n_datasets):
+        X1 = make_pcca_data(n, p1, 0, k, random_state=rng)[0]
+        X2 = make_pcca_data(n, p2, 0, k, random_state=rng)[0]
+        model = PCCA(k, 100, **model_kwargs)
+        model.fit(X1, X2)
+        p_values[d] = permutation_test_pcca(model, n_resamples, tol, max_iters,
+                                            random_state=rng)['p_values']
+
+    p = np.sort(p_values[:, 0])
+    cdf = np.arange(1, n_datasets + 1) / n_datasets
+    ks = np.max(np.maximum(cdf - p, p - (cdf - 1 / n_datasets)))
+    rate = np.mean(p_values[:, 0] <= alpha)
+    print(f"Null calibration: {rate:.3f} of {n_datasets} datasets with p <= {alpha}, "
+          f"KS distance {ks:.3f}")
+    return {'p_values': p_values, 'rejection_rate': rate, 'ks': ks}
+
+
+def align_loadings(W, W_ref):
+    """Rotate each W[b] onto W_ref (orthogonal Procrustes, batched).
+
+    The PCCA likelihood is invariant to W -> W R for orthogonal R, so
+    replicate loadings are only comparable after this alignment.
+    """
+    U, _, Vt = np.linalg.svd(_t(W) @ W_ref)
+    return W @ (U @ Vt)
+
+
+# -----------------------------------------------------------------------------
+
+def _converged_fit(model, start, tol, max_iters):
+    """(W, Psi1, Psi2) on the model's data, iterated from `start` until converged."""
+    mom = _Moments(model.p1, X=model.X, noise=model.noise)
+    return _iterate(mom, *start, model.reg, model.noise, tol, max_iters)
+
+
+def _check_data(model):
+    if not hasattr(model, 'X'):
+        raise ValueError("resampling needs the training data, which saved "
+                         "models do not keep; refit instead")
+
+
+def _refit(model, start, kind, draws, tol, max_iters, batch_size, n_jobs):
+    """EM on every resample in `draws` (weights or perms), warm-started
+    from `start`.
+    """
+    batches = [draws[i:i + batch_size] for i in range(0, len(draws), batch_size)]
+    refit = lambda b: _refit_batch(model, start, kind, b, tol, max_iters)
+    if n_jobs > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=n_jobs) as ex:
+            results = list(ex.map(refit, batches))
+    else:
+        results = [refit(b) for b in batches]
+    W, rho = (np.concatenate(parts) for parts in zip(*results))
+    return W, rho
+
+
+def _refit_batch(model, start, kind, draws, tol, max_iters):
+    B = len(draws)
+    mom = _Moments(model.p1, X=model.X, noise=model.noise, **{kind: draws})
+    W, Psi1, Psi2 = (np.repeat(A[None], B, axis=0) for A in start)
+    W, Psi1, Psi2 = _iterate(mom, W, Psi1, Psi2, model.reg, model.noise, tol,
+                             max_iters)
+    return W, _canonical_correlations(W, Psi1, Psi2, model.noise)
+
+
+def _iterate(mom, W, Psi1, Psi2, reg, noise, tol, max_iters):
+    """EM steps until each batch entry's log-likelihood has converged.
+
+    An entry stops once its average log-likelihood per trial and feature
+    changes by less than `tol` in one step, which unlike a relative change
+    is unaffected by rescaling the data; later steps only run on the entries
+    still active.
+    """
+    batched = W.ndim == 3
+    if not batched:
+        W, Psi1, Psi2 = W[None], Psi1[None], Psi2[None]
+    W, Psi1, Psi2 = W.copy(), Psi1.copy(), Psi2.copy()
+    p = W.shape[-2]
+
+    active = np.arange(len(W))
+    sub = mom
+    # With n=1 _log_likelihood is the average over trials
+    ll = _log_likelihood(mom, W, Psi1, Psi2, 1, noise) / p
+    n_steps = 0
+    for _ in range(max_iters):
+        W_a, Psi1_a, Psi2_a = _em_update(sub, W[active], Psi1[active],
+                                         Psi2[active], reg, noise)
+        W[active], Psi1[active], Psi2[active] = W_a, Psi1_a, Psi2_a
+        ll_new = _log_likelihood(sub, W_a, Psi1_a, Psi2_a, 1, noise) / p
+        n_steps += len(active)
+        done = np.abs(ll_new - ll[active]) < tol
+        ll[active] = ll_new
+        if np.all(done):
+            break
+        if np.any(done):
+            active = active[~done]
+            sub = mom.take(active)
+    else:
+        print(f"Warning: {len(active)} of {len(W)} EM fits not converged "
+              f"after {max_iters} iterations")
+    instrument.count('em_iterations', n_steps)
+    if not batched:
+        return W[0], Psi1[0], Psi2[0]
+    return W, Psi1, Psi2
@@ -2,10 +2,12 @@
 ###############################################################################
 # SETUP / IMPORTS
 ###############################################################################
+import contextlib
+import io
 import logging
 import os
-
-os.makedirs("results", exist_ok=True)
+from functools import lru_cache
+from types import SimpleNamespace
 
 logger = logging.getLogger('ibllib')
 logger.setLevel(logging.CRITICAL)
@@ -13,141 +15,390 @@ logger.setLevel(logging.CRITICAL)
 os.environ["TQDM_DISABLE"] = "1"
 
 import numpy as np
-import matplotlib.pyplot as plt
-from statsmodels.stats.multitest import multipletests
-from one.api import ONE
-from brainbox.io.one import SessionLoader, SpikeSortingLoader
-from brainbox.singlecell import bin_spikes
-from brainbox.singlecell import bin_spikes2D
-
-
-from iblatlas.atlas import AllenAtlas
-ba = AllenAtlas()
-
-one = ONE(base_url='https://openalyx.internationalbrainlab.org', \
-          password='international', \
-          silent=True)
 
 from eda import plot_cluster_all, get_diff_arrays_for_one_cluster, plot_difference_with_significance
 from preprocessing import find_sensitive_clusters_dict
-from sklearn.decomposition import PCA
-from PCCA import PCCA
+from preprocessing import extract_spikes_for_pcca_by_region, prepare_pcca_matrices
+from PCCA import PCCA, TimeResolvedPCCA
+from DPCCA import DynamicalPCCA
+import instrument
+from cache import StageCache
+from registry import ModelRegistry
+from reduction import AdaptivePCA
 
 ###############################################################################
-# EDA
+# PARAMETERS
 ###############################################################################
+# Every constant of the pipeline. compute() takes any subset of these as
+# overrides; sweep.py reads them from a config file and expands lists of
+# values into a grid of jobs.
+
+DEFAULTS = {
+    'pid': '3675290c-8134-4598-b924-83edb7940269',
+    'regions': ('SCdg', 'SCiw'),    # view 1, view 2
+    'event': 'stimOn',
+    'condition': 'left-right',
+    # binning for the cluster difference plot and the PCCA tensors (s)
+    'pre_time': 0.5,
+    'post_time': 1.0,
+    'bin_size': 0.05,
+    # sensitivity scan; same pre_time and bin_size
+    'sensitivity_post_time': 0.5,
+    'alpha': 0.005,
+    'n_shuffles': 500,
+    'correction': 'bonferroni-fdr',  # or 'fdr_bh', 'fdr_by', 'max', 'cluster'
+    # A float keeps that fraction of the variance (rank grown adaptively,
+    # capped at pca_max_components); an int fixes the rank.
+    'pca_components': 0.95,
+    'pca_max_components': 200,
+    'pca_method': 'randomized',     # or 'incremental' / 'full'
+    'latent_dims': list(range(1, 15)),
+    # time-resolved (window and step in bins) and dynamical PCCA
+    'components': 3,
+    'window': 3,
+    'step': 1,
+    'raster_cluster': 328,
+}
+
+
+def resolve_params(params=None):
+    """DEFAULTS updated with `params`, in canonical types.
+
+    Lists and tuples from a config file compare and hash the same as the
+    defaults, so equal parameter sets always give equal cache keys.
+    """
+    params = dict(params or {})
+    unknown = set(params) - set(DEFAULTS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {sorted(unknown)}")
+    params = {**DEFAULTS, **params}
+    params['regions'] = tuple(params['regions'])
+    if len(params['regions']) != 2:
+        raise ValueError(f"regions must name two regions, got {params['regions']}")
+    params['latent_dims'] = [int(d) for d in params['latent_dims']]
+    for key in ('pre_time', 'post_time', 'bin_size', 'sensitivity_post_time', 'alpha'):
+        params[key] = float(params[key])
+    return params
 
-pid = '3675290c-8134-4598-b924-83edb7940269'
-[eid, pname] = one.pid2eid(pid)
-
-ssl = SpikeSortingLoader(pid=pid, one=one, atlas=ba)
-spikes, clusters, channels = ssl.load_spike_sorting()
-clusters = ssl.merge_clusters(spikes, clusters, channels)
-
-sl = SessionLoader(eid=eid, one=one)
-sl.load_trials()
-trials = sl.trials
-
-sig = find_sensitive_clusters_dict(atlas_acronym='SCdg')
-
-cluster_to_plot = sig['stimOn'][-2]
-
-obs_diff, shuffled_diff, final_reject, time_bins = get_diff_arrays_for_one_cluster(
-    pid=pid,
-    sl=sl,
-    cluster_id=cluster_to_plot,
-    event_times=trials['stimOn_times'],
-    pre_time=0.5,
-    post_time=01.0,
-    bin_size=0.05,
-    alpha=0.005,
-    n_shuffles=500
-)
-
-plot_difference_with_significance(
-    time_bins=time_bins,
-    obs_diff=obs_diff,
-    shuffled_diff=shuffled_diff,
-    final_reject=final_reject,
-    title=f"Stim - Cluster {cluster_to_plot}"
-)
-
-plot_cluster_all(pid=pid, cluster_id=328, one=one, ba=ba)
 
 ###############################################################################
-# PREPROCESSING FOR PCCA
+# RESOURCES
 ###############################################################################
+# Built on first use, so importing this module (or re-plotting from the
+# cache) never connects to OpenAlyx or loads the atlas.
 
-from preprocessing import extract_spikes_for_pcca_by_region, prepare_pcca_matrices
+@lru_cache(maxsize=None)
+def get_one():
+    from one.api import ONE
+    return ONE(base_url='https://openalyx.internationalbrainlab.org', \
+               password='international', \
+               silent=True)
 
-sig_scdg = find_sensitive_clusters_dict(atlas_acronym='SCdg')
-sig_sciw = find_sensitive_clusters_dict(atlas_acronym='SCiw')
 
-data = extract_spikes_for_pcca_by_region(sig_scdg['pid'], sig_scdg, sig_sciw,'stimOn', one, ba)
-X_scdg, X_sciw, trial_idx, scdg_clusters, sciw_clusters = prepare_pcca_matrices(data, condition='left-right')
-
-###############################################################################
-# PCCA
-###############################################################################
+@lru_cache(maxsize=None)
+def get_atlas():
+    from iblatlas.atlas import AllenAtlas
+    return AllenAtlas()
 
-# Original 3D shapes
-print(X_scdg.shape)  # (n_trials, n_clusters, n_time_bins)
-print(X_sciw.shape)
 
-# Reshape into 2D (flatten cluster and time dimensions)
-X_scdg_flat = X_scdg.reshape(X_scdg.shape[0], -1)
-X_sciw_flat = X_sciw.reshape(X_sciw.shape[0], -1)
+@lru_cache(maxsize=None)
+def get_registry():
+    """Fitted PCCA models, keyed by training data and hyperparameters."""
+    return ModelRegistry('models')
 
-print(X_scdg_flat.shape)  # (n_trials, n_clusters * n_time_bins)
-print(X_sciw_flat.shape)
 
-# Apply PCA to reduce dimensionality
-pca_components = 200  # You can adjust this based on variance explained
-pca1 = PCA(n_components=pca_components)
-pca2 = PCA(n_components=pca_components)
+_sessions = {}
 
-X1_pcca = pca1.fit_transform(X_scdg_flat)
-X2_pcca = pca2.fit_transform(X_sciw_flat)
 
-print(X1_pcca.shape)  # Now (n_trials, pca_components)
-print(X2_pcca.shape)
+def get_session(pid):
+    """Spikes, clusters and trials of `pid` (prefetch.Session).
 
-def pcca_rmse(X1, X2, components=2):
-    # 1) Fit
-    pcca = PCCA(components, 100)
-    pcca.fit(X1_pcca, X2_pcca)
+    Downloaded the first time a stage needs them and shared by the stages
+    that follow; use_session() hands in one fetched ahead of time. Only the
+    latest insertion is held.
+    """
+    if pid not in _sessions:
+        from prefetch import session_fetcher
+        use_session(session_fetcher(get_one(), get_atlas())(pid))
+    return _sessions[pid]
 
-    # 2) Generate same # of samples as original
-    n_samples = X1.shape[0]
-    X1_gen, X2_gen = pcca.sample()
 
-    # 3) RMSE
-    num_samples = min(X1.shape[0], X2.shape[0])
+def use_session(session):
+    """Serve `session` from get_session() in place of a download."""
+    _sessions.clear()
+    _sessions[session.pid] = session
 
-    if X1.shape[0] != X2.shape[0]:
-        X1, X2 = X1[:num_samples], X2[:num_samples]
 
-    rmse1 = np.sqrt(np.mean((X1_gen - X1_pcca)**2))
-    rmse2 = np.sqrt(np.mean((X2_gen - X2_pcca)**2))
-    return rmse1, rmse2
+###############################################################################
+# STAGES
+###############################################################################
+# Every stage only takes hashable parameters and upstream stage results, so
+# StageCache can key it by its inputs. ONE and the atlas are shared resources
+# and deliberately not part of the keys.
+
+def stage_load(pid):
+    """Load the trials table for a probe insertion."""
+    return get_session(pid).trials
+
+
+def stage_sensitivity(atlas_acronym, pid, pre_time, post_time, bin_size, alpha,
+                      n_shuffles, correction='bonferroni-fdr'):
+    """Permutation test for stim/movement/feedback sensitive clusters."""
+    session = get_session(pid) if pid is not None else None
+    return find_sensitive_clusters_dict(atlas_acronym=atlas_acronym, pid=pid,
+                                        pre_time=pre_time, post_time=post_time,
+                                        bin_size=bin_size, alpha=alpha,
+                                        n_shuffles=n_shuffles, correction=correction,
+                                        session=session)
+
+
+def stage_cluster_diff(pid, trials, cluster_id, event, pre_time, post_time,
+                       bin_size, alpha, n_shuffles, correction='bonferroni-fdr'):
+    """Observed/shuffled Right - Left differences for a single cluster."""
+    return get_diff_arrays_for_one_cluster(
+        pid=pid,
+        sl=SimpleNamespace(trials=trials),
+        cluster_id=cluster_id,
+        event_times=trials[f'{event}_times'],
+        pre_time=pre_time,
+        post_time=post_time,
+        bin_size=bin_size,
+        alpha=alpha,
+        n_shuffles=n_shuffles,
+        correction=correction,
+        session=get_session(pid)
+    )
+
+
+def stage_extract(sig_scdg, sig_sciw, event_type, condition, regions=('SCdg', 'SCiw'),
+                  pre_time=0.5, post_time=1.0, bin_size=0.05):
+    """Bin sensitive clusters of both regions into (trials x time x neurons)."""
+    pid = sig_scdg['pid']
+    data = extract_spikes_for_pcca_by_region(pid, sig_scdg, sig_sciw,
+                                             event_type, None, None,
+                                             session=get_session(pid),
+                                             regions=regions, pre_time=pre_time,
+                                             post_time=post_time, bin_size=bin_size)
+    return (prepare_pcca_matrices(data, condition=condition, regions=regions)
+            + (data['bin_times'],))
+
+
+def stage_pca(X, n_components, max_components, method):
+    """Reduce (trials x time x neurons), flattened batch-wise, with PCA."""
+    print((X.shape[0], int(np.prod(X.shape[1:]))))  # (n_trials, n_clusters * n_time_bins)
+    pca = AdaptivePCA(n_components=n_components, method=method,
+                      max_components=max_components)
+    return pca.fit_transform(X)
+
+
+def pcca_rmse(X1, X2, components=2, n_init=5):
+    """Fit PCCA and return the cross-view prediction RMSEs.
+
+    Uses the conditional means E[X1 | X2] and E[X2 | X1] rather than random
+    draws from the fitted model, so the sweep is deterministic given the fit.
+    The best of `n_init` batched random restarts is kept, and a model
+    already in the registry is reused instead of refitted.
+    """
+    pcca = get_registry().fit(PCCA(components, 100, n_init=n_init), X1, X2)
+    return pcca.prediction_error(X1, X2)
+
+
+def stage_pcca_sweep(X1, X2, latent_dims):
+    """Fit PCCA for each latent dimensionality and record the RMSE."""
+    rmseA, rmseB = [], []
+    for d in latent_dims:
+        rA, rB = pcca_rmse(X1, X2, d)
+        rmseA.append(rA)
+        rmseB.append(rB)
+        instrument.count('pcca_sweep_dims')
+    return rmseA, rmseB
+
+
+def stage_time_resolved(X1, X2, bin_times, components, n_iters, window, step):
+    """Windowed PCCA over the trial tensors (no flattening of time)."""
+    model = TimeResolvedPCCA(components, n_iters, window=window, step=step)
+    model.fit(X1, X2, bin_times=bin_times)
+    return model.times_, model.canonical_correlations_
+
+
+def stage_dynamical(X1, X2, components, n_iters):
+    """State-space PCCA on the trial tensors; trial-averaged latents."""
+    model = DynamicalPCCA(components, n_iters)
+    model.fit(X1, X2)
+    print(f"Dynamical PCCA cross-view RMSE: {model.prediction_error(X1, X2)}")
+    return model.transform(X1, X2).mean(axis=0)
+
+
+def plot_dynamical(times, latents, event, regions=('SCdg', 'SCiw'), out_dir='results'):
+    import matplotlib.pyplot as plt
+
+    for j in range(latents.shape[1]):
+        plt.plot(times, latents[:, j], label=f'Latent {j + 1}')
+    plt.axvline(0, linestyle='--', color='k')
+    plt.xlabel(f"Time from {event} (s)")
+    plt.ylabel("Smoothed Shared Latent (trial mean)")
+    plt.title(f"Dynamical PCCA ({regions[0]} - {regions[1]})")
+    plt.legend()
+    plt.savefig(os.path.join(out_dir, "Dynamical PCCA Latents.png"), dpi=300,
+                bbox_inches='tight')
+    plt.close()
+
+
+def plot_time_resolved(times, rho, event, regions=('SCdg', 'SCiw'), out_dir='results'):
+    import matplotlib.pyplot as plt
+
+    for j in range(rho.shape[1]):
+        plt.plot(times, rho[:, j], marker='o', label=f'Component {j + 1}')
+    plt.axvline(0, linestyle='--', color='k')
+    plt.xlabel(f"Time from {event} (s)")
+    plt.ylabel("Canonical Correlation")
+    plt.title(f"Time-Resolved PCCA ({regions[0]} - {regions[1]})")
+    plt.legend()
+    plt.savefig(os.path.join(out_dir, "Time-Resolved PCCA.png"), dpi=300,
+                bbox_inches='tight')
+    plt.close()
+
+
+def plot_pcca_sweep(latent_dims, rmseA, rmseB, regions=('SCdg', 'SCiw'), out_dir='results'):
+    import matplotlib.pyplot as plt
+
+    plt.plot(latent_dims, rmseA, marker='o', label=f'{regions[0]} RMSE')
+    plt.plot(latent_dims, rmseB, marker='s', label=f'{regions[1]} RMSE')
+    plt.xlabel("Number of Latent Components")
+    plt.ylabel("RMSE")
+    plt.title("PCCA Cross-View Prediction Error")
+    plt.legend()
+    plt.savefig(os.path.join(out_dir, "PCCA Reconstruction Error.png"), dpi=300,
+                bbox_inches='tight')
+    plt.close()
 
-# Suppose X1, X2 are (nSamples, nFeaturesA/B)
-latent_dims = range(1,15)
-rmseA, rmseB = [], []
 
-for d in latent_dims:
-    rA, rB = pcca_rmse(X1_pcca, X2_pcca, d)
-    rmseA.append(rA)
-    rmseB.append(rB)
-    print(f"latent_dims {d} done")
+###############################################################################
+# PIPELINE
+###############################################################################
+
+def compute(cache, params=None, session=None):
+    """Run (or read back) every analysis stage; returns what the plots need.
+
+    `params` overrides entries of DEFAULTS. `session` is an already loaded
+    prefetch.Session of the PID, e.g. from a SessionPrefetcher.
+    """
+    p = resolve_params(params)
+    pid, event, regions = p['pid'], p['event'], p['regions']
+    if session is not None:
+        if session.pid != pid:
+            raise ValueError(f"session holds {session.pid}, not {pid}")
+        use_session(session)
+
+    # -------------------------------- EDA ------------------------------------
+    trials = cache.run('load', stage_load, pid)
+
+    sensitivity = dict(pid=pid, pre_time=p['pre_time'],
+                       post_time=p['sensitivity_post_time'], bin_size=p['bin_size'],
+                       alpha=p['alpha'], n_shuffles=p['n_shuffles'],
+                       correction=p['correction'])
+    # identical to sig_scdg below; deduplicated by the cache
+    sig = cache.run('sensitivity', stage_sensitivity, regions[0], **sensitivity)
+    cluster_to_plot = sig.value[event][-2]
+
+    obs_diff, shuffled_diff, final_reject, time_bins = cache.run(
+        'cluster_diff', stage_cluster_diff,
+        pid, trials, cluster_to_plot, event,
+        pre_time=p['pre_time'], post_time=p['post_time'], bin_size=p['bin_size'],
+        alpha=p['alpha'], n_shuffles=p['n_shuffles'], correction=p['correction']
+    ).value
+
+    # ----------------------- PREPROCESSING FOR PCCA --------------------------
+    sig_scdg = cache.run('sensitivity', stage_sensitivity, regions[0], **sensitivity)
+    sig_sciw = cache.run('sensitivity', stage_sensitivity, regions[1], **sensitivity)
+
+    matrices = cache.run('extract', stage_extract, sig_scdg, sig_sciw,
+                         event, p['condition'], regions=regions,
+                         pre_time=p['pre_time'], post_time=p['post_time'],
+                         bin_size=p['bin_size'])
+    X_scdg, X_sciw, trial_idx, scdg_clusters, sciw_clusters, bin_times = matrices.value
+
+    # -------------------------------- PCCA -----------------------------------
+    # Original 3D shapes: (n_trials, n_time_bins, n_clusters)
+    print(X_scdg.shape)
+    print(X_sciw.shape)
+
+    # Apply PCA to reduce dimensionality
+    pca = (p['pca_components'], p['pca_max_components'], p['pca_method'])
+    X1_pcca = cache.run('pca', stage_pca, X_scdg, *pca)
+    X2_pcca = cache.run('pca', stage_pca, X_sciw, *pca)
+
+    print(X1_pcca.value.shape)  # Now (n_trials, pca_components)
+    print(X2_pcca.value.shape)
+
+    latent_dims = p['latent_dims']
+    rmseA, rmseB = cache.run('pcca_sweep', stage_pcca_sweep,
+                             X1_pcca, X2_pcca, latent_dims).value
+
+    # When does shared variability between the regions peak?
+    times, rho = cache.run('time_resolved', stage_time_resolved,
+                           X_scdg, X_sciw, bin_times, components=p['components'],
+                           n_iters=100, window=p['window'], step=p['step']).value
+
+    # Shared latent with linear-Gaussian dynamics across bins
+    latents = cache.run('dynamical', stage_dynamical, X_scdg, X_sciw,
+                        components=p['components'], n_iters=50).value
+
+    return dict(params=p, pid=pid, event=event, regions=regions,
+                cluster_to_plot=cluster_to_plot, time_bins=time_bins,
+                obs_diff=obs_diff, shuffled_diff=shuffled_diff,
+                final_reject=final_reject, latent_dims=latent_dims,
+                rmseA=rmseA, rmseB=rmseB, times=times, rho=rho,
+                bin_times=bin_times, latents=latents)
+
+
+def is_cached(cache_dir, params=None):
+    """True if every stage of `params` is in `cache_dir`, so that compute()
+    would not need the session data."""
+    cache = StageCache(cache_dir=cache_dir, verbose=False, compute=False)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            compute(cache, params)
+    except LookupError:
+        return False
+    return True
+
+
+def plot_results(results, raster=True, out_dir="results"):
+    """Write every figure to `out_dir`. `raster` needs OpenAlyx access."""
+    os.makedirs(out_dir, exist_ok=True)
+    r = SimpleNamespace(**results)
+
+    plot_difference_with_significance(
+        time_bins=r.time_bins,
+        obs_diff=r.obs_diff,
+        shuffled_diff=r.shuffled_diff,
+        final_reject=r.final_reject,
+        title=f"{r.event} - Cluster {r.cluster_to_plot}",
+        out_dir=out_dir
+    )
+
+    if raster:
+        plot_cluster_all(pid=r.pid, cluster_id=r.params['raster_cluster'],
+                         one=get_one(), ba=get_atlas(), out_dir=out_dir)
+
+    plot_pcca_sweep(r.latent_dims, r.rmseA, r.rmseB, r.regions, out_dir)
+
+    plot_time_resolved(r.times, r.rho, r.event, r.regions, out_dir)
+
+    plot_dynamical(r.bin_times, r.latents, r.event, r.regions, out_dir)
+
+
+def main(cache=None, raster=True, params=None, out_dir="results"):
+    if cache is None:
+        cache = StageCache(cache_dir='cache')
+
+    plot_results(compute(cache, params), raster=raster, out_dir=out_dir)
+
+    if instrument.enabled:
+        print(f"Instrumentation report: {instrument.write_report(out_dir)}")
+    print("Done!")
 
-plt.plot(latent_dims, rmseA, marker='o', label='SCdg RMSE')
-plt.plot(latent_dims, rmseB, marker='s', label='SCiw RMSE')
-plt.xlabel("Number of Latent Components")
-plt.ylabel("RMSE")
-plt.title("PCCA Reconstruction Error")
-plt.legend()
-plt.savefig(f"results/PCCA Reconstruction Error.png", dpi=300, bbox_inches='tight')
-plt.close()
 
-print("Done!")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
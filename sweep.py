@@ -0,0 +1,206 @@
+"""============================================================================
+Parameter sweeps over the run.py pipeline.
+
+    python cli.py sweep sweep.toml --jobs 4
+    python cli.py sweep --pid PID1 PID2 --event stimOn feedback --bin-size 0.02 0.05
+
+A config file (TOML or JSON) has two optional tables:
+
+    [params]                     # overrides of run.DEFAULTS for every job
+    n_shuffles = 1000
+
+    [sweep]                      # one job per combination of these lists
+    pid = ["3675290c-8134-4598-b924-83edb7940269", "..."]
+    regions = [["SCdg", "SCiw"], ["SCdg", "SCig"]]
+    event = ["stimOn", "firstMovement"]
+    bin_size = [0.02, 0.05]
+
+Jobs run in separate worker processes and share the stage cache. A stage
+that several jobs have in common (e.g. a PID's sensitivity scan, which does
+not depend on the event) is computed by the first job to reach it; the
+others wait on its lock file (cache.StageCache) and read it back. Each
+job writes params.json, results.pkl and its figures to <out>/<job id>/,
+where the job id is a hash of the job's full parameter set, and
+<out>/sweep.csv lists every job with its parameters and status.
+============================================================================"""
+
+import csv
+import itertools
+import json
+import os
+import pickle
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import instrument
+from cache import StageCache, hash_inputs
+
+
+# -----------------------------------------------------------------------------
+
+def load_config(path):
+    """Read a TOML or JSON sweep config; returns (params, sweep) dicts.
+    """
+    if path.endswith('.toml'):
+        import tomllib
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+    else:
+        with open(path) as f:
+            config = json.load(f)
+    unknown = set(config) - {'params', 'sweep'}
+    if unknown:
+        raise ValueError(f"Unknown sections in {path}: {sorted(unknown)}")
+    return config.get('params', {}), config.get('sweep', {})
+
+
+def expand_jobs(params=None, sweep=None):
+    """Full parameter dicts of every job in the grid `sweep` x `params`.
+
+    Each value of `sweep` is a list of alternatives; the grid is their
+    cartesian product, with the entries of `params` shared by all jobs.
+    Duplicate jobs are dropped.
+    """
+    from run import resolve_params
+
+    params, sweep = dict(params or {}), dict(sweep or {})
+    for key, values in sweep.items():
+        if not isinstance(values, (list, tuple)) or not values:
+            raise ValueError(f"sweep.{key} must be a non-empty list")
+
+    jobs = {}
+    for values in itertools.product(*sweep.values()):
+        job = resolve_params({**params, **dict(zip(sweep, values))})
+        jobs.setdefault(job_id(job), job)
+    return list(jobs.values())
+
+
+def job_id(params):
+    """Short hash of a resolved parameter dict; names the job's directory."""
+    return hash_inputs(params)[:12]
+
+
+# -----------------------------------------------------------------------------
+
+def run_job(params, out_root='results', cache_dir='cache', raster=False, session=None):
+    """Run the pipeline for one job and store its outputs. Returns its id.
+
+    `session` is the job's prefetched prefetch.Session, if any.
+    """
+    import run
+
+    params = run.resolve_params(params)
+    name = job_id(params)
+    out_dir = os.path.join(out_root, name)
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, 'params.json'), 'w') as f:
+        json.dump(params, f, indent=1)
+
+    if instrument.enabled:
+        instrument.reset()
+    results = run.compute(StageCache(cache_dir=cache_dir), params, session=session)
+    with open(os.path.join(out_dir, 'results.pkl'), 'wb') as f:
+        pickle.dump(results, f, protocol=pickle.HIGHEST_PROTOCOL)
+    run.plot_results(results, raster=raster, out_dir=out_dir)
+    if instrument.enabled:
+        instrument.write_report(out_dir)
+    return name
+
+
+def run_sweep(jobs, n_jobs=None, out_root='results', cache_dir='cache', raster=False,
+              prefetch=2):
+    """Run `jobs` (from expand_jobs) on `n_jobs` worker processes.
+
+    With one worker, jobs run grouped by PID and the sessions of the next
+    `prefetch` PIDs download in background threads (prefetch.SessionPrefetcher)
+    while the current PID's jobs compute. PIDs whose jobs are all cached are
+    not downloaded. With several workers, each job loads its own session,
+    overlapping with the other workers' compute.
+
+    A failing job is reported and recorded in sweep.csv without stopping the
+    others. Returns the sweep.csv rows.
+    """
+    n_jobs = n_jobs or min(len(jobs), os.cpu_count() or 1)
+    os.makedirs(out_root, exist_ok=True)
+    print(f"Running {len(jobs)} jobs on {n_jobs} workers")
+
+    rows = []
+    if n_jobs == 1:
+        for params, session in _prefetched(jobs, cache_dir, prefetch):
+            rows.append(_job_row(params, _call(run_job, params, out_root, cache_dir,
+                                               raster, session)))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as ex:
+            futures = {ex.submit(_call, run_job, params, out_root, cache_dir, raster):
+                       params for params in jobs}
+            for future in as_completed(futures):
+                rows.append(_job_row(futures[future], future.result()))
+
+    rows.sort(key=lambda row: row['job'])
+    _write_rows(rows, os.path.join(out_root, 'sweep.csv'))
+    n_failed = sum(row['status'] != 'ok' for row in rows)
+    print(f"{len(rows) - n_failed} jobs done, {n_failed} failed; "
+          f"see {os.path.join(out_root, 'sweep.csv')}")
+    return rows
+
+
+# -----------------------------------------------------------------------------
+
+def _prefetched(jobs, cache_dir, depth):
+    """(params, session) for every job, grouped by PID, with the sessions of
+    uncached PIDs fetched `depth` PIDs ahead (session None otherwise)."""
+    import run
+    from prefetch import SessionPrefetcher, session_fetcher
+
+    by_pid = {}
+    for params in jobs:
+        by_pid.setdefault(params['pid'], []).append(params)
+    needed = [pid for pid, group in by_pid.items() if pid is not None
+              and not all(run.is_cached(cache_dir, params) for params in group)]
+    if not needed or depth < 1:
+        for group in by_pid.values():
+            for params in group:
+                yield params, None
+        return
+
+    fetch_session = session_fetcher(run.get_one(), run.get_atlas())
+
+    def fetch(pid):
+        # a failed download is retried by the PID's jobs, which record the error
+        try:
+            return fetch_session(pid)
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    sessions = iter(SessionPrefetcher(needed, fetch, depth=depth))
+    for pid, group in by_pid.items():
+        session = next(sessions) if pid in needed else None
+        for params in group:
+            yield params, session
+
+
+def _call(func, params, *args):
+    """func(params, *args) -> 'ok', or the error message if it raises."""
+    try:
+        func(params, *args)
+        return 'ok'
+    except Exception as e:
+        traceback.print_exc()
+        return f"failed: {type(e).__name__}: {e}"
+
+
+def _job_row(params, status):
+    name = job_id(params)
+    print(f"[sweep] {name}: {status}")
+    return {'job': name, 'status': status,
+            **{key: json.dumps(val) if isinstance(val, (list, tuple)) else val
+               for key, val in params.items()}}
+
+
+def _write_rows(rows, path):
+    fields = list(rows[0]) if rows else ['job', 'status']
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,142 @@
+"""============================================================================
+Synthetic IBL-shaped data.
+
+make_session simulates one probe insertion in the layout the pipeline gets
+from OpenAlyx: a `spikes` dict (times, clusters, amps, depths), a merged
+`clusters` dict (cluster_id, label, acronym, ...), `channels` and a trials
+table, wrapped in a prefetch.Session. Every cluster fires as a homogeneous
+Poisson process plus an event-locked response after stimulus onset whose
+strength depends on the trial side and on a few shared per-trial latents
+that all regions load on, so PCCA has a planted answer to recover.
+
+make_pcca_data draws directly from the PCCA generative model, for timing the
+model itself. Nothing here needs network access.
+============================================================================"""
+
+import numpy as np
+import pandas as pd
+
+from prefetch import Session
+
+
+# -----------------------------------------------------------------------------
+
+def make_session(n_trials=400, n_clusters=(30, 30), regions=('SCdg', 'SCiw'),
+                 base_rate=5.0, n_latents=2, latent_gain=20.0, side_gain=1.0,
+                 response_window=1.0, trial_duration=3.0, good_fraction=0.8,
+                 dt=0.01, pid='synthetic', random_state=None):
+    """Simulate one insertion with `n_clusters[i]` clusters in `regions[i]`.
+
+    The event-locked rate of cluster c on trial j is
+    latent_gain * softplus(L_c z_j + side_gain * s_c * side_j) * profile(t)
+    for t in [0, response_window) after stimOn, on top of a background rate
+    drawn around `base_rate` (Hz). profile(t) = (t / tau) exp(1 - t / tau)
+    peaks at tau = response_window / 5. z_j ~ N(0, I) are the planted latents.
+
+    Returns (session, truth), where truth holds 'latents' (n_trials,
+    n_latents), 'side' (+1 right / -1 left per trial), 'loadings'
+    (n_clusters, n_latents), 'side_tuning', 'profile' and 'profile_times'.
+    The side term is shared across regions too, so a PCCA fit needs
+    n_latents + 1 components to recover both.
+    """
+    rng = np.random.default_rng(random_state)
+    if np.isscalar(n_clusters):
+        n_clusters = (n_clusters,) * len(regions)
+    N = int(sum(n_clusters))
+
+    # ------------------------------ Trials -----------------------------------
+    side = np.where(rng.random(n_trials) < 0.5, 1, -1)        # +1 = right
+    contrast = rng.choice([1.0, 0.25, 0.125, 0.0625, 0.0], n_trials)
+    correct = rng.random(n_trials) < 0.85
+    stim_on = 1.0 + np.arange(n_trials) * trial_duration \
+        + rng.uniform(0, 0.5, n_trials)
+    first_move = stim_on + rng.gamma(4.0, 0.06, n_trials)
+    feedback = first_move + rng.uniform(0.1, 0.3, n_trials)
+    trials = pd.DataFrame({
+        'stimOn_times': stim_on,
+        'firstMovement_times': first_move,
+        'feedback_times': feedback,
+        'contrastLeft': np.where(side < 0, contrast, np.nan),
+        'contrastRight': np.where(side > 0, contrast, np.nan),
+        'choice': np.where(correct, side, -side),
+        'feedbackType': np.where(correct, 1, -1),
+        'probabilityLeft': np.full(n_trials, 0.5),
+    })
+    duration = stim_on[-1] + trial_duration
+
+    # ----------------------------- Clusters ----------------------------------
+    acronym = np.repeat(np.asarray(regions), n_clusters)
+    good = rng.random(N) < good_fraction
+    label = np.where(good, 1.0, rng.choice([0.0, 1 / 3], N))
+    rates = base_rate * rng.lognormal(0.0, 0.5, N)
+    depths = rng.uniform(0, 3840, N)
+    clusters = {
+        'cluster_id': np.arange(N),
+        'label': label,
+        'acronym': acronym,
+        'depths': depths,
+        'firing_rate': rates,
+    }
+    channels = {'acronym': acronym, 'axial_um': depths}
+
+    # ------------------------------ Spikes -----------------------------------
+    # Background: homogeneous Poisson over the whole session
+    counts = rng.poisson(rates * duration)
+    bg_clusters = np.repeat(np.arange(N), counts)
+    bg_times = rng.uniform(0, duration, counts.sum())
+
+    # Event-locked responses, on a (trials x clusters x fine bins) grid
+    z = rng.standard_normal((n_trials, n_latents))
+    loadings = rng.standard_normal((N, n_latents)) / np.sqrt(n_latents)
+    side_tuning = rng.standard_normal(N)
+    t = np.arange(0, response_window, dt)
+    tau = response_window / 5
+    profile = (t / tau) * np.exp(1 - t / tau)                 # peak 1 at tau
+    drive = z @ loadings.T + side_gain * side[:, None] * side_tuning
+    rate = latent_gain * np.logaddexp(0, drive)[:, :, None] * profile
+    ev_counts = rng.poisson(rate * dt)
+    trial_idx, cluster_idx, bin_idx = np.nonzero(ev_counts)
+    reps = ev_counts[trial_idx, cluster_idx, bin_idx]
+    ev_times = np.repeat(stim_on[trial_idx] + t[bin_idx], reps) \
+        + rng.uniform(0, dt, reps.sum())
+    ev_clusters = np.repeat(cluster_idx, reps)
+
+    times = np.concatenate([bg_times, ev_times])
+    spike_clusters = np.concatenate([bg_clusters, ev_clusters])
+    order = np.argsort(times, kind='stable')
+    spikes = {
+        'times': times[order],
+        'clusters': spike_clusters[order],
+        'amps': rng.lognormal(-10, 0.3, len(order)),
+        'depths': depths[spike_clusters[order]],
+    }
+
+    session = Session(pid, f'{pid}-eid', spikes, clusters, channels, trials,
+                      pname='probe00')
+    truth = {'latents': z, 'side': side, 'loadings': loadings,
+             'side_tuning': side_tuning, 'profile': profile, 'profile_times': t}
+    return session, truth
+
+
+def make_pcca_data(n=500, p1=50, p2=50, k=3, noise=1.0, random_state=None):
+    """Draw (X1, X2) from the PCCA model x_i = W_i z + e_i, e_i ~ N(0, noise^2 I).
+
+    Returns X1 (n, p1), X2 (n, p2), the latents Z (n, k) and W (p1 + p2, k).
+    """
+    rng = np.random.default_rng(random_state)
+    Z = rng.standard_normal((n, k))
+    W = rng.standard_normal((p1 + p2, k))
+    X = Z @ W.T + noise * rng.standard_normal((n, p1 + p2))
+    X -= X.mean(axis=0)
+    return X[:, :p1], X[:, p1:], Z, W
+
+
+def latent_recovery(Z_true, Z_hat):
+    """R^2 of each true latent regressed (with intercept) on the estimate.
+
+    Invariant to the rotation and scaling PCCA leaves unidentified.
+    """
+    A = np.hstack([Z_hat, np.ones((len(Z_hat), 1))])
+    coef = np.linalg.lstsq(A, Z_true, rcond=None)[0]
+    resid = Z_true - A @ coef
+    return 1 - resid.var(axis=0) / Z_true.var(axis=0)
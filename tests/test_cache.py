@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _stage_digests(seed):
+    """code_digest of run.py's stages in a fresh process with PYTHONHASHSEED=seed."""
+    script = ("import cache, run\n"
+              "for f in (run.stage_load, run.stage_sensitivity, run.stage_extract,\n"
+              "          run.stage_pca, run.stage_pcca_sweep):\n"
+              "    print(cache.code_digest(f))\n")
+    env = {**os.environ, 'PYTHONHASHSEED': str(seed)}
+    out = subprocess.run([sys.executable, '-c', script], cwd=REPO, env=env,
+                         capture_output=True, text=True, check=True)
+    return out.stdout.split()
+
+
+def test_code_digest_independent_of_hash_seed():
+    assert _stage_digests(1) == _stage_digests(2)
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from correction import fdr
+
+
+@pytest.mark.parametrize('method, sm_method', [('bh', 'fdr_bh'), ('by', 'fdr_by')])
+def test_fdr_matches_statsmodels(method, sm_method):
+    multipletests = pytest.importorskip('statsmodels.stats.multitest').multipletests
+    rng = np.random.default_rng(0)
+    p = rng.random((6, 40)) ** 3
+
+    reject, p_adj = fdr(p, 0.05, method)
+    for row in range(len(p)):
+        sm_reject, sm_adj, _, _ = multipletests(p[row], 0.05, sm_method)
+        np.testing.assert_allclose(p_adj[row], sm_adj, rtol=1e-12)
+        np.testing.assert_array_equal(reject[row], sm_reject)
+
+    reject, p_adj = fdr(p, 0.05, method, pooled=True)
+    sm_reject, sm_adj, _, _ = multipletests(p.ravel(), 0.05, sm_method)
+    np.testing.assert_allclose(p_adj.ravel(), sm_adj, rtol=1e-12)
+    np.testing.assert_array_equal(reject.ravel(), sm_reject)
+
+
+def test_fdr_skips_nan():
+    multipletests = pytest.importorskip('statsmodels.stats.multitest').multipletests
+    p = np.array([0.001, np.nan, 0.02, 0.04, np.nan, 0.3])
+    _, p_adj = fdr(p, 0.05)
+    tested = ~np.isnan(p)
+    assert np.all(np.isnan(p_adj[~tested]))
+    np.testing.assert_allclose(p_adj[tested], multipletests(p[tested], 0.05, 'fdr_bh')[1])
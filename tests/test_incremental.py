@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from incremental import RegionTensors, RunningSensitivity
+from PCCA import PCCA
+from synthetic import make_session
+
+
+def test_appended_tensors_match_extract():
+    pytest.importorskip('brainbox')
+    from preprocessing import extract_spikes_for_pcca_by_region, prepare_pcca_matrices
+
+    session, _ = make_session(n_trials=120, n_clusters=(8, 6), random_state=0)
+    clusters = session.clusters
+    good = clusters['label'] >= 0.5
+    sig = [{'pid': session.pid,
+            'stimOn': list(clusters['cluster_id'][good & (clusters['acronym'] == region)])}
+           for region in ('SCdg', 'SCiw')]
+    region_data = extract_spikes_for_pcca_by_region(session.pid, *sig, 'stimOn', None, None,
+                                                    session=session)
+    X1, X2, trial_idx, ids1, ids2 = prepare_pcca_matrices(region_data)
+
+    tensors = RegionTensors({'SCdg': ids1, 'SCiw': ids2})
+    for batch in np.array_split(np.arange(len(session.trials)), 3):
+        tensors.append(session.spikes, session.trials.iloc[batch].reset_index(drop=True))
+    Y1, Y2, idx, _, _ = tensors.matrices()
+
+    np.testing.assert_array_equal(idx, trial_idx)
+    np.testing.assert_array_equal(Y1, X1)
+    np.testing.assert_array_equal(Y2, X2)
+
+
+def test_single_batch_sensitivity_matches_find_sensitive_clusters():
+    pytest.importorskip('brainbox')
+    from preprocessing import find_sensitive_clusters
+
+    session, _ = make_session(n_trials=200, n_clusters=(8, 6), side_gain=3.0,
+                              random_state=0)
+    window = dict(pre_time=0.1, post_time=1.0, bin_size=0.05, n_shuffles=200)
+    event_times = session.trials['stimOn_times']
+    np.random.seed(0)
+    expected, times = find_sensitive_clusters(session.pid, event_times, session,
+                                              session=session, **window)
+    np.random.seed(0)
+    running = RunningSensitivity(**window)
+    running.update(session.spikes, session.clusters, session.trials)
+    found, found_times = running.sensitive_clusters()
+
+    assert expected
+    assert found == expected
+    np.testing.assert_allclose(found_times, times)
+
+
+def test_partial_fit_moments_match_full_fit():
+    rng = np.random.default_rng(0)
+    X1 = rng.standard_normal((200, 6))
+    X2 = rng.standard_normal((200, 5))
+
+    model, full = PCCA(2, 3), PCCA(2, 3)
+    model.fit(X1[:120], X2[:120])
+    model.partial_fit(X1[120:], X2[120:])
+    full.fit(X1, X2)
+
+    assert model.n == full.n == 200
+    np.testing.assert_allclose(model.moments.S, full.moments.S, rtol=1e-12)
+    np.testing.assert_array_equal(model.X, full.X)
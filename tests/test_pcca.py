@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+
+from PCCA import (PCCA, _em_update, _log_likelihood, _Moments, _noise_dense, _noise_eye,
+                  _run_em)
+from synthetic import make_pcca_data
+
+
+def _data_space_em(X, W, Psi1, Psi2, reg, n_iters):
+    """The original PCCA._em_step, on the p x n stacked data X."""
+    p1, n = len(Psi1), X.shape[1]
+    Psi = np.block([[Psi1, np.zeros((p1, len(Psi2)))],
+                    [np.zeros((len(Psi2), p1)), Psi2]])
+    for _ in range(n_iters):
+        Psi_inv = np.linalg.inv(Psi)
+        M = np.linalg.inv(np.eye(W.shape[1]) + W.T @ Psi_inv @ W)
+        Z = M @ W.T @ Psi_inv @ X
+        Ezz = Z @ Z.T + n * M
+        W = (X @ Z.T) @ np.linalg.inv(Ezz)
+        residual = X - W @ Z
+        Psi = np.zeros_like(Psi)
+        Psi[:p1, :p1] = residual[:p1] @ residual[:p1].T / n + reg * np.eye(p1)
+        Psi[p1:, p1:] = residual[p1:] @ residual[p1:].T / n + reg * np.eye(len(Psi2))
+    return W, Psi[:p1, :p1], Psi[p1:, p1:]
+
+
+def _problem(n=300, p1=8, p2=6, k=2, seed=0):
+    X1, X2, _, _ = make_pcca_data(n, p1, p2, k, random_state=seed)
+    X = np.hstack([X1, X2]).T
+    W = np.random.default_rng(seed).random((p1 + p2, k))
+    return X1, X2, X, W
+
+
+def test_em_update_matches_data_space_step():
+    _, _, X, W = _problem()
+    p1, n = 8, X.shape[1]
+    Psi1, Psi2 = np.eye(p1), np.eye(len(X) - p1)
+    expected = _data_space_em(X, W, Psi1, Psi2, 0.1, 200)
+
+    mom = _Moments(p1, S=X @ X.T / n)
+    for _ in range(200):
+        W, Psi1, Psi2 = _em_update(mom, W, Psi1, Psi2, 0.1)
+    for got, want in zip((W, Psi1, Psi2), expected):
+        np.testing.assert_allclose(got, want, rtol=1e-9, atol=1e-11)
+
+
+def test_fit_matches_data_space_em():
+    X1, X2, X, _ = _problem()
+    np.random.seed(0)
+    model = PCCA(2, 50, regularization=0.1)
+    model.fit(X1, X2)
+
+    np.random.seed(0)
+    W = np.vstack([np.random.random((X1.shape[1], 2)), np.random.random((X2.shape[1], 2))])
+    W, Psi1, Psi2 = _data_space_em(X, W, np.eye(X1.shape[1]), np.eye(X2.shape[1]), 0.1, 50)
+    np.testing.assert_allclose(model.W, W, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(model.Psi1, Psi1, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(model.Psi2, Psi2, rtol=1e-10, atol=1e-12)
+
+
+def test_batched_restarts_equal_separate_runs():
+    _, _, X, _ = _problem()
+    p1, p2 = 8, len(X) - 8
+    mom = _Moments(p1, S=X @ X.T / X.shape[1])
+    W = np.random.default_rng(1).random((4, p1 + p2, 2))
+    Psi1 = np.repeat(np.eye(p1)[None], 4, axis=0)
+    Psi2 = np.repeat(np.eye(p2)[None], 4, axis=0)
+
+    batched = _run_em(mom, W, Psi1, Psi2, 0.1, 30, X.shape[1])
+    for r in range(4):
+        single = _run_em(mom, W[r], Psi1[r], Psi2[r], 0.1, 30, X.shape[1])
+        for got, want in zip(batched, single):
+            np.testing.assert_allclose(got[r], want, rtol=1e-10, atol=1e-12)
+
+
+def test_implicit_moments_match_dense():
+    _, _, X, W = _problem()
+    p1, n = 8, X.shape[1]
+    dense = _Moments(p1, S=X @ X.T / n)
+    implicit = _Moments(p1, X=X)
+    state = {mom: (W, np.eye(p1), np.eye(len(X) - p1)) for mom in (dense, implicit)}
+    for mom in state:
+        for _ in range(20):
+            state[mom] = _em_update(mom, *state[mom], 0.1)
+    for got, want in zip(state[implicit], state[dense]):
+        np.testing.assert_allclose(got, want, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(_log_likelihood(implicit, *state[implicit], n),
+                               _log_likelihood(dense, *state[dense], n), rtol=1e-12)
+
+
+@pytest.mark.parametrize('noise', [('full', 'full'), ('diagonal', 'diagonal'),
+                                   ('isotropic', 'isotropic'), ('full', 'diagonal')])
+def test_log_likelihood_matches_scipy(noise):
+    multivariate_normal = pytest.importorskip('scipy.stats').multivariate_normal
+    _, _, X, W = _problem()
+    p1, n = 8, X.shape[1]
+    mom = (_Moments(p1, S=X @ X.T / n) if noise == ('full', 'full')
+           else _Moments(p1, X=X, noise=noise))
+    Psi1, Psi2 = _noise_eye(p1, noise[0]), _noise_eye(len(X) - p1, noise[1])
+    for _ in range(10):
+        W, Psi1, Psi2 = _em_update(mom, W, Psi1, Psi2, 0.1, noise)
+
+    Psi = np.zeros((len(X), len(X)))
+    Psi[:p1, :p1] = _noise_dense(Psi1, noise[0])
+    Psi[p1:, p1:] = _noise_dense(Psi2, noise[1])
+    expected = multivariate_normal(np.zeros(len(X)), W @ W.T + Psi).logpdf(X.T).sum()
+    np.testing.assert_allclose(_log_likelihood(mom, W, Psi1, Psi2, n, noise), expected,
+                               rtol=1e-10)
@@ -0,0 +1,13 @@
+import numpy as np
+
+from reduction import AdaptivePCA
+
+
+def test_incremental_rank_not_capped_by_batch_size():
+    rng = np.random.default_rng(0)
+    X = rng.standard_normal((300, 10, 12)) * np.linspace(1, 3, 12)
+    kept = {method: AdaptivePCA(0.9, method=method, batch_size=16, random_state=0).fit(X)
+            for method in ('incremental', 'full')}
+    assert kept['incremental'].n_components_ > 16
+    assert kept['incremental'].explained_variance_ratio_.sum() >= 0.9
+    assert abs(kept['incremental'].n_components_ - kept['full'].n_components_) <= 1